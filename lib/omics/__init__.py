@@ -20,34 +20,68 @@ Package to support geo-omics-scripts
 """
 
 import argparse
-import configparser
+from functools import lru_cache
 from importlib import import_module
-import inspect
+import os
 from os import environ
 from pathlib import Path
-from pkgutil import iter_modules
 import re
-import subprocess
 import sys
+import threading
+from types import ModuleType
 
+from ._commands import COMMANDS
 from ._version import get_version
 
 
-__version__ = get_version()
-
-
 OMICS_DIR = '.omics'
 CONFIG_FILE = 'config'
 CONF_SECTION_PROJECT = 'project'
 SCRIPT_PREFIX = 'omics-'
+PROJECT_ENV_VAR = 'OMICS_PROJECT'
+PROJECT_HOME_ENV_VAR = 'OMICS_PROJECT_HOME'
 DEFAULT_THREADS = 1
 DEFAULT_VERBOSITY = 1
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def __getattr__(name):
+    """
+    Provide the __version__ attribute lazily
+
+    Getting the version may require to run git, so this is only done on
+    demand.
+    """
+    if name == '__version__':
+        return get_version()
+    raise AttributeError('module {!r} has no attribute {!r}'
+                         ''.format(__name__, name))
+
+
+if sys.version_info < (3, 7):
+    # module-level __getattr__ needs python 3.7 (PEP 562), older pythons get
+    # the version eagerly, this is cheap once it is hard-coded at install time
+    __version__ = get_version()
+
+
+class ParserCaptured(Exception):
+    """
+    Raised by OmicsArgParser instead of parsing when in capture mode
+
+    This is used to build the command registry, see omics._commands
+    """
+    def __init__(self, parser):
+        super().__init__(parser.prog)
+        self.parser = parser
 
 
 class OmicsArgParser(argparse.ArgumentParser):
     """
     Implements extension to the standard parser
     """
+    capture = False
+    """ If True, parse_known_args() raises ParserCaptured """
+
     def __init__(self, *args, project_home=True, threads=True, add_help=True,
                  is_main_omics_parser=False,
                  just_parse=False, **kwargs):
@@ -95,7 +129,9 @@ class OmicsArgParser(argparse.ArgumentParser):
                 '--project-home',
                 metavar='PATH',
                 help='Omics project directory, by default, this is the '
-                     'current directory.',
+                     'directory given by the {} environment variable, or '
+                     'else the current directory.'
+                     ''.format(PROJECT_HOME_ENV_VAR),
             )
         common.add_argument(
             '-v', '--verbose',
@@ -125,6 +161,34 @@ class OmicsArgParser(argparse.ArgumentParser):
                 help='Number of threads / CPUs to employ',
             )
 
+    @classmethod
+    def from_registry(cls, options):
+        """
+        Make a parser from option metadata in the command registry
+
+        :param list options: List of option dicts, see omics._commands
+
+        The parser is only good for auto-completion.
+        """
+        argp = cls(add_help=False, project_home=False, threads=False,
+                   just_parse=True)
+        for i in options:
+            option_strings = [
+                j for j in i['options']
+                if j not in argp._option_string_actions
+            ]
+            if not option_strings:
+                continue
+            if i['nargs'] == 0:
+                argp.add_argument(*option_strings, action='store_true')
+            else:
+                argp.add_argument(
+                    *option_strings,
+                    nargs=i['nargs'],
+                    type=None if i['file'] else int,
+                )
+        return argp
+
     def format_help(self):
         """
         Like parent method but abbreviate common options in usage text
@@ -143,6 +207,9 @@ class OmicsArgParser(argparse.ArgumentParser):
 
         Note: There is some redundancy between the arguments and the project.
         """
+        if self.capture:
+            raise ParserCaptured(self)
+
         if self.auto_complete:
             try:
                 self.bash_complete(args)
@@ -154,7 +221,7 @@ class OmicsArgParser(argparse.ArgumentParser):
         args, argv = super().parse_known_args(args, namespace)
 
         if args.version:
-            print(__version__)
+            print(get_version())
             self.exit()
 
         if 'OMICS_DEBUG' in environ:
@@ -186,7 +253,8 @@ class OmicsArgParser(argparse.ArgumentParser):
                 try:
                     args.threads = project['threads']
                 except (TypeError, AttributeError, KeyError):
-                    if 'PBS_ENVIRONMENT' in environ:
+                    if 'PBS_ENVIRONMENT' in environ \
+                            or 'SLURM_JOB_ID' in environ:
                         args.threads = get_num_cpus()
                     else:
                         args.threads = DEFAULT_THREADS
@@ -229,14 +297,20 @@ class OmicsArgParser(argparse.ArgumentParser):
         cur_type = None
         cur_option = None
         found_subcmd = False
+        subcmd_pos = None  # position of sub command in args
         num_opt_args = 0  # number of options args remaining
         pos_arg_count = 0  # keeps count of pos args for sub commands
-        for arg in args[:index + 1]:
+        for pos, arg in enumerate(args[:index + 1]):
             if 'OMICS_AUTO_COMPLETE_DEBUG' in environ:
                 print('arg: "{}", cur_option: {}, nargs={}, got subcmd={}'
                       ''.format(arg, cur_option, num_opt_args, found_subcmd),
                       file=sys.stderr)
 
+            if found_subcmd and self.is_main_omics_parser:
+                # remaining args are for the sub command's parser
+                cur_type = 'subcmd_arg'
+                continue
+
             if num_opt_args > 0:
                 num_opt_args -= 1
                 cur_type = 'opt_arg'
@@ -262,6 +336,7 @@ class OmicsArgParser(argparse.ArgumentParser):
                 if self.is_main_omics_parser:
                     # assumed non-empty args to be the subcommand
                     found_subcmd = True
+                    subcmd_pos = pos
                     cur_option = None
                     cur_type = 'subcmd'
                 else:
@@ -280,9 +355,15 @@ class OmicsArgParser(argparse.ArgumentParser):
         allowed = []
         if found_subcmd and cur_type != 'subcmd':
             # cursor is after the subcmd
-            main_argp = get_main_arg_parser(just_parse=True)
-            sub_args = main_argp.parse_args()
-            launch_cmd_as_sub_module(sub_args, main_argp)
+            info = get_command_info(args[subcmd_pos])
+            if info is not None and info['options'] is not None:
+                # complete from registry, without importing the command
+                sub_argp = OmicsArgParser.from_registry(info['options'])
+                sub_argp.bash_complete(args[subcmd_pos + 1:])
+            else:
+                main_argp = get_main_arg_parser(just_parse=True)
+                sub_args = main_argp.parse_args()
+                launch_cmd_as_sub_module(sub_args, main_argp)
         elif cur_type in [None, 'subcmd']:
             allowed = get_available_commands()
         elif cur_type == 'opt':
@@ -306,15 +387,19 @@ class OmicsArgParser(argparse.ArgumentParser):
         sys.exit()
 
 
+@lru_cache(maxsize=None)
 def get_num_cpus():
     """
     Get the number of available CPUs
 
     :return type: int
 
-    If run in the context of a PBS job, the number of requested CPUs is used.
-    On a non-PBS system, i.e. some shared machine, 1/2 the available CPUs are
-    taken.
+    If run in the context of a PBS or Slurm job, the number of requested CPUs
+    is used.  Otherwise, if the process is limited by a cgroup CPU quota, e.g.
+    inside a container, then the quota is used.  On a non-PBS system without
+    quota, i.e. some shared machine, 1/2 the available CPUs are taken.
+
+    The result is memoized, the detection runs at most once per process.
     """
     if 'PBS_ENVIRONMENT' in environ:
         try:
@@ -323,23 +408,141 @@ def get_num_cpus():
             print('omics [WARNING]: Failed to read PBS_NP variable: {}: {}'
                   ''.format(e.__class__.__name__, e), file=sys.stderr)
             num_cpus = 1
-    else:
-        # `lscpu -p=cpu` prints list of cpu ids, starting with 0, so take last
-        # line, divide by 2 (sharing the system) add 1 is the number of CPUs
-        # used
+    elif 'SLURM_JOB_ID' in environ:
         try:
-            p = subprocess.run(['lscpu', '-p=cpu'], stdout=subprocess.PIPE)
-            p.check_returncode()
-            num_cpus = p.stdout.decode().splitlines()[-1].strip()
-            num_cpus = int(int(num_cpus) / 2) + 1
+            num_cpus = int(environ.get('SLURM_CPUS_PER_TASK',
+                                       environ.get('SLURM_CPUS_ON_NODE')))
         except Exception as e:
-            print('omics [WARNING]: Failed to obtain number of CPUs: {}: {}'
-                  ''.format(e.__class__.__name__, e), file=sys.stdout)
+            print('omics [WARNING]: Failed to read SLURM_CPUS_PER_TASK or '
+                  'SLURM_CPUS_ON_NODE variable: {}: {}'
+                  ''.format(e.__class__.__name__, e), file=sys.stderr)
             num_cpus = 1
+    else:
+        try:
+            available = len(os.sched_getaffinity(0))
+        except AttributeError:
+            # no sched_getaffinity() on this platform
+            available = os.cpu_count() or 1
+
+        try:
+            quota = get_cgroup_cpu_quota()
+        except Exception as e:
+            print('omics [WARNING]: Failed to read cgroup CPU quota: {}: {}'
+                  ''.format(e.__class__.__name__, e), file=sys.stderr)
+            quota = None
+
+        if quota is None:
+            # sharing the system: take half, rounding up
+            num_cpus = int((available - 1) / 2) + 1
+        else:
+            # quota is enforced by the scheduler / container runtime
+            num_cpus = max(1, min(available, quota))
 
     return num_cpus
 
 
+def get_cgroup_cpu_quota(cgroup_root=CGROUP_ROOT):
+    """
+    Get the CPU limit imposed on this process via cgroups
+
+    :param str cgroup_root: Mount point of the cgroup filesystem
+    :return: The number of CPUs (rounded up) or None if there is no quota.
+
+    Both the unified (v2) and legacy (v1) cgroup hierarchies are supported.  If
+    the process' own cgroup directory is not visible, e.g. inside a container,
+    then the root of the hierarchy is checked.
+    """
+    root = Path(cgroup_root)
+    v2_path = None
+    v1_path = None
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                _, controllers, path = line.strip().split(':', maxsplit=2)
+                if controllers == '':
+                    v2_path = path.lstrip('/')
+                elif 'cpu' in controllers.split(','):
+                    v1_path = (controllers, path.lstrip('/'))
+    except FileNotFoundError:
+        return None
+
+    if v2_path is not None:
+        for i in [root / v2_path, root]:
+            try:
+                quota, period = (i / 'cpu.max').read_text().split()
+            except FileNotFoundError:
+                continue
+            if quota == 'max':
+                return None
+            return -(-int(quota) // int(period))
+
+    if v1_path is not None:
+        controllers, path = v1_path
+        for i in [root / controllers / path, root / controllers,
+                  root / 'cpu' / path, root / 'cpu']:
+            try:
+                quota = int((i / 'cpu.cfs_quota_us').read_text())
+                period = int((i / 'cpu.cfs_period_us').read_text())
+            except FileNotFoundError:
+                continue
+            if quota <= 0:
+                # -1 means no limit
+                return None
+            return -(-quota // period)
+
+    return None
+
+
+class LazyModule(ModuleType):
+    """
+    Stand-in for a module that is imported on first attribute access
+
+    The import is done by the regular import system while holding a lock, so
+    that threads touching the module for the first time at once all get the
+    fully initialized module.  Attribute access is then forwarded to it.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, name):
+        super().__init__(name)
+        self._module = None
+
+    def __getattr__(self, attr):
+        # only called for attributes not found on the stand-in itself
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = import_module(self.__name__)
+                module = self._module
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """
+    Import a module lazily
+
+    :param str name: Absolute name of a top-level module or package
+    :return: The module object, or a LazyModule stand-in if the module was not
+             imported yet
+
+    The module is only executed when one of its attributes is accessed for
+    the first time.  Use this for heavy dependencies, e.g. numpy, pandas,
+    matplotlib, or django, so that they are only loaded by code paths that
+    actually use them.  This is safe to do from several threads at once.  A
+    missing module still raises ImportError right away.
+    """
+    try:
+        return sys.modules[name]
+    except KeyError:
+        pass
+
+    from importlib.util import find_spec
+    if find_spec(name) is None:
+        raise ImportError('No module named {!r}'.format(name), name=name)
+    return LazyModule(name)
+
+
 def get_argparser(*args, **kwargs):
     """
     Provide a canonical omics argparse argument parser
@@ -367,13 +570,23 @@ def process_command_line(command, options, script_dir=Path()):
 def get_project(path=None):
     """
     Retrieve the current project
+
+    The project is also exported to the environment so that child processes,
+    e.g. other omics commands, can skip most of the project discovery.
+
+    :param path: Directory to search the project from, by default the one
+                 given by the OMICS_PROJECT_HOME environment variable, e.g.
+                 for commands run outside of the project, or else the current
+                 directory.
     """
     if path is None:
-        path = Path.cwd()
+        path = Path(environ.get(PROJECT_HOME_ENV_VAR) or Path.cwd())
     else:
         # allow str input
         path = Path(path)
-    return OmicsProject.from_directory(path)
+    project = OmicsProject.from_directory(path)
+    project.export()
+    return project
 
 
 def get_main_arg_parser(*args, **kwargs):
@@ -419,6 +632,17 @@ def launch_cmd_as_sub_module(args, argp=None):
     """
     import_err = None
     module_name = args.command[0].replace('-', '_')
+    if COMMANDS is not None:
+        info = get_command_info(args.command[0])
+        if info is None or info['module'] is None:
+            # known to be no module, skip trying the import
+            import_err = ImportError('No omics module implements command {}'
+                                     ''.format(args.command[0]))
+            if args.dry_run or args.verbosity > 1:
+                print('{}: {}'.format(import_err.__class__.__name__,
+                                      import_err))
+            return import_err
+
     try:
         cmd_module = import_module('.' + module_name,
                                    package=__package__)
@@ -431,6 +655,7 @@ def launch_cmd_as_sub_module(args, argp=None):
             try:
                 cmd_module.main(args.command[1:])
             except (AttributeError, TypeError) as e:
+                import inspect
                 # May happen when there is no function main() or
                 # main() does not take a positional arg
                 # so we need to distinguish the cases:
@@ -477,11 +702,38 @@ class OmicsProject(dict):
     default = {
         'project_home': Path.cwd(),  # internal use, not found in conf file
         'name': None,
-        'threads': get_num_cpus(),
         'verbosity': DEFAULT_VERBOSITY,
     }
     """ Default settings """
 
+    config_file = None
+    """ Path to configuration file, None if default settings are used """
+
+    config_mtime = None
+    """ Modification time (ns) of configuration file when it was read """
+
+    search_dir = None
+    """ Directory from which the project was searched for """
+
+    lazy_default = {
+        'threads': (int, get_num_cpus),
+    }
+    """
+    Default settings that are expensive to get, given as (type, function)
+    pairs, the values are only computed when first accessed
+    """
+
+    def __missing__(self, key):
+        """
+        Fill in a lazy default value on first access
+        """
+        try:
+            _, get_value = self.lazy_default[key]
+        except KeyError:
+            raise KeyError(key) from None
+        self[key] = get_value()
+        return self[key]
+
     @classmethod
     def from_directory(cls, path):
         """
@@ -493,16 +745,28 @@ class OmicsProject(dict):
         :raise NoOmicsContextFound: If no OMICS_DIR directory with a valid
                                     configuration is found in the given or a
                                     parent directory.
+
+        If a parent process exported its project, see export(), and the search
+        reaches the directory the parent searched from, then the parent's
+        result is taken, unless the configuration file was modified since.
         """
         try:
             path = Path.resolve(path)
         except Exception as e:
             raise OmicsProjectNotFound from e
 
+        handle = cls._get_handle()
         omics_dir = None
-        user = path.owner()
+        user = None
         for i in [path] + list(path.parents):
+            if handle is not None and str(i) == handle['dir']:
+                proj = cls._from_handle(handle, path)
+                if proj is not None:
+                    return proj
+
             try:
+                if user is None:
+                    user = path.owner()
                 dir_owner = i.owner()
             except Exception as e:
                 # guard against odd things: e.g. uid not found on FLUX
@@ -521,15 +785,97 @@ class OmicsProject(dict):
             config_file = omics_dir / CONFIG_FILE
             if config_file.is_file():
                 try:
-                    return cls.from_file(config_file)
+                    proj = cls.from_file(config_file)
                 except Exception as e:
                     raise OmicsProjectNotFound from e
+                proj.search_dir = path
+                return proj
             else:
                 print('Warning: No config file found, using default '
                       'configuration.', file=sys.stderr)
 
         # use default settings as fallback
-        return cls.from_default(project_home=path)
+        proj = cls.from_default(project_home=path)
+        proj.search_dir = path
+        return proj
+
+    @classmethod
+    def _get_handle(cls):
+        """
+        Get project handle exported by a parent process
+
+        :return: Dict with the handle data or None
+        """
+        if not environ.get(PROJECT_ENV_VAR):
+            return None
+
+        import json
+        try:
+            return json.loads(environ[PROJECT_ENV_VAR])
+        except ValueError:
+            print('Warning: ignoring malformed {} environment variable'
+                  ''.format(PROJECT_ENV_VAR), file=sys.stderr)
+            return None
+
+    @classmethod
+    def _from_handle(cls, handle, path):
+        """
+        Get project from handle exported by a parent process
+
+        :param dict handle: The handle data
+        :param Path path: The directory the project is searched from
+
+        :return: The project or None if the handle is stale.
+        """
+        if handle['config'] is None:
+            proj = cls.from_default(project_home=path)
+        else:
+            config_file = Path(handle['config'])
+            try:
+                mtime = config_file.stat().st_mtime_ns
+            except OSError:
+                return None
+
+            if mtime == handle['mtime']:
+                data = dict(handle['project'])
+                data['project_home'] = Path(data['project_home'])
+                proj = cls.from_default(**data)
+                proj.config_file = config_file
+                proj.config_mtime = mtime
+            else:
+                try:
+                    proj = cls.from_file(config_file)
+                except Exception:
+                    return None
+
+        proj.search_dir = path
+        return proj
+
+    def export(self):
+        """
+        Export project handle to the environment
+
+        The handle holds the resolved configuration and is inherited by child
+        processes which then can skip most of the project discovery.
+        """
+        if self.search_dir is None:
+            return
+
+        import json
+        if self.config_file is None:
+            config_file = None
+        else:
+            config_file = str(self.config_file)
+
+        environ[PROJECT_ENV_VAR] = json.dumps({
+            'dir': str(self.search_dir),
+            'config': config_file,
+            'mtime': self.config_mtime,
+            'project': {
+                k: str(v) if isinstance(v, Path) else v
+                for k, v in self.items()
+            },
+        })
 
     @classmethod
     def from_default(cls, **kwargs):
@@ -550,18 +896,25 @@ class OmicsProject(dict):
         :param Path config_file: Configuration file
         :return: OmicsProject object
         """
+        from configparser import MissingSectionHeaderError
+
         with config_file.open() as f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
             config_str = f.read()
 
         try:
-            return cls._from_str(
+            proj = cls._from_str(
                 config_str,
                 project_home=config_file.parent.parent
             )
-        except configparser.MissingSectionHeaderError:
+        except MissingSectionHeaderError:
             # add project section
             config_str += '[{}]\n{}'.format(CONF_SECTION_PROJECT, config_str)
-            return cls._from_str(config_str)
+            proj = cls._from_str(config_str)
+
+        proj.config_file = config_file
+        proj.config_mtime = mtime
+        return proj
 
     @classmethod
     def _from_str(cls, config_str, **kwargs):
@@ -573,9 +926,11 @@ class OmicsProject(dict):
 
         :return: OmicsConfig object
         """
+        from configparser import ConfigParser
+
         proj = cls.from_default(**kwargs)
 
-        parser = configparser.ConfigParser(
+        parser = ConfigParser(
             inline_comment_prefixes=('#',),
         )
         parser.read_string(config_str)
@@ -606,7 +961,10 @@ class OmicsProject(dict):
                 # None means variable is unset, no type conversion
                 continue
 
-            type_ = type(self.default[key])
+            if key in self.lazy_default:
+                type_, _ = self.lazy_default[key]
+            else:
+                type_ = type(self.default[key])
             args = CONF_SECTION_PROJECT, key
 
             if not isinstance(self[key], type_):
@@ -623,6 +981,7 @@ def get_available_scripts():
     :return: List of paths for subcommand scripts.
     :raises: In case of errors
     """
+    import subprocess
     p = subprocess.run(['which', 'omics'], stdout=subprocess.PIPE)
     p.check_returncode()
     path = Path(p.stdout.decode().strip()).parent
@@ -643,6 +1002,9 @@ def get_modules_with_main():
     """
     # This function is part of auto-completion and should not print anything
     # to stdout.
+    import inspect
+    from pkgutil import iter_modules
+
     mods = []
     for _, name, ispkg in iter_modules(path=__path__):
         # print(name, ispkg, sep='\n')
@@ -659,15 +1021,34 @@ def get_modules_with_main():
     return mods
 
 
+def get_command_info(command):
+    """
+    Look up a sub-command in the command registry
+
+    :param str command: Name of the command
+    :return: Dict with the command's module, script, and options or None if
+             the command is unknown or there is no registry.
+    """
+    if COMMANDS is None:
+        return None
+    return COMMANDS.get(command)
+
+
 def get_available_commands():
     """
     Get list of available sub-commands
 
     :return list: List of str names of sub-commands.
                   List is empty in case of errors.
+
+    The command registry is used if available, otherwise the commands get
+    discovered which may be slow.
     """
     # This function is part of auto-completion and should not print anything
     # to stdout.
+    if COMMANDS is not None:
+        return sorted(COMMANDS)
+
     ret = set()
     try:
         commands = get_available_scripts()
@@ -0,0 +1,208 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Registry of the omics sub-commands
+
+The registry maps each command name to the omics.* module and/or the omics-*
+script implementing it together with the command's options.  This is all the
+omics command needs to dispatch or auto-complete a command without importing
+any of the (possibly heavy) command modules.
+
+COMMANDS is hard-coded at install time, see the install-py target in
+lib/Makefile.  In a development environment it is None and the commands are
+discovered at run time.
+"""
+
+# Set to registry dict when installing, see main_write_registry()
+COMMANDS = None
+
+# common options of all scripts using liba.sh, see GETOPT_* in liba.sh
+LIBA_SHORT_OPTIONS = 'hv'
+LIBA_LONG_OPTIONS = 'help,no-color,working-dir:,verbosity:'
+
+
+def get_parser_options(parser):
+    """
+    Get the option metadata from an argument parser
+
+    :param parser: An argparse.ArgumentParser object
+    :return list: List of dicts with the option strings, the number of
+                  arguments, and if arguments are files.
+    """
+    from argparse import FileType
+
+    options = []
+    for i in parser._actions:
+        if not i.option_strings:
+            # positional arg
+            continue
+        if i.nargs is None or isinstance(i.nargs, str):
+            # None, ?, *, +, ... all complete like a single argument
+            nargs = 1
+        else:
+            nargs = i.nargs
+        options.append({
+            'options': list(i.option_strings),
+            'nargs': nargs,
+            'file': i.type in [None, str] or isinstance(i.type, FileType),
+        })
+    return options
+
+
+def get_module_options(module):
+    """
+    Get the options of a command module
+
+    The module's main() function is run in parser capturing mode, i.e. its
+    OmicsArgParser raises ParserCaptured when asked to parse the command line.
+
+    :return: List of options or None if the parser could not be captured.
+    """
+    import inspect
+    from . import OmicsArgParser, ParserCaptured
+
+    OmicsArgParser.capture = True
+    try:
+        if inspect.signature(module.main).parameters:
+            module.main([])
+        else:
+            module.main()
+    except ParserCaptured as e:
+        return get_parser_options(e.parser)
+    except BaseException:
+        # includes SystemExit from plain argparse parsers
+        return None
+    finally:
+        OmicsArgParser.capture = False
+    return None
+
+
+def get_script_options(path):
+    """
+    Get the options of a command script
+
+    Options are obtained from the SHORT_OPTIONS and LONG_OPTIONS getopt
+    specifications of scripts using liba.sh.
+
+    :param Path path: Path to script
+    :return: List of options or None if this is not a liba.sh script.
+    """
+    import re
+
+    text = path.read_text()
+    if 'liba.sh' not in text:
+        return None
+
+    def get_spec(var):
+        m = re.search(r'^' + var + r'=["\']?([^"\'\s]*)', text, re.MULTILINE)
+        return m.group(1) if m else ''
+
+    options = []
+    short_spec = get_spec('SHORT_OPTIONS').replace(',', '')
+    short_spec += LIBA_SHORT_OPTIONS
+    for i, char in enumerate(short_spec):
+        if char != ':':
+            nargs = 1 if short_spec[i + 1:i + 2] == ':' else 0
+            options.append({'options': ['-' + char], 'nargs': nargs,
+                            'file': True})
+
+    long_spec = get_spec('LONG_OPTIONS') + ',' + LIBA_LONG_OPTIONS
+    for i in long_spec.split(','):
+        if i:
+            options.append({'options': ['--' + i.rstrip(':')],
+                            'nargs': 1 if i.endswith(':') else 0,
+                            'file': True})
+    return options
+
+
+def make_registry(script_dir):
+    """
+    Discover all sub-commands
+
+    :param Path script_dir: Directory containing the omics-* scripts
+    :return dict: The command registry
+    """
+    from importlib import import_module
+    import inspect
+    from pkgutil import iter_modules
+    from . import SCRIPT_PREFIX, __path__ as omics_path
+
+    commands = {}
+    for _, name, _ in iter_modules(path=omics_path):
+        if name.startswith('_'):
+            continue
+        try:
+            module = import_module('.' + name, package=__package__)
+        except Exception:
+            continue
+        if hasattr(module, 'main') and inspect.isfunction(module.main):
+            commands[name.replace('_', '-')] = {
+                'module': module.__name__,
+                'script': None,
+                'options': get_module_options(module),
+            }
+
+    for i in sorted(script_dir.glob(SCRIPT_PREFIX + '*')):
+        if i.name.endswith('~'):
+            continue
+        cmd = i.name[len(SCRIPT_PREFIX):]
+        info = commands.setdefault(
+            cmd,
+            {'module': None, 'script': None, 'options': None}
+        )
+        info['script'] = i.name
+        if info['options'] is None:
+            info['options'] = get_script_options(i)
+
+    return commands
+
+
+def write_registry(path, script_dir):
+    """
+    Hard-code the command registry into given copy of this module
+    """
+    from pprint import pformat
+    import re
+
+    registry = 'COMMANDS = ' + pformat(make_registry(script_dir))
+    text = path.read_text()
+    text, count = re.subn(r'^COMMANDS = None$', lambda _: registry, text,
+                          flags=re.MULTILINE)
+    if count != 1:
+        raise RuntimeError('Failed to find COMMANDS placeholder in {}'
+                           ''.format(path))
+    path.write_text(text)
+
+
+def main_write_registry():
+    import argparse
+    from pathlib import Path
+
+    argp = argparse.ArgumentParser(
+        description='Hard-code the command registry into the given copy of '
+                    'the omics._commands module.',
+    )
+    argp.add_argument('module_file', help='Path to _commands.py to modify')
+    argp.add_argument(
+        '--script-dir',
+        default='.',
+        help='Directory containing the omics-* scripts, default is the '
+             'current directory',
+    )
+    args = argp.parse_args()
+    write_registry(Path(args.module_file), Path(args.script_dir))
@@ -15,13 +15,15 @@
 # You should have received a copy of the GNU General Public License along
 # with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
 
+from functools import lru_cache
 import os.path
-import subprocess
 
-# Set to real version when distribute outside of git vcs
+# Set to real version when distribute outside of git vcs, this is done at
+# build / install time by the hard-code-version and install-py make targets
 VERSION = None
 
 
+@lru_cache(maxsize=None)
 def get_version(version=VERSION, raise_on_error=False):
     """
     Get the version string
@@ -29,10 +31,15 @@ def get_version(version=VERSION, raise_on_error=False):
     Get the hard-coded version if possible, then fall back to ask git.  If that
     fails raise an execption or return an 'unknown' depending on the
     raise_on_error flag.
+
+    With python 3.7 or later this is not called at import time, the
+    package-level __version__ attribute is resolved on first access, so git
+    only gets asked on demand, e.g. by --version, and at most once.
     """
     if version:
         return version
 
+    import subprocess
     try:
         p = subprocess.run(
             ['git', 'describe'],
@@ -0,0 +1,173 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Checksums computed on data while it is being read or written
+
+Files are hashed as a side effect of reading them for some other purpose,
+so checking them costs no extra pass over the data.  hashlib releases the
+GIL while hashing larger pieces of data, so this works well with threads.
+"""
+
+import hashlib
+import io
+from pathlib import Path
+
+ALGORITHMS = ['md5', 'sha256']
+
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# length of hex digests, to tell the algorithm of a checksum file
+HEX_LENGTH = {32: 'md5', 64: 'sha256'}
+
+
+class ChecksumMismatch(RuntimeError):
+    pass
+
+
+def read_checksum_file(path):
+    """
+    Read a checksum file as written by md5sum or sha256sum
+
+    :param Path path: The checksum file
+    :return: Dict mapping the resolved path of each listed file to a tuple of
+             algorithm and hex digest.  Names are relative to the checksum
+             file's directory.
+    """
+    checksums = {}
+    with path.open() as f:
+        for num, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                digest, name = line.split(None, 1)
+                algorithm = HEX_LENGTH[len(digest)]
+            except (KeyError, ValueError):
+                raise RuntimeError('Bad line {} in checksum file {}: {}'
+                                   ''.format(num, path, line))
+            # binary mode marker
+            name = name.lstrip('*')
+            checksums[(path.parent / name).resolve()] = \
+                (algorithm, digest.lower())
+    return checksums
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Raw reader passing all data read through a hash
+
+    :param file: Raw or buffered binary file object
+    :param hash: A hashlib hash object
+    """
+    def __init__(self, file, hash):
+        super().__init__()
+        self._file = file
+        self.hash = hash
+
+    @property
+    def name(self):
+        return getattr(self._file, 'name', '')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = self._file.readinto(b)
+        if size:
+            with memoryview(b) as view:
+                self.hash.update(view[:size])
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+class HashingWriter():
+    """
+    Minimal file-like object passing data through a hash before writing it
+
+    :param file: Object with a write() method
+    :param hash: A hashlib hash object
+    """
+    def __init__(self, file, hash):
+        self._file = file
+        self.hash = hash
+
+    def write(self, data):
+        self.hash.update(data)
+        return self._file.write(data)
+
+
+class Verifier():
+    """
+    Computes checksums of input and output data and checks the input
+
+    :param str algorithm: One of ALGORITHMS
+    :param dict expected: Optional expected checksums as returned by
+                          read_checksum_file().  Checksums of other
+                          algorithms are ignored.
+    """
+    def __init__(self, algorithm, expected=None):
+        self.algorithm = algorithm
+        self.expected = {
+            path: digest
+            for path, (algo, digest) in (expected or {}).items()
+            if algo == algorithm
+        }
+
+    def new(self):
+        """
+        Get a new hash object
+        """
+        return hashlib.new(self.algorithm)
+
+    def open(self, path):
+        """
+        Open a file for reading while hashing its contents
+
+        :return: A buffered binary file object with peek() support whose
+                 raw file's hash attribute is the hash object
+        """
+        raw = HashingReader(open(str(path), 'rb', buffering=0), self.new())
+        return io.BufferedReader(raw, buffer_size=BUFFER_SIZE)
+
+    def hash_file(self, path):
+        """
+        Hash a whole file
+
+        :return: The hash object
+        """
+        with self.open(path) as f:
+            while f.read(BUFFER_SIZE):
+                pass
+            return f.raw.hash
+
+    def check(self, path, digest):
+        """
+        Compare digest of a file to the expected value, if there is one
+
+        :raise ChecksumMismatch: If the digest differs
+        """
+        expected = self.expected.get(Path(path).resolve())
+        if expected is not None and expected != digest:
+            raise ChecksumMismatch(
+                '{} checksum mismatch for {}: expected {} but got {}'
+                ''.format(self.algorithm, path, expected, digest)
+            )
@@ -3,4 +3,4 @@ This is the omics database module
 
 This is 'stand-alone' Django ORM and db backend for the geo-omics-scripts.
 """
-from .manage import main, setup
+from .manage import connect, init_db, main, setup
@@ -15,20 +15,28 @@
 # You should have received a copy of the GNU General Public License along
 # with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
 from io import StringIO
 from pathlib import Path
+import sqlite3
 import sys
 
-import django
-from django.conf import settings
-from django.core.management import call_command, execute_from_command_line
-
 from omics import OmicsArgParser, OMICS_DIR
 
+# django is heavy and imported only where needed, the schema can be checked
+# and read-only queries can be run with plain sqlite3
 
 DEFAULT_DB_FILE = 'omics.db'
 PROG_NAME = 'omics db'  # for argparse and django management cmd benefit
 
+# table to keep track of the schema migrations that were applied
+FINGERPRINT_TABLE = 'omics_db_schema'
+
+# file systems on which sqlite's WAL mode does not work, it needs shared
+# memory that is only shared between processes on the same host
+NETWORK_FS_TYPES = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'lustre',
+                    'gpfs', 'beegfs', 'ceph', 'fuse.sshfs', 'afs')
+
 db_settings = {
     'INSTALLED_APPS': ['omics.db.apps.OmicsDBConfig'],
     'DATABASES': {
@@ -49,22 +57,165 @@ argp.add_argument(
          'and otherwise the default {} in the current directory is used.'
          ''.format(OMICS_DIR, DEFAULT_DB_FILE),
 )
+argp.add_argument(
+    '--query',
+    metavar='SQL',
+    default=None,
+    help='Run given read-only SQL query directly via sqlite3 and print the '
+         'resulting rows tab-separated.  This bypasses Django and any other '
+         'arguments are ignored.',
+)
 
 
-def setup(db_path):
+def get_db_file_name(db_path):
     """
-    Setup and configure django framework
-
-    This is public API exposed at the package level to be used by other code
-    outside of omics.db but do not call this from within omics.db since
-    django.setup() is called here only for the benefit of external scripts and
-    per Django documentation should not be call explicitly in code using the
-    framework, i.e. everything under omics.db.
+    Get database file name from file or directory path
     """
+    db_path = Path(db_path)
     if db_path.is_dir():
-        db_file_name = str(db_path / DEFAULT_DB_FILE)
+        return str(db_path / DEFAULT_DB_FILE)
     else:
-        db_file_name = str(db_path)
+        return str(db_path)
+
+
+def connect(db_file_name, readonly=True):
+    """
+    Open the database with sqlite3, bypassing Django
+
+    This is the fast path for code that only needs to read some data and does
+    not want to pay for Django's setup.  Rows can be accessed by column name.
+
+    :param db_file_name: Path to the database file
+    :param bool readonly: If True, open database in read-only mode.
+    :return: sqlite3.Connection object
+    """
+    if readonly:
+        uri = 'file:{}?mode=ro'.format(Path(db_file_name).resolve())
+        conn = sqlite3.connect(uri, uri=True)
+    else:
+        conn = sqlite3.connect(str(db_file_name))
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def get_schema_fingerprint():
+    """
+    Get fingerprint of the current database schema
+
+    The fingerprint is a hash over the models and migrations of the omics.db
+    app.  If it changed, then the database needs to be migrated.
+    """
+    app_dir = Path(__file__).parent
+    files = [app_dir / 'models.py']
+    files += sorted((app_dir / 'migrations').glob('*.py'))
+    fp = hashlib.sha1()
+    for i in files:
+        if i.is_file():
+            fp.update(i.name.encode())
+            fp.update(i.read_bytes())
+    return fp.hexdigest()
+
+
+def get_stored_fingerprint(conn):
+    """
+    Get the schema fingerprint stored in the database
+
+    :param conn: sqlite3 connection
+    :return: The fingerprint or None if the database was never migrated.
+    """
+    try:
+        row = conn.execute(
+            'SELECT fingerprint FROM {}'.format(FINGERPRINT_TABLE)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # no such table
+        return None
+    return None if row is None else row[0]
+
+
+def store_fingerprint(conn, fingerprint):
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS {} (fingerprint TEXT)'
+                     ''.format(FINGERPRINT_TABLE))
+        conn.execute('DELETE FROM {}'.format(FINGERPRINT_TABLE))
+        conn.execute('INSERT INTO {} VALUES (?)'.format(FINGERPRINT_TABLE),
+                     (fingerprint,))
+
+
+def get_fs_type(path):
+    """
+    Get type of the file system a path is on
+
+    :return: The type as listed in /proc/self/mounts or None if it can not
+             be found out.
+    """
+    path = Path(path).resolve()
+    fs_type = None
+    longest = -1
+    try:
+        with open('/proc/self/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # spaces etc. are octal-escaped in mount points
+                mount_point = fields[1].encode().decode('unicode_escape')
+                if path == Path(mount_point) \
+                        or Path(mount_point) in path.parents:
+                    if len(mount_point) > longest:
+                        longest = len(mount_point)
+                        fs_type = fields[2]
+    except OSError:
+        return None
+    return fs_type
+
+
+def init_db(db_path, wal=False):
+    """
+    Create database or bring its schema up-to-date
+
+    Django is only set up to run the migrations if the schema fingerprint
+    stored in the database does not match the current one.
+
+    :param db_path: Path to database file or directory containing it.
+    :param bool wal: Put the database into WAL mode so that readers don't
+                     block writers.  This is skipped with a warning if the
+                     database is on a network file system, where WAL does
+                     not work.
+    :return bool: True if migrations were run.
+    """
+    db_file_name = get_db_file_name(db_path)
+    fingerprint = get_schema_fingerprint()
+    if wal:
+        fs_type = get_fs_type(Path(db_file_name).parent)
+        if fs_type in NETWORK_FS_TYPES:
+            print('Warning: database is on a {} network file system, not '
+                  'using WAL journal mode: {}'.format(fs_type, db_file_name),
+                  file=sys.stderr)
+            wal = False
+    conn = connect(db_file_name, readonly=False)
+    try:
+        if wal:
+            # journal mode is persistent, stored in the database file
+            conn.execute('PRAGMA journal_mode=WAL')
+        if get_stored_fingerprint(conn) == fingerprint:
+            return False
+
+        if migrate(db_file_name):
+            store_fingerprint(conn, fingerprint)
+        return True
+    finally:
+        conn.close()
+
+
+def migrate(db_file_name):
+    """
+    Set up Django and run the migrations
+
+    :return bool: True on success, False if the migration failed.
+    """
+    import django
+    from django.core.management import call_command
 
     configure(db_file_name)
     django.setup()
@@ -76,6 +227,31 @@ def setup(db_path):
               'migrate command was:'.format(e.__class__.__name__, e),
               file=sys.stderr)
         print(out.getvalue(), file=sys.stderr)
+        return False
+    return True
+
+
+def setup(db_path):
+    """
+    Setup and configure django framework
+
+    This is public API exposed at the package level to be used by other code
+    outside of omics.db but do not call this from within omics.db since
+    django.setup() is called here only for the benefit of external scripts and
+    per Django documentation should not be call explicitly in code using the
+    framework, i.e. everything under omics.db.
+
+    Code that only needs to create or update the database should call
+    init_db() instead, which sets up Django only if migrations are due.
+    """
+    import django
+    from django.conf import settings
+
+    if not init_db(db_path):
+        # migrations were skipped, so django still needs to be set up
+        if not settings.configured:
+            configure(get_db_file_name(db_path))
+        django.setup()
 
 
 def configure(db_file_name=DEFAULT_DB_FILE):
@@ -84,6 +260,8 @@ def configure(db_file_name=DEFAULT_DB_FILE):
 
     This needs to be called once whenever we want to access the database
     """
+    from django.conf import settings
+
     db_settings['DATABASES']['default']['NAME'] = str(db_file_name)
     settings.configure(**db_settings)
 
@@ -112,7 +290,18 @@ def main(argv=None):
         print('No database present, file not found: {}\nTo properly initiate '
               'a project run "omics init" or run "omics db migrate" '
               'to just set up a database in the current directory.'
-              ''.format(args.db), file=sys.stderr)
+              ''.format(db_path), file=sys.stderr)
+
+    if args.query is not None:
+        conn = connect(db_path)
+        try:
+            for row in conn.execute(args.query):
+                print(*row, sep='\t')
+        finally:
+            conn.close()
+        return
+
+    from django.core.management import execute_from_command_line
 
     configure(db_path)
     execute_from_command_line([PROG_NAME] + rest_argv)
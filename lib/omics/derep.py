@@ -17,178 +17,865 @@
 
 """
 Find and remove replicated reads from fastq files.
+
+Input files may be gzip-compressed.  With several threads, uncompressed
+input is indexed by a pool of processes, each taking a range of one of the
+files, and duplicates are resolved in parallel per partition of the hashes.
 """
 
 import argparse
 from binascii import hexlify
-from itertools import zip_longest
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
+from itertools import chain, islice
 from pathlib import Path
+import re
+from tempfile import TemporaryDirectory
+
+from . import get_argparser, lazy_import, DEFAULT_VERBOSITY
+from .fingerprints import FingerprintIndex, get_project_index
+from .gzio import (add_compress_arguments, compressed_path, is_gzip,
+                   open_output, open_reads, uncompressed_path)
+from .optical import find_optical
+from .quality import line_bounds, quality_sums
+from .seqio import (FileFormat, RecordReader, detect_format,
+                    find_record_start, read_paired)
+from .utils import get_read_coordinates
 
-from . import get_argparser, DEFAULT_VERBOSITY
+numpy = lazy_import('numpy')
 
 ST_HEAD = 1
 ST_SEQ = 2
 ST_PLUS = 3
 ST_SCORE = 4
 
+# approximate memory in bytes per read pair used to index and sort reads:
+# hash and score, sort order, and temporary copies
+INDEX_BYTES_PER_READ = 48
+
+# record of a sorted run of the index spilled to disk
+RUN_DTYPE = [('key', '<u8'), ('score', '<f8'), ('record', '<i8')]
+RUN_RECORD_SIZE = 24
+
+# size of the file ranges indexed by one process
+RANGE_SIZE = 64 * 1024 * 1024
+
+# lines per record of interleaved reads
+PAIR_LINES = 8
+
+# odd multiplier to combine the hashes of forward and reverse read
+PAIR_MULTIPLIER = 0x9e3779b97f4a7c15
+HASH_MASK = 0xffffffffffffffff
 
-def hash_read_pair(fwd_head, fwd_seq, rev_head='', rev_seq=''):
+size_pat = re.compile(r'(?P<num>\d+(\.\d*)?)\s*(?P<unit>[kmgt]?)b?', re.I)
+
+
+def hash_read(head, seq):
+    """
+    Stable 64-bit hash of a read
+
+    Uses a BLAKE2 hash of flowcell + lane + sequence.  Unlike the built-in
+    hash() this is the same in every process.
+
+    :return: Unsigned int
+    """
+    data = b':'.join(head.strip().split(b':')[:4] + [seq.strip()])
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), 'little')
+
+
+def combine_hashes(fwd_hash, rev_hash):
+    """
+    Combine hashes of forward and reverse read into hash of the pair
+
+    Works on ints and on numpy uint64 arrays alike.
+    """
+    if isinstance(fwd_hash, int):
+        return (fwd_hash * PAIR_MULTIPLIER & HASH_MASK) ^ rev_hash
+    return fwd_hash * numpy.uint64(PAIR_MULTIPLIER) ^ rev_hash
+
+
+def hash_read_pair(fwd_head, fwd_seq, rev_head=None, rev_seq=None):
     """
     Hash function for reads, reverse read may be omitted
 
-    Uses built-in hash of flowcell + lane + sequence
+    :return: Stable, unsigned 64-bit hash of flowcell + lane + sequence of
+             both reads, or of the forward read alone
+    """
+    if rev_head is None:
+        return hash_read(fwd_head, fwd_seq)
+    return combine_hashes(hash_read(fwd_head, fwd_seq),
+                          hash_read(rev_head, rev_seq))
+
+
+def read_batches(fwd_in, rev_in=None, *, interleaved=False, check=False):
+    """
+    Read batches of read pairs or of single reads
+
+    :param fwd_in: File handle to forward, single or interleaved reads
+    :param rev_in: File handle to reverse reads, None for single or
+                   interleaved reads
+    :param bool interleaved: Take each two consecutive reads of fwd_in as a
+                             read pair, the batches then have records of
+                             eight lines.
+    :param bool check: Check the fastq format of the reads
+    :return: Iterator over tuples of forward and reverse batch, the reverse
+             batch is None without rev_in
+    """
+    for file in [fwd_in, rev_in]:
+        if file is not None and detect_format(file) is FileFormat.fasta:
+            raise NotImplementedError('Fasta support not implemented')
+
+    if rev_in is None:
+        batches = RecordReader(fwd_in, fmt=FileFormat.fastq,
+                               interleaved=interleaved, check=check)
+        return ((i, None) for i in batches)
+    return read_paired(fwd_in, rev_in, fmt=FileFormat.fastq, check=check)
+
+
+def batch_hashes(fwd_batch, rev_batch=None):
+    """
+    Get the hashes of the read pairs, or reads, of a batch
+
+    :param fwd_batch: Batch of forward, single or interleaved reads
+    :param rev_batch: Batch of reverse reads or None
+    :return: List of int
+    """
+    if rev_batch is not None:
+        return [
+            hash_read_pair(fh, fs, rh, rs)
+            for (fh, fs, _, _), (rh, rs, _, _) in zip(
+                fwd_batch.iter_lines(copy=True),
+                rev_batch.iter_lines(copy=True))
+        ]
+    if fwd_batch.lines == PAIR_LINES:
+        return [
+            hash_read_pair(fh, fs, rh, rs)
+            for fh, fs, _, _, rh, rs, _, _ in fwd_batch.iter_lines(copy=True)
+        ]
+    return [
+        hash_read(head, seq)
+        for head, seq, _, _ in fwd_batch.iter_lines(copy=True)
+    ]
+
+
+def record_hash(fwd_batch, rev_batch, i):
+    """
+    Get the hash of the i-th read pair, or read, of a batch
+
+    See batch_hashes()
+    """
+    lines = [(fwd_batch, 0), (fwd_batch, 1)]
+    if rev_batch is not None:
+        lines += [(rev_batch, 0), (rev_batch, 1)]
+    elif fwd_batch.lines == PAIR_LINES:
+        lines += [(fwd_batch, 4), (fwd_batch, 5)]
+    return hash_read_pair(*(bytes(b.line(i, j)) for b, j in lines))
+
+
+def batch_coordinates(batch):
+    """
+    Get tile and x/y coordinates of the reads of a batch
+
+    For read pairs the coordinates are taken from the forward read's header.
+
+    :return: numpy int64 array with a row of tile, x, and y per read
+    """
+    return numpy.array(
+        [get_read_coordinates(i) for i in batch.spans(0, 1, copy=True)],
+        dtype=numpy.int64,
+    ).reshape(-1, 3)
+
+
+def batch_scores(fwd_batch, rev_batch=None):
     """
-    return b':'.join(
-        fwd_head.strip().split(b':')[:4] +
-        [fwd_seq.strip()] +
-        rev_head.strip().split(b':')[:4] +
-        [rev_seq.strip()]
-    ).__hash__()
+    Get the mean quality scores of the read pairs, or reads, of a batch
 
+    The mean is that of the concatenated quality lines with newlines.
 
-def read_groups(fwd, rev):
+    :return: numpy float64 array
     """
-    Iterate over reads
+    sums, lengths = quality_sums(fwd_batch)
+    if rev_batch is not None:
+        rev_sums, rev_lengths = quality_sums(rev_batch)
+    elif fwd_batch.lines == PAIR_LINES:
+        rev_sums, rev_lengths = quality_sums(fwd_batch, PAIR_LINES - 1)
+    else:
+        return sums / lengths
+    return (sums + rev_sums) / (lengths + rev_lengths)
 
-    :param fwd: File handle to forward reads
-    :param rev: File handle to reverse reads
 
-    This implements the grouper recipe on a zipped input.  The output
-    iterates over 4-tuples of 2-tuples, i.e. the forward, reverse pairs
-    of the four lines of a read:
+def memory_size(text):
+    """
+    Parse a memory size like 500M or 64G, as argparse type
+
+    :return: Number of bytes
+    """
+    m = size_pat.fullmatch(text.strip())
+    if m is None:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(text))
+    exponent = ' kmgt'.index(m.group('unit').lower() or ' ')
+    return int(float(m.group('num')) * 1024 ** exponent)
+
+
+def find_repeats(keys, scores):
+    """
+    Get positions of all but the best read pair of each group of equal hash
 
-      (@fwd_head, @rev_head), (fwd_seq, rev_seq), (+, +), (fwd_qual, rev_qual)
+    The best read pair is the one with the highest score, for equal scores
+    the first one.
+
+    :param keys: numpy array of hashes
+    :param scores: numpy array of mean quality scores
+    :return: Tuple of the sort order by hash and decreasing score, and a
+             boolean array marking the repeats in that order
+    """
+    # lexsort is stable, ties in score keep the earlier read pair first
+    order = numpy.lexsort((-scores, keys))
+    sorted_keys = keys[order]
+    # all but the first of each group of equal hashes are repeats
+    repeat = numpy.zeros(len(keys), dtype=bool)
+    repeat[1:] = sorted_keys[1:] == sorted_keys[:-1]
+    return order, repeat
+
+
+class SortedRuns():
     """
-    paired = zip_longest(fwd, rev)
-    args = [iter(paired)] * 4
-    return zip_longest(*args)
+    Duplicate index spilled to disk in sorted runs
 
+    Each run covers a consecutive range of record numbers.  Repeats within a
+    run are marked in the run's bitmap right away, only the best read pair
+    of each hash is written to the run file, sorted by hash.
 
-def find_duplicates(fwd_in, rev_in=None, *, check=False):
+    :param str directory: Where to make the temporary directory for the run
+                          files, by default TMPDIR or the system's default
+    """
+    def __init__(self, directory=None):
+        self._tmpdir = TemporaryDirectory(prefix='omics-derep-',
+                                          dir=directory)
+        self.paths = []
+        self.bitmaps = []
+        self.count = 0
+
+    def add(self, keys, scores):
+        """
+        Spill the index of the next range of read pairs
+
+        All but the last run must cover a multiple of 8 read pairs, so that
+        the bitmaps can be joined.
+        """
+        order, repeat = find_repeats(keys, scores)
+        refuse = numpy.zeros(len(keys), dtype=bool)
+        refuse[order[repeat]] = True
+        self.bitmaps.append(numpy.packbits(refuse, bitorder='little'))
+        del refuse
+
+        best = order[~repeat]
+        run = numpy.empty(len(best), dtype=RUN_DTYPE)
+        run['key'] = keys[best]
+        run['score'] = scores[best]
+        run['record'] = best + self.count
+        path = Path(self._tmpdir.name) / 'run{}'.format(len(self.paths))
+        run.tofile(str(path))
+        self.paths.append(path)
+        self.count += len(keys)
+
+    def build_filter(self, max_memory):
+        """
+        Merge the runs and get the bitmap of refused read pairs
+
+        The runs are read in blocks.  In each round, the read pairs with
+        hashes below the smallest hash not read yet from any run are
+        resolved, their groups are complete.
+        """
+        refuse = numpy.concatenate(self.bitmaps)
+        self.bitmaps = []
+        block_size = max(1024, max_memory // (4 * RUN_RECORD_SIZE
+                                              * len(self.paths)))
+        files = [i.open('rb') for i in self.paths]
+        try:
+            bufs = [numpy.fromfile(i, dtype=RUN_DTYPE, count=block_size)
+                    for i in files]
+            more = [len(i) == block_size for i in bufs]
+            while True:
+                bounds = [b['key'][-1] for b, m in zip(bufs, more) if m]
+                bound = min(bounds) if bounds else None
+                parts = []
+                for i, b in enumerate(bufs):
+                    size = len(b)
+                    if bound is not None:
+                        size = numpy.searchsorted(b['key'], bound)
+                    parts.append(b[:size])
+                    bufs[i] = b[size:]
+                chunk = numpy.concatenate(parts)
+                del parts
+                if len(chunk):
+                    # runs are in record order, so are ties in the chunk
+                    order, repeat = find_repeats(chunk['key'],
+                                                 chunk['score'])
+                    records = chunk['record'][order[repeat]]
+                    numpy.bitwise_or.at(
+                        refuse,
+                        records >> 3,
+                        numpy.left_shift(1, records & 7).astype(numpy.uint8),
+                    )
+                elif bound is None:
+                    break
+                for i, (b, m) in enumerate(zip(bufs, more)):
+                    if m and (not len(b) or b['key'][-1] == bound):
+                        new = numpy.fromfile(files[i], dtype=RUN_DTYPE,
+                                             count=block_size)
+                        more[i] = len(new) == block_size
+                        bufs[i] = numpy.concatenate([b, new])
+        finally:
+            for i in files:
+                i.close()
+            self._tmpdir.cleanup()
+        return refuse
+
+
+class SeenSet():
+    """
+    Set of hashes kept in sorted numpy arrays
+
+    Hashes are added as sorted arrays, each merged with the newest arrays
+    that are not larger than it, so there are only about log n arrays to
+    search, taking 8 bytes per hash.  With a memory budget, the arrays are
+    merged and written to disk when the budget is reached and are then
+    searched memory-mapped.
+
+    :param int max_memory: Approximate memory budget in bytes, or None
+    :param str directory: Where to make the temporary directory for the
+                          arrays written to disk
+    """
+    def __init__(self, max_memory=None, directory=None):
+        self.max_memory = max_memory
+        self.directory = directory
+        self.levels = []
+        self.spilled = []
+        self._tmpdir = None
+
+    def __len__(self):
+        return sum(map(len, chain(self.spilled, self.levels)))
+
+    def lookup(self, keys):
+        """
+        Tell which hashes are in the set
+
+        :param keys: numpy uint64 array
+        :return: numpy bool array
+        """
+        found = numpy.zeros(len(keys), dtype=bool)
+        for level in chain(self.spilled, self.levels):
+            pos = numpy.searchsorted(level, keys)
+            pos[pos == len(level)] = 0
+            found |= level[pos] == keys
+        return found
+
+    def add(self, keys):
+        """
+        Add hashes to the set
+
+        :param keys: Sorted numpy uint64 array of hashes not in the set
+        """
+        if not len(keys):
+            return
+        while self.levels and len(self.levels[-1]) <= len(keys):
+            # the stable sort finds and merges the two sorted runs
+            keys = numpy.sort(numpy.concatenate([self.levels.pop(), keys]),
+                              kind='stable')
+        self.levels.append(keys)
+        # merging takes up to twice the memory of the arrays
+        if self.max_memory is not None \
+                and 16 * sum(map(len, self.levels)) > self.max_memory:
+            self._spill()
+
+    def _spill(self):
+        if self._tmpdir is None:
+            self._tmpdir = TemporaryDirectory(prefix='omics-derep-',
+                                              dir=self.directory)
+        keys = numpy.sort(numpy.concatenate(self.levels), kind='stable')
+        self.levels = []
+        path = Path(self._tmpdir.name) / 'seen{}.npy'.format(
+            len(self.spilled)
+        )
+        numpy.save(str(path), keys)
+        del keys
+        self.spilled.append(numpy.load(str(path), mmap_mode='r'))
+
+    def keys(self):
+        """
+        Get all hashes in the set, in no particular order
+        """
+        return numpy.concatenate(
+            list(chain(self.spilled, self.levels))
+            + [numpy.empty(0, dtype=numpy.uint64)]
+        )
+
+    def cleanup(self):
+        """
+        Remove the arrays written to disk
+        """
+        self.spilled = []
+        if self._tmpdir is not None:
+            self._tmpdir.cleanup()
+            self._tmpdir = None
+
+
+def find_duplicates(fwd_in, rev_in=None, *, interleaved=False, check=False,
+                    max_memory=None, tmp_dir=None, fingerprints=None,
+                    found=None, coords=None):
     """
     Find duplicate reads in given fastq files
 
     Calculates hash of concatenation of flowcell + lane part of header with
-    whitespace-trimmed sequence string to detect replicated reads.  The
-    file offsets of each header-@ of forward reads is recorded and semi-ordered
-    such that the first offset listed belongs to the forward read of the
-    highest quality paired duplicate read.
+    whitespace-trimmed sequence string to detect replicated reads.  The hash
+    and the mean quality score of each read pair are stored in compact
+    arrays, indexed by the record number, i.e. the position of the read pair
+    in the files.  Without reverse reads, single reads are hashed, or the
+    pairs of interleaved reads.
+
+    :param rev_in: Reverse reads, or None for single or interleaved reads
+    :param bool interleaved: If True, fwd_in holds interleaved read pairs
+    :param int max_memory: Optional memory budget for the index in bytes.
+                           When reached, the index is spilled to disk as a
+                           sorted run.
+    :param str tmp_dir: Where to put the runs, by default TMPDIR or the
+                        system's default
+    :param fingerprints: Optional FingerprintIndex to look up the read pairs
+                         in, see match_fingerprints()
+    :param list found: For use with fingerprints, the bool arrays telling
+                       which read pairs were found are appended to it
+    :param list coords: If given, the coordinates of the reads are appended
+                        to it in arrays made by batch_coordinates()
+
+    :return: Tuple of the index and the total number of read pairs.  The
+             index is a tuple of numpy arrays of the 64-bit hashes and the
+             mean quality scores or, if spilled to disk, a SortedRuns
+             object.
     """
-    if rev_in is None:
-        raise NotImplemented('Single reads processing not implemented')
-
-    data = {}
-    fwd_read_pos = 0
-    total_count = 0
-
-    for (fh, rh), (fs, rs), (fp, rp), (fq, rq) in read_groups(fwd_in, rev_in):
-        if check:
-            if ord('>') in [fh[0], rh[0]]:
-                raise NotImplementedError('Fasta support not implemented')
-            if fh[0] != ord('@'):
-                raise RuntimeError('Expected fastq header in {}: {}'
-                                   ''.format(fwd_in.name, fh))
-            if rh[0] != ord('@'):
-                raise RuntimeError('Expected fastq header in {}: {}'
-                                   ''.format(rev_in.name, rh))
-            # TODO: check if headers match
-            if not fp == rp == b'+\n':
-                raise RuntimeError('Expected two + lines:\n{}\n{}'
-                                   ''.format(fp, rp))
-
-        paired_hash = hash_read_pair(fh, fs, rh, rs)
-
-        # get mean score of concatenated quality with newlines
-        cur_mean = mean_quality_score(fq + rq)
-
-        if paired_hash in data:
-            best_mean, pos_list = data[paired_hash]
-            if cur_mean > best_mean:
-                # new best read goes first
-                data[paired_hash] = (
-                    cur_mean,
-                    [fwd_read_pos] + pos_list
-                )
-            else:
-                # read to be deleted, goes at end
-                    data[paired_hash] = (
-                        best_mean,
-                        pos_list + [fwd_read_pos]
-                    )
+    segments = index_serial(fwd_in, rev_in, interleaved=interleaved,
+                            check=check, coords=coords)
+    if fingerprints is not None:
+        segments = match_fingerprints(segments, fingerprints, found)
+    return collect_index(segments, max_memory, tmp_dir)
+
+
+def find_duplicates_parallel(fwd_path, rev_path, threads, *, check=False,
+                             max_memory=None, tmp_dir=None,
+                             fingerprints=None, found=None):
+    """
+    Find duplicate reads in uncompressed fastq files using several processes
+
+    The files are split into byte ranges, each indexed by a separate
+    process.  The hashes are stable across processes and the ranges' indexes
+    are combined in order of the records, so the result is the same as that
+    of find_duplicates().
+
+    :param Path fwd_path: Forward or single reads file
+    :param Path rev_path: Reverse reads file, None for single reads
+    :param int threads: Number of processes
+    """
+    with ProcessPoolExecutor(max_workers=threads) as pe:
+        fwd, rev = [
+            None if path is None else pe.map(index_range, *zip(*[
+                (path, start, start + RANGE_SIZE, check)
+                for start in range(0, max(1, path.stat().st_size),
+                                   RANGE_SIZE)
+            ]))
+            for path in [fwd_path, rev_path]
+        ]
+        if rev is None:
+            segments = (
+                (keys, sums / lengths) for keys, sums, lengths in fwd
+            )
         else:
-            data[paired_hash] = (
-                cur_mean,
-                [fwd_read_pos]
+            segments = pair_ranges(fwd, rev, (fwd_path, rev_path))
+        if fingerprints is not None:
+            segments = match_fingerprints(segments, fingerprints, found)
+        return collect_index(segments, max_memory, tmp_dir)
+
+
+def index_serial(fwd_in, rev_in=None, *, interleaved=False, check=False,
+                 coords=None):
+    """
+    Index read pairs, or reads, from file objects
+
+    :param list coords: Optional list to append the reads' coordinates to
+
+    :return: Iterator over segments of the index, tuples of numpy arrays of
+             hashes and mean quality scores
+    """
+    for fwd_batch, rev_batch in read_batches(fwd_in, rev_in,
+                                             interleaved=interleaved,
+                                             check=check):
+        keys = numpy.array(batch_hashes(fwd_batch, rev_batch),
+                           dtype=numpy.uint64)
+        if coords is not None:
+            coords.append(batch_coordinates(fwd_batch))
+        yield keys, batch_scores(fwd_batch, rev_batch)
+
+
+def index_range(path, start, end, check=False):
+    """
+    Index the reads starting in a byte range of an uncompressed fastq file
+
+    To be run in a separate process.  A read starting before end is indexed
+    even if it extends beyond end.
+
+    :return: Tuple of numpy arrays of the hashes, and the sums and lengths
+             of the quality scores, including the newline, of the reads
+    """
+    parts = []
+    with open(str(path), 'rb') as file:
+        start = find_record_start(file, start)
+        if start is not None and start < end:
+            file.seek(start)
+            for batch in RecordReader(file, fmt=FileFormat.fastq,
+                                      check=check):
+                starts, _ = line_bounds(batch, 0)
+                num = numpy.searchsorted(starts + batch.offset, end)
+                keys = numpy.fromiter(
+                    (hash_read(head, seq) for head, seq, _, _
+                     in islice(batch.iter_lines(copy=True), num)),
+                    dtype=numpy.uint64,
+                    count=num,
+                )
+                sums, lengths = quality_sums(batch)
+                parts.append((keys, sums[:num], lengths[:num]))
+                if num < len(batch):
+                    break
+    if not parts:
+        return (numpy.empty(0, dtype=numpy.uint64),
+                numpy.empty(0, dtype=numpy.int64),
+                numpy.empty(0, dtype=numpy.int64))
+    return tuple(numpy.concatenate(i) for i in zip(*parts))
+
+
+def pair_ranges(fwd, rev, names):
+    """
+    Combine the indexes of ranges of forward and reverse reads file
+
+    :param fwd: Iterator over the results of index_range() for the ranges of
+                the forward reads file, in order
+    :param rev: Likewise for the reverse reads
+    :param tuple names: Names of the files, for error messages
+    :return: Iterator over segments of the index of the read pairs
+    """
+    f = r = None
+    while True:
+        if f is None or not len(f[0]):
+            f = next(fwd, None)
+        if r is None or not len(r[0]):
+            r = next(rev, None)
+        if f is None or r is None:
+            rest = chain([i for i in [f, r] if i is not None], fwd, rev)
+            if any(len(i[0]) for i in rest):
+                raise RuntimeError('Files have different number of reads: '
+                                   '{} and {}'.format(*names))
+            break
+        size = min(len(f[0]), len(r[0]))
+        if size:
+            # mean score of concatenated quality with newlines
+            yield (
+                combine_hashes(f[0][:size], r[0][:size]),
+                (f[1][:size] + r[1][:size]) / (f[2][:size] + r[2][:size]),
             )
+        f = tuple(i[size:] for i in f)
+        r = tuple(i[size:] for i in r)
 
-        # set positions for next read
-        fwd_read_pos = fwd_in.tell()
-        total_count += 1
 
-    return data, total_count
+def match_fingerprints(segments, fingerprints, found):
+    """
+    Look up read pairs in a fingerprint index
 
+    Hashes not found are queued to be added to the fingerprint index.
 
-def mean_quality_score(score):
+    :param segments: Iterator over segments of the index
+    :param fingerprints: A FingerprintIndex object
+    :param list found: The bool arrays telling which read pairs were found
+                       are appended to this list
+    :return: Iterator over the unchanged segments
     """
-    :param bytes score: Byte string encoding the score
+    for keys, scores in segments:
+        hit = fingerprints.lookup(keys)
+        fingerprints.add(keys[~hit])
+        found.append(hit)
+        yield keys, scores
+
+
+def collect_index(segments, max_memory=None, tmp_dir=None):
+    """
+    Put segments of the index together, spilling to disk if needed
+
+    :param segments: Iterator over tuples of hash and score arrays
+    :param int max_memory: Optional memory budget in bytes
+    :param str tmp_dir: Where to put the runs spilled to disk
+    :return: Tuple of the index and the total number of read pairs, see
+             find_duplicates()
     """
-    return sum(score) / len(score)
+    limit = None
+    if max_memory is not None:
+        # multiple of 8 for SortedRuns
+        limit = max(8, max_memory // INDEX_BYTES_PER_READ // 8 * 8)
+    runs = None
+    parts = []
+    size = 0
 
+    for keys, scores in segments:
+        while limit is not None and size + len(keys) >= limit:
+            # cut the segment at the budget, so a run never exceeds it
+            cut = limit - size
+            parts.append((keys[:cut], scores[:cut]))
+            keys, scores = keys[cut:], scores[cut:]
+            if runs is None:
+                runs = SortedRuns(tmp_dir)
+            runs.add(numpy.concatenate([i for i, _ in parts]),
+                     numpy.concatenate([i for _, i in parts]))
+            parts = []
+            size = 0
+        if len(keys):
+            parts.append((keys, scores))
+            size += len(keys)
 
-def build_filter(data):
+    if parts:
+        keys = numpy.concatenate([i for i, _ in parts])
+        scores = numpy.concatenate([i for _, i in parts])
+    else:
+        keys = numpy.empty(0, dtype=numpy.uint64)
+        scores = numpy.empty(0, dtype=numpy.float64)
+    if runs is None:
+        return (keys, scores), len(keys)
+    if len(keys):
+        runs.add(keys, scores)
+    return runs, runs.count
+
+
+def build_filter(data, max_memory=None, threads=None):
     """
-    Transform data from hash-indexed to set of read positions
+    Get the replicated reads to be removed as a bitmap
+
+    Read pairs are sorted by hash and, within groups of equal hash, by
+    decreasing mean quality score.  All but the first of each group, i.e.
+    the earliest read pair with the highest score, are marked.
+
+    :param data: The index from find_duplicates()
+    :param int max_memory: The memory budget, if the index was spilled to
+                           disk
+    :param int threads: Number of processes.  The hashes are partitioned by
+                        their leading bits and each partition is resolved by
+                        its own process.  Not used for spilled indexes.
+    :return: numpy array of bits packed into bytes, in little bit order, the
+             bit for each record number is set if the read pair is refused.
     """
-    refuse = set()
-    for _, pos_list in data.values():
-        for i in pos_list[1:]:
-            refuse.add(i)
-    return refuse
+    if isinstance(data, SortedRuns):
+        return data.build_filter(max_memory)
+
+    keys, scores = data
+    refuse = numpy.zeros(len(keys), dtype=bool)
+    if threads is None or threads < 2:
+        order, repeat = find_repeats(keys, scores)
+        refuse[order[repeat]] = True
+        return numpy.packbits(refuse, bitorder='little')
+
+    # route each hash by its leading byte, stable sort keeps the records of
+    # each partition in order, so ties resolve the same as without
+    # partitioning
+    part = (keys >> numpy.uint64(56)).astype(numpy.intp) * threads // 256
+    order = numpy.argsort(part, kind='stable')
+    bounds = numpy.cumsum(numpy.bincount(part, minlength=threads))[:-1]
+    del part
 
+    with ProcessPoolExecutor(max_workers=threads) as pe:
+        futures = [
+            pe.submit(resolve_partition, keys[i], scores[i], i)
+            for i in numpy.split(order, bounds)
+        ]
+        del order
+        for fut in futures:
+            refuse[fut.result()] = True
+    return numpy.packbits(refuse, bitorder='little')
 
-def filter_write(refuse, fwd_in, rev_in, fwd_out, rev_out, check=False,
-                 dupe_file=None):
+
+def resolve_partition(keys, scores, records):
     """
-    Write out filtered data
+    Get the repeats of a partition of the index
+
+    To be run in a separate process.
+
+    :param records: Array of the record numbers of the partition, in order
+    :return: Array of the record numbers of the repeats
+    """
+    order, repeat = find_repeats(keys, scores)
+    return records[order[repeat]]
 
-    :param set refuse: Set of file offset positions of the read headers @ of
-                       duplicated reads in the forward reads file.
+
+def count_refused(refuse):
+    """
+    Get number of read pairs marked in a filter bitmap
+    """
+    return int(numpy.unpackbits(refuse).sum())
+
+
+def get_refused(refuse, start, stop):
     """
-    if rev_in is None or rev_out is None:
-        raise NotImplemented('Single reads processing not implemented')
+    Get the refused record numbers in a range from a filter bitmap
+
+    :return: List of record numbers relative to start
+    """
+    first = start // 8
+    bits = numpy.unpackbits(refuse[first:(stop + 7) // 8], bitorder='little')
+    bits = bits[start - 8 * first:stop - 8 * first]
+    return numpy.flatnonzero(bits).tolist()
+
+
+def filter_write(refuse, fwd_in, rev_in, fwd_out, rev_out, *,
+                 interleaved=False, check=False, dupe_file=None,
+                 optical=None):
+    """
+    Write out filtered data
 
-    pos = fwd_in.tell()
-    for (fh, rh), (fs, rs), (fp, rp), (fq, rq) in read_groups(fwd_in, rev_in):
-        if pos in refuse:
+    :param refuse: Bitmap of the record numbers of duplicated reads, as made
+                   by build_filter()
+    :param rev_in: Reverse reads, None for single or interleaved reads
+    :param rev_out: Reverse reads output, None for single or interleaved
+                    reads
+    :param optical: Optional bitmap of the optical duplicates among the
+                    refused reads, the list of replicates then tells optical
+                    from PCR duplicates in a third column.
+    """
+    start = 0
+    for fwd_batch, rev_batch in read_batches(fwd_in, rev_in,
+                                             interleaved=interleaved,
+                                             check=check):
+        refused = get_refused(refuse, start, start + len(fwd_batch))
+        if optical is not None:
+            optical_refused = set(get_refused(optical, start,
+                                              start + len(fwd_batch)))
+        start += len(fwd_batch)
+        # write runs of kept reads straight from the input block
+        first = 0
+        for i in refused:
+            if first < i:
+                fwd_out.write(fwd_batch.records(first, i))
+                if rev_batch is not None:
+                    rev_out.write(rev_batch.records(first, i))
+            first = i + 1
             if dupe_file is not None:
-                hash_ = hash_read_pair(fh, fs, rh, rs)
-                hash_ = hash_.to_bytes(length=8, byteorder='big', signed=True)
+                hash_ = record_hash(fwd_batch, rev_batch, i)
+                hash_ = hash_.to_bytes(length=8, byteorder='big')
                 hash_ = hexlify(hash_)
-                dupe_file.write(fh.rstrip() + b'\t' + hash_ + b'\n')
-        else:
-            fwd_out.write(fh + fs + fp + fq)
-            rev_out.write(rh + rs + rp + rq)
+                head = bytes(fwd_batch.line(i, 0))
+                if optical is not None:
+                    if i in optical_refused:
+                        hash_ += b'\toptical'
+                    else:
+                        hash_ += b'\tpcr'
+                dupe_file.write(head.rstrip() + b'\t' + hash_ + b'\n')
+        fwd_out.write(fwd_batch.records(first, len(fwd_batch)))
+        if rev_batch is not None:
+            rev_out.write(rev_batch.records(first, len(rev_batch)))
+
+
+def filter_first(fwd_in, rev_in, fwd_out, rev_out, *, interleaved=False,
+                 check=False, dupe_file=None, fingerprints=None,
+                 max_memory=None, tmp_dir=None):
+    """
+    Write out filtered data in a single pass, keeping first seen read pairs
+
+    Unlike with find_duplicates() and filter_write() the input is read only
+    once, but of replicated read pairs the first one is kept, not the one
+    with the best quality.  The hashes of the kept read pairs are held in a
+    SeenSet.
 
-        if check:
-            if not fh[0] == rh[0] == ord('@'):
-                raise RuntimeError('Fastq header expected but found:\n{}\n{}'
-                                   ''.format(fh, rh))
+    See filter_write() for the parameters.
+
+    :param fingerprints: Optional FingerprintIndex, read pairs found in it
+                         are refused, the others are queued to be added
+    :param int max_memory: Approximate memory budget for the hashes
+    :param str tmp_dir: Directory for the hashes written to disk
+    :return: Tuple of total number and number of refused read pairs
+    """
+    seen = SeenSet(max_memory, tmp_dir)
+    total = 0
+    refused = 0
+    try:
+        for fwd_batch, rev_batch in read_batches(fwd_in, rev_in,
+                                                 interleaved=interleaved,
+                                                 check=check):
+            total += len(fwd_batch)
+            hashes = numpy.array(batch_hashes(fwd_batch, rev_batch),
+                                 dtype=numpy.uint64)
+            # of repeats within the batch the first is kept
+            keys, index = numpy.unique(hashes, return_index=True)
+            known = seen.lookup(keys)
+            if fingerprints is not None:
+                known |= fingerprints.lookup(keys)
+            seen.add(keys[~known])
+            keep = numpy.zeros(len(hashes), dtype=bool)
+            keep[index[~known]] = True
+            del keys, index, known
+
+            first = 0
+            for i in numpy.flatnonzero(~keep).tolist():
+                refused += 1
+                if first < i:
+                    fwd_out.write(fwd_batch.records(first, i))
+                    if rev_batch is not None:
+                        rev_out.write(rev_batch.records(first, i))
+                first = i + 1
+                if dupe_file is not None:
+                    hash_ = hexlify(int(hashes[i]).to_bytes(length=8,
+                                                            byteorder='big'))
+                    head = bytes(fwd_batch.line(i, 0))
+                    dupe_file.write(head.rstrip() + b'\t' + hash_ + b'\n')
+            fwd_out.write(fwd_batch.records(first, len(fwd_batch)))
+            if rev_batch is not None:
+                rev_out.write(rev_batch.records(first, len(rev_batch)))
+        if fingerprints is not None:
+            fingerprints.add(seen.keys())
+    finally:
+        seen.cleanup()
+    return total, refused
 
-            if not fp == rp == b'+\n':
-                raise RuntimeError('Plus separator expected but found:\n{}\n{}'
-                                   ''.format(fp, rp))
 
-        pos = fwd_in.tell()
+def commit_fingerprints(fingerprints, verbosity=DEFAULT_VERBOSITY):
+    """
+    Add the queued fingerprints to the index, if there is one
+
+    Reads removed for being found with other samples are reported.
+    """
+    if fingerprints is None:
+        return
+    if fingerprints.matched and verbosity >= DEFAULT_VERBOSITY:
+        print('removed reads found with other samples in the fingerprint '
+              'index:')
+        for sample, count in fingerprints.matched.most_common():
+            print('  {}: {}'.format(sample, count))
+    added = fingerprints.commit()
+    if verbosity > DEFAULT_VERBOSITY:
+        print('index holds {} fingerprints of sample {}'
+              ''.format(added, fingerprints.sample))
 
 
 def main(argv=None, namespace=None):
     argp = get_argparser(
         prog=__loader__.name.replace('.', ' '),
         description=__doc__,
-        threads=False,
     )
     argp.add_argument('forward_reads', type=argparse.FileType())
-    argp.add_argument('reverse_reads', type=argparse.FileType())
+    argp.add_argument(
+        'reverse_reads',
+        nargs='?',
+        type=argparse.FileType(),
+        help='Reverse reads, if omitted single-end reads are dereplicated, '
+             'or, with --interleaved, interleaved read pairs',
+    )
+    argp.add_argument(
+        '--interleaved',
+        action='store_true',
+        help='The forward reads file holds interleaved read pairs, which are '
+             'written to a single interleaved output file',
+    )
     argp.add_argument(
         '-c', '--check',
         action='store_true',
@@ -213,51 +900,235 @@ def main(argv=None, namespace=None):
         help='If provided, the list of replicated reads is written to the '
              'given file.',
     )
+    argp.add_argument(
+        '--single-pass',
+        action='store_true',
+        help='Read the input only once, keeping the first of each set of '
+             'replicated read pairs instead of the one with the best '
+             'quality.  This halves the amount of data read.  The index '
+             'then takes about 8 bytes per read pair, with --max-memory it '
+             'is written to disk when the budget is reached.',
+    )
+    argp.add_argument(
+        '--fingerprints',
+        action='store_true',
+        help='Also remove read pairs found in the project\'s fingerprint '
+             'index of other, earlier processed, samples, and add this '
+             'sample\'s read pairs to the index, replacing those of any '
+             'earlier run of the sample.  The number of read pairs removed '
+             'for each other sample is reported.',
+    )
+    argp.add_argument(
+        '--fingerprints-file',
+        metavar='FILE',
+        help='Use the given fingerprint index file instead of the '
+             'project\'s, implies --fingerprints',
+    )
+    argp.add_argument(
+        '--sample',
+        metavar='NAME',
+        help='Name of the sample in the fingerprint index, by default the '
+             'absolute path of the forward reads file.  Give a name if the '
+             'same sample may be read from different places.',
+    )
+    argp.add_argument(
+        '--optical',
+        metavar='DIST',
+        type=int,
+        help='Tell optical duplicates, replicates within DIST pixels of each '
+             'other on the same tile, from PCR duplicates.  Both are '
+             'removed, but counted separately, and the replicates list gets '
+             'a third column saying "optical" or "pcr".  Picard uses 100 for '
+             'unpatterned and 2500 for patterned flowcells.  Can not be used '
+             'with --single-pass or --max-memory.',
+    )
+    argp.add_argument(
+        '--max-memory',
+        metavar='SIZE',
+        type=memory_size,
+        help='Approximate memory budget for the index of reads, e.g. 500M or '
+             '60G.  When reached, the index is written to disk in sorted '
+             'runs that are merged later.  The output is the same as with '
+             'the index in memory.  By default there is no limit.',
+    )
+    argp.add_argument(
+        '--tmp-dir',
+        metavar='PATH',
+        help='Directory for the index written to disk with --max-memory, '
+             'the default is given by the TMPDIR environment variable, or '
+             'else the system\'s default temporary directory.',
+    )
+    add_compress_arguments(argp)
     args = argp.parse_args(args=argv, namespace=namespace)
 
     out_dir = Path(args.out_dir)
     if not out_dir.is_dir():
         argp.error('Directory does not exist: {}'.out_dir)
+    if args.optical is not None:
+        if args.single_pass or args.max_memory is not None:
+            argp.error('--optical can not be used with --single-pass or '
+                       '--max-memory')
+        if args.optical < 0:
+            argp.error('--optical: distance must not be negative')
 
-    args.forward_reads.close()
-    args.reverse_reads.close()
+    if args.interleaved and args.reverse_reads is not None:
+        argp.error('--interleaved takes a single reads file')
 
+    args.forward_reads.close()
     fwd_path = Path(args.forward_reads.name)
-    rev_path = Path(args.reverse_reads.name)
+    rev_path = None
+    if args.reverse_reads is not None:
+        args.reverse_reads.close()
+        rev_path = Path(args.reverse_reads.name)
+    kind = 'read' if rev_path is None and not args.interleaved \
+        else 'paired-read'
 
-    fwd_in = fwd_path.open('rb')
-    rev_in = rev_path.open('rb')
+    fingerprints = None
+    found = []
+    sample = args.sample or str(fwd_path.resolve())
+    if args.fingerprints_file:
+        fingerprints = FingerprintIndex(args.fingerprints_file, sample)
+    elif args.fingerprints:
+        index_path = get_project_index(args.project)
+        index_path.parent.mkdir(exist_ok=True)
+        fingerprints = FingerprintIndex(index_path, sample)
+    if fingerprints is not None and args.verbosity > DEFAULT_VERBOSITY:
+        print('fingerprint index {} holds {} fingerprints of {} samples'
+              ''.format(fingerprints.path, len(fingerprints),
+                        len(fingerprints.names)))
 
-    data, total_reads = find_duplicates(fwd_in, rev_in, check=args.check)
+    out_paths = []
+    for i in [fwd_path, rev_path]:
+        if i is not None:
+            name = uncompressed_path(i)
+            out_paths.append(compressed_path(
+                out_dir / (name.stem + args.infix + name.suffix),
+                args.compress,
+            ))
 
-    if args.verbosity > DEFAULT_VERBOSITY:
-        print('total paired-read count: {}'.format(total_reads))
+    if not args.single_pass:
+        threads = args.threads
+        if threads is not None and threads > 1:
+            # byte ranges need uncompressed regular files with records that
+            # can be told apart, coordinates are collected in one process
+            if args.interleaved or args.optical is not None:
+                threads = None
+            for i in [fwd_path, rev_path]:
+                if i is None:
+                    continue
+                with i.open('rb') as file:
+                    if not i.is_file() or is_gzip(file):
+                        threads = None
+            if threads is None and args.verbosity > DEFAULT_VERBOSITY:
+                print('compressed, interleaved or non-regular input, or '
+                      'optical duplicates, indexing reads in a single '
+                      'process')
 
-    refuse = build_filter(data)
+        coords = None if args.optical is None else []
+        if threads is None or threads < 2:
+            fwd_in = open_reads(fwd_path, threads=args.threads)
+            rev_in = None if rev_path is None \
+                else open_reads(rev_path, threads=args.threads)
+            data, total_reads = find_duplicates(
+                fwd_in, rev_in,
+                interleaved=args.interleaved,
+                check=args.check,
+                max_memory=args.max_memory,
+                tmp_dir=args.tmp_dir,
+                fingerprints=fingerprints,
+                found=found,
+                coords=coords,
+            )
+            fwd_in.close()
+            if rev_in is not None:
+                rev_in.close()
+        else:
+            data, total_reads = find_duplicates_parallel(
+                fwd_path, rev_path, threads,
+                check=args.check,
+                max_memory=args.max_memory,
+                tmp_dir=args.tmp_dir,
+                fingerprints=fingerprints,
+                found=found,
+            )
 
-    if args.verbosity > DEFAULT_VERBOSITY:
-        print('replicated paired-reads:', len(refuse))
+        if args.verbosity > DEFAULT_VERBOSITY:
+            print('total {} count: {}'.format(kind, total_reads))
+            if isinstance(data, SortedRuns):
+                print('index written to disk in {} runs'
+                      ''.format(len(data.paths)))
 
-    fwd_in.seek(0)
-    rev_in.seek(0)
+        refuse = build_filter(data, args.max_memory, threads)
+        if fingerprints is not None:
+            found = numpy.packbits(
+                numpy.concatenate(found + [numpy.empty(0, dtype=bool)]),
+                bitorder='little',
+            )
+            if args.verbosity > DEFAULT_VERBOSITY:
+                print('{}s found in fingerprint index: {}'
+                      ''.format(kind, count_refused(found)))
+            refuse |= found
 
-    fwd_out_path = out_dir / (fwd_path.stem + args.infix + fwd_path.suffix)
-    rev_out_path = out_dir / (rev_path.stem + args.infix + rev_path.suffix)
+        if args.verbosity > DEFAULT_VERBOSITY:
+            print('replicated {}s: {}'.format(kind, count_refused(refuse)))
 
-    fwd_out = fwd_out_path.open('wb')
-    rev_out = rev_out_path.open('wb')
+        optical = None
+        if coords is not None:
+            keys = data[0]
+            coords = numpy.concatenate(
+                coords + [numpy.empty((0, 3), dtype=numpy.int64)]
+            )
+            near = find_optical(keys, coords[:, 0], coords[:, 1],
+                                coords[:, 2], args.optical)
+            del coords
+            near &= numpy.unpackbits(refuse, count=len(keys),
+                                     bitorder='little').astype(bool)
+            optical = numpy.packbits(near, bitorder='little')
+            if args.verbosity > DEFAULT_VERBOSITY:
+                num_optical = count_refused(optical)
+                print('  optical duplicates: {}'.format(num_optical))
+                print('  PCR duplicates: {}'
+                      ''.format(count_refused(refuse) - num_optical))
+
+    # open again for the filtering pass, compressed input can't seek
+    fwd_in = open_reads(fwd_path, threads=args.threads)
+    rev_in = None if rev_path is None \
+        else open_reads(rev_path, threads=args.threads)
+    outs = [open_output(i, args.compress, args.compress_level,
+                        threads=args.threads)
+            for i in out_paths]
+    fwd_out, rev_out = (outs + [None])[:2]
 
     if args.verbosity > DEFAULT_VERBOSITY:
-        print('writing dereplicated output to {} and {} ...'
-              ''.format(fwd_out_path, rev_out_path), end='', flush=True)
+        print('writing dereplicated output to {} ...'
+              ''.format(' and '.join(map(str, out_paths))),
+              end='', flush=True)
 
-    filter_write(refuse, fwd_in, rev_in, fwd_out, rev_out,
-                 dupe_file=args.replicates_list)
-    fwd_out.close()
-    rev_out.close()
+    if args.single_pass:
+        total_reads, refused = filter_first(
+            fwd_in, rev_in, fwd_out, rev_out,
+            interleaved=args.interleaved,
+            check=args.check,
+            dupe_file=args.replicates_list,
+            fingerprints=fingerprints,
+            max_memory=args.max_memory,
+            tmp_dir=args.tmp_dir,
+        )
+    else:
+        filter_write(refuse, fwd_in, rev_in, fwd_out, rev_out,
+                     interleaved=args.interleaved,
+                     dupe_file=args.replicates_list,
+                     optical=optical)
+    for i in outs:
+        i.close()
 
     if args.verbosity > DEFAULT_VERBOSITY:
         print('done')
+        if args.single_pass:
+            print('total {} count: {}'.format(kind, total_reads))
+            print('replicated {}s: {}'.format(kind, refused))
+
+    commit_fingerprints(fingerprints, args.verbosity)
 
 
 if __name__ == '__main__':
@@ -20,39 +20,31 @@ Convert fastq into fasta
 """
 
 import argparse
+from itertools import chain, repeat
 import sys
 
 from . import OmicsArgParser
+from .gzio import add_compress_arguments, open_output, open_reads
+from .seqio import FileFormat, RecordReader
 
 
 def convert(data, output, check=True):
     """
     Convert data from FASTQ into FASTA format
 
-    :param data: File-like object with input data
-    :param output: File-like object for output
+    :param data: File-like object with input data, opened in binary mode
+    :param output: File-like object for output, opened in binary mode
     """
-    state = 0
-    for line in data:
-        if check:
-            if state is 0 and not line.startswith('@'):
-                raise RuntimeError('Input not in FASTQ format? Expected line '
-                                   'to start with @: {}'.format(line))
-            elif state is 2 and not line == '+\n':
-                raise RuntimeError('Input not in FASTQ format? Expected + '
-                                   'separator line: {}'.format(line))
-
-        if state is 0:
-            output.write('>' + line[1:])
-        elif state is 1:
-            output.write(line)
-
-        state = (state + 1) % 4
-
-    if state is not 0:
-        raise RuntimeError('Input not in FASTQ format? Expected total number '
-                           'of lines to be multiple of 4, last line: {}'
-                           ''.format(line))
+    try:
+        reader = RecordReader(data, fmt=FileFormat.fastq, check=check)
+        for batch in reader:
+            # header without the @ and sequence lines
+            head_seq = batch.spans(0, 2, skip=1)
+            output.write(b''.join(chain.from_iterable(
+                zip(repeat(b'>'), head_seq)
+            )))
+    except RuntimeError as e:
+        raise RuntimeError('Input not in FASTQ format? {}'.format(e))
 
 
 def main(argv=None, namespace=None):
@@ -60,22 +52,22 @@ def main(argv=None, namespace=None):
         prog=__loader__.name.replace('.', ' '),
         description=__doc__,
         project_home=False,
-        threads=False,
     )
     argp.add_argument(
         'inputfile',
         metavar='FILE',
         nargs='?',
-        type=argparse.FileType('r'),
-        default=sys.stdin,
-        help='Fastq file to be converted, by default data is read from stdin.'
+        type=argparse.FileType('rb'),
+        default=sys.stdin.buffer,
+        help='Fastq file to be converted, may be gzip-compressed.  By default '
+             'data is read from stdin.'
     )
     argp.add_argument(
         '-o', '--output',
         metavar='FILE',
         nargs='?',
-        type=argparse.FileType('w'),
-        default=sys.stdout,
+        type=argparse.FileType('wb'),
+        default=sys.stdout.buffer,
         help='Name of output filie.  Write to stdout by default.'
     )
     argp.add_argument(
@@ -90,8 +82,16 @@ def main(argv=None, namespace=None):
         help='Skip sanity check on input data.  By default it is checked that '
              'the input is indeed in fastq format.',
     )
+    add_compress_arguments(argp)
     args = argp.parse_args(args=argv, namespace=namespace)
-    convert(args.inputfile, args.output, check=args.check)
+    output = open_output(args.output, args.compress, args.compress_level,
+                         threads=args.threads)
+    convert(open_reads(args.inputfile, threads=args.threads), output,
+            check=args.check)
+    output.flush()
+    if output is not args.output:
+        # finish the compressed stream
+        output.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,257 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Copying files without moving the data through python
+
+Whole files can be reflinked, i.e. cloned copy-on-write on file systems like
+btrfs or XFS, or hard-linked.  Other copies are done by the kernel via
+copy_file_range(2) or sendfile(2).  Each method falls back to the next one
+down when not supported by the OS or file system:
+
+    reflink -> copy_file_range -> sendfile -> python
+    hardlink -> copy_file_range -> sendfile -> python
+"""
+
+import errno
+import fcntl
+import os
+
+# choices for the copy method, in the order given above
+COPY_METHODS = ['reflink', 'hardlink', 'kernel', 'python']
+
+# ioctl request to clone a file, from linux/fs.h
+FICLONE = 0x40049409
+
+# bytes per copy_file_range or sendfile call
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# buffer size for copying through python
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# errors meaning a method is not available for the given files
+UNSUPPORTED = {
+    errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTSUP, errno.ENOTTY,
+    errno.EOPNOTSUPP, errno.EXDEV, errno.EPERM, errno.EMLINK,
+}
+
+
+def reflink(src, dest):
+    """
+    Clone a file copy-on-write
+
+    The destination file is created or truncated.
+
+    :param Path src: Source file
+    :param Path dest: Destination file
+    :raise OSError: If the file system or OS does not support it
+    """
+    with src.open('rb') as i, dest.open('wb') as o:
+        fcntl.ioctl(o.fileno(), FICLONE, i.fileno())
+
+
+def hardlink(src, dest):
+    """
+    Hard-link a file, replacing an existing empty destination file
+
+    :param Path src: Source file
+    :param Path dest: Destination file
+    :raise OSError: E.g. if source and destination are on different file
+                    systems
+    """
+    if dest.is_file() and dest.stat().st_size == 0:
+        dest.unlink()
+    os.link(str(src), str(dest))
+
+
+def link_file(src, dest, method):
+    """
+    Try to reflink or hard-link a file
+
+    :param Path src: Source file
+    :param Path dest: Destination file
+    :param str method: The copy method, see COPY_METHODS
+    :return: The method used, or None if the file was not linked and needs
+             to be copied
+    """
+    funcs = {'reflink': reflink, 'hardlink': hardlink}
+    if method not in funcs:
+        return None
+    try:
+        funcs[method](src, dest)
+    except OSError as e:
+        if e.errno not in UNSUPPORTED:
+            raise
+        return None
+    return method
+
+
+def _copy_file_range(infd, outfd):
+    while True:
+        size = os.copy_file_range(infd, outfd, CHUNK_SIZE)
+        if size == 0:
+            break
+        yield size
+
+
+def _sendfile(infd, outfd):
+    while True:
+        # with offset None sendfile uses and updates the file position
+        size = os.sendfile(outfd, infd, None, CHUNK_SIZE)
+        if size == 0:
+            break
+        yield size
+
+
+def copy_fileobj(infile, outfile, method='kernel', throttle=None):
+    """
+    Copy the rest of a file into another, by the kernel if possible
+
+    Both files must be regular files for the kernel methods.  Copying starts
+    at the current file positions and the positions are advanced.
+
+    :param infile: Input file object opened in binary mode
+    :param outfile: Output file object opened in binary mode, but not in
+                    append mode.
+    :param str method: The copy method, see COPY_METHODS, anything but
+                       'python' makes the kernel do the copying if possible.
+    :param throttle: Optional function called with the number of bytes
+                     after each chunk copied, see omics.iosched
+    :return: Tuple of the name of the function that did the copying and the
+             number of bytes copied.
+    """
+    total = 0
+    if method != 'python':
+        outfile.flush()
+        infd, outfd = infile.fileno(), outfile.fileno()
+        # python may have read ahead, sync file position with infile
+        os.lseek(infd, infile.tell(), os.SEEK_SET)
+        kernel_copy = []
+        if hasattr(os, 'copy_file_range'):
+            kernel_copy.append(('copy_file_range', _copy_file_range))
+        if hasattr(os, 'sendfile'):
+            kernel_copy.append(('sendfile', _sendfile))
+        for name, func in kernel_copy:
+            try:
+                for size in func(infd, outfd):
+                    total += size
+                    if throttle is not None:
+                        throttle(size)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                # try next method from where this one stopped
+                continue
+            else:
+                infile.seek(0, os.SEEK_END)
+                outfile.seek(0, os.SEEK_END)
+                return name, total
+        # back to python, continue at the kernel's file positions
+        infile.seek(os.lseek(infd, 0, os.SEEK_CUR))
+        outfile.seek(os.lseek(outfd, 0, os.SEEK_CUR))
+
+    while True:
+        data = infile.read(BUFFER_SIZE)
+        if not data:
+            break
+        outfile.write(data)
+        total += len(data)
+        if throttle is not None:
+            throttle(len(data))
+    return 'python', total
+
+
+def pwrite_all(fd, data, offset):
+    """
+    Write all of data at given offset of a file descriptor
+
+    The file position is neither used nor changed.
+    """
+    view = memoryview(data)
+    while view:
+        size = os.pwrite(fd, view, offset)
+        view = view[size:]
+        offset += size
+
+
+class OffsetWriter():
+    """
+    Minimal file-like object writing from given offset of a file descriptor
+
+    Several writers may write to different regions of the same file at the
+    same time, e.g. from different threads.
+
+    :param int fd: File descriptor open for writing
+    :param int offset: Where to start writing
+    """
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        pwrite_all(self.fd, data, self.offset)
+        self.offset += len(data)
+        return len(data)
+
+
+def copy_to_offset(infile, outfd, offset, method='kernel', throttle=None):
+    """
+    Copy the rest of a file to given offset of a file descriptor
+
+    Only copy_file_range(2) can write at an offset, if the kernel does not
+    support it the data is copied with pwrite(2).
+
+    :param infile: Input file object opened in binary mode
+    :param int outfd: Output file descriptor, its file position is not used
+    :param int offset: Offset into the output
+    :param str method: The copy method, see COPY_METHODS
+    :param throttle: Optional function called with the number of bytes
+                     after each chunk copied
+    :return: Tuple of the name of the function that did the copying and the
+             number of bytes copied.
+    """
+    total = 0
+    if method != 'python' and hasattr(os, 'copy_file_range'):
+        infd = infile.fileno()
+        os.lseek(infd, infile.tell(), os.SEEK_SET)
+        try:
+            while True:
+                size = os.copy_file_range(infd, outfd, CHUNK_SIZE, None,
+                                          offset + total)
+                if size == 0:
+                    break
+                total += size
+                if throttle is not None:
+                    throttle(size)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            infile.seek(os.lseek(infd, 0, os.SEEK_CUR))
+        else:
+            infile.seek(0, os.SEEK_END)
+            return 'copy_file_range', total
+
+    writer = OffsetWriter(outfd, offset + total)
+    while True:
+        data = infile.read(BUFFER_SIZE)
+        if not data:
+            break
+        writer.write(data)
+        total += len(data)
+        if throttle is not None:
+            throttle(len(data))
+    return 'pwrite', total
@@ -0,0 +1,211 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Persistent index of read fingerprints
+
+The index holds the 64-bit read pair hashes of each sample processed so far,
+each together with the number of its sample.  It is stored as a numpy .npy
+file with two rows, the hashes in sorted order and the sample numbers, and
+the sample names are kept in a text file next to it, one per line.  The
+index is memory-mapped for lookups, so checking reads against reads of
+earlier samples only touches the pages the binary searches need.  Lookups
+ignore the fingerprints of the sample being processed, and committing a
+sample's fingerprints replaces those of earlier runs of the same sample.
+Updates are merged under a lock and replace the file atomically, so that
+several samples can be processed at the same time.
+"""
+
+from collections import Counter
+import fcntl
+import os
+from pathlib import Path
+
+from . import OMICS_DIR, lazy_import
+
+numpy = lazy_import('numpy')
+
+# name of a project's index in the project's omics directory
+INDEX_FILE = 'derep-fingerprints.npy'
+
+# suffix of the file with the sample names, replacing the index's suffix
+SAMPLES_SUFFIX = '.samples'
+
+DTYPE = '<u8'
+
+# rows of the index
+KEY = 0
+SAMPLE = 1
+
+
+def get_project_index(project):
+    """
+    Get path to a project's fingerprint index
+
+    :param project: An OmicsProject object
+    """
+    return Path(project['project_home']) / OMICS_DIR / INDEX_FILE
+
+
+class FingerprintIndex():
+    """
+    Sorted on-disk set of read fingerprints of several samples
+
+    :param Path path: The index file, which need not exist yet
+    :param str sample: Name of the sample being processed
+
+    The matched attribute is a Counter of the fingerprints found by lookup()
+    for each other sample.
+    """
+    def __init__(self, path, sample):
+        self.path = Path(path)
+        self.samples_path = self.path.with_suffix(SAMPLES_SUFFIX)
+        self.sample = sample
+        self.names = self._load_names()
+        self.index = self._load()
+        self.matched = Counter()
+        self._pending = []
+
+    def __len__(self):
+        return self.index.shape[1]
+
+    @property
+    def sample_id(self):
+        """
+        Number of the sample being processed, None if it is not indexed
+        """
+        try:
+            return self.names.index(self.sample)
+        except ValueError:
+            return None
+
+    def _load_names(self):
+        if not self.samples_path.exists():
+            return []
+        return self.samples_path.read_text().splitlines()
+
+    def _load(self):
+        if not self.path.exists():
+            return numpy.empty((2, 0), dtype=DTYPE)
+        index = numpy.load(str(self.path), mmap_mode='r')
+        if index.dtype != numpy.dtype(DTYPE) or index.ndim != 2 \
+                or index.shape[0] != 2:
+            raise RuntimeError('Not a fingerprint index: {}'
+                               ''.format(self.path))
+        return index
+
+    def _replace(self, path, write):
+        """
+        Atomically replace a file, calling write(file) for the content
+        """
+        tmp = path.with_name('.' + path.name + '.tmp')
+        with tmp.open('wb') as f:
+            write(f)
+        os.replace(str(tmp), str(path))
+
+    def find(self, keys):
+        """
+        Find fingerprints of other samples in the index
+
+        :param keys: numpy array of fingerprints
+        :return: numpy int64 array of the number of a sample other than the
+                 one being processed that has the fingerprint, -1 for keys
+                 not found
+        """
+        keys = numpy.asarray(keys, dtype=DTYPE)
+        found = numpy.full(len(keys), -1, dtype=numpy.int64)
+        if not len(self):
+            return found
+        index_keys = self.index[KEY]
+        lo = numpy.searchsorted(index_keys, keys, side='left')
+        hi = numpy.searchsorted(index_keys, keys, side='right')
+        # each sample has a fingerprint once, sorted by sample number, so
+        # if the first one found is the sample's own, the next is another's
+        own = self.sample_id
+        hit = numpy.flatnonzero(lo < hi)
+        samples = numpy.asarray(self.index[SAMPLE][lo[hit]]).astype(
+            numpy.int64)
+        if own is not None:
+            is_own = samples == own
+            other = is_own & (hi[hit] - lo[hit] > 1)
+            samples[other] = self.index[SAMPLE][lo[hit][other] + 1]
+            keep = ~is_own | other
+            hit = hit[keep]
+            samples = samples[keep]
+        found[hit] = samples
+        return found
+
+    def lookup(self, keys):
+        """
+        Tell which fingerprints other samples have in the index
+
+        The counts of the matched attribute are updated.
+
+        :param keys: numpy array of fingerprints
+        :return: numpy bool array, True for keys found in the index
+        """
+        found = self.find(keys)
+        samples, counts = numpy.unique(found[found >= 0], return_counts=True)
+        for i, count in zip(samples.tolist(), counts.tolist()):
+            self.matched[self.names[i]] += count
+        return found >= 0
+
+    def add(self, keys):
+        """
+        Queue fingerprints of the sample to be added to the index by commit()
+
+        :param keys: numpy array of fingerprints, in any order, may contain
+                     repeats
+        """
+        self._pending.append(numpy.unique(numpy.asarray(keys, dtype=DTYPE)))
+
+    def commit(self):
+        """
+        Write the queued fingerprints to the index
+
+        The sample's fingerprints of earlier runs are replaced.  The index
+        file is re-read under a lock, so fingerprints added by other
+        processes in the meantime are kept.  The merge is done in memory.
+
+        :return: Number of fingerprints of the sample in the index
+        """
+        keys = numpy.unique(numpy.concatenate(
+            self._pending + [numpy.empty(0, dtype=DTYPE)]
+        ))
+        self._pending = []
+        lock_path = self.path.with_name(self.path.name + '.lock')
+        with lock_path.open('w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.names = self._load_names()
+            own = self.sample_id
+            if own is None:
+                own = len(self.names)
+                self.names.append(self.sample)
+                text = ''.join(i + '\n' for i in self.names).encode()
+                self._replace(self.samples_path, lambda f: f.write(text))
+            old = self._load()
+            old = old[:, old[SAMPLE] != own]
+            new = numpy.empty((2, len(keys)), dtype=DTYPE)
+            new[KEY] = keys
+            new[SAMPLE] = own
+            merged = numpy.concatenate([old, new], axis=1)
+            del old, new
+            merged = merged[:, numpy.lexsort(merged[::-1])]
+            self._replace(self.path, lambda f: numpy.save(f, merged))
+            del merged
+            self.index = self._load()
+        return len(keys)
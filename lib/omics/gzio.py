@@ -0,0 +1,552 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Threaded reading and writing of gzip-compressed data
+
+zlib releases the GIL while inflating, so threads give real parallelism.
+BGZF files, e.g. written by bgzip or samtools, are a series of independent
+gzip members of at most 64 KiB each, whose compressed sizes are stored in
+their headers.  These are decompressed block-parallel by a thread pool.  Any
+other gzip data, single- or multi-member, is inflated by a background thread
+reading ahead while the data is being processed.
+
+Output is always written in BGZF format, which any gzip tool can read, with
+the blocks compressed in parallel.
+"""
+
+from collections import deque
+import io
+import os
+from pathlib import Path
+import queue
+import struct
+import threading
+import zlib
+
+from . import get_num_cpus
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# gzip magic, deflate, FEXTRA flag, ..., XLEN=6, BC subfield of length 2
+BGZF_HEADER_SIZE = 18
+BGZF_BLOCK_SIZE = 64 * 1024
+
+# uncompressed data per block, as bgzip does, so that even incompressible
+# data fits into a block
+BGZF_DATA_SIZE = 0xff00
+
+# empty block marking the end of a BGZF file
+BGZF_EOF = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+            b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+DEFAULT_COMPRESS_LEVEL = 6
+
+# number of BGZF blocks inflated per job
+BGZF_JOB_BLOCKS = 16
+
+# size of compressed chunks read by the inflate thread
+READ_SIZE = 1024 * 1024
+
+# number of chunks the inflate thread may read ahead
+READ_AHEAD = 16
+
+# buffer size for the reader returned by open_reads()
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# wbits value for zlib to process gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def get_bgzf_block_size(header):
+    """
+    Get the total size of a BGZF block from its header
+
+    :param bytes header: The first BGZF_HEADER_SIZE bytes of the block
+    :return: The block size or None if this is not a BGZF header.
+    """
+    if len(header) < BGZF_HEADER_SIZE:
+        return None
+    if header[:4] != b'\x1f\x8b\x08\x04':
+        return None
+    if header[10:16] != b'\x06\x00BC\x02\x00':
+        return None
+    return struct.unpack('<H', header[16:18])[0] + 1
+
+
+def inflate_blocks(blocks):
+    """
+    Decompress a list of complete gzip members
+
+    CRC and size of each member are checked by zlib.
+    """
+    return b''.join([zlib.decompress(i, GZIP_WBITS) for i in blocks])
+
+
+def deflate_blocks(data, level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Compress data into BGZF blocks
+
+    :param bytes data: Uncompressed data
+    :param int level: zlib compression level
+    :return: The BGZF blocks as bytes
+    """
+    blocks = []
+    for start in range(0, len(data), BGZF_DATA_SIZE):
+        chunk = data[start:start + BGZF_DATA_SIZE]
+        deflater = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        cdata = deflater.compress(chunk) + deflater.flush()
+        blocks += [
+            b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00',
+            struct.pack('<H', BGZF_HEADER_SIZE + len(cdata) + 8 - 1),
+            cdata,
+            struct.pack('<II', zlib.crc32(chunk), len(chunk)),
+        ]
+    return b''.join(blocks)
+
+
+class Inflater():
+    """
+    Incremental decompression of multi-member gzip data
+
+    Zero padding between members, as written by some tools, is skipped.
+    """
+    def __init__(self):
+        self._inflater = None
+
+    def decompress(self, data):
+        """
+        Decompress the next piece of compressed data
+
+        :return: List of decompressed chunks, possibly empty
+        """
+        chunks = []
+        while data:
+            if self._inflater is None:
+                # next member, skip any zero padding
+                data = data.lstrip(b'\x00')
+                if not data:
+                    break
+                self._inflater = zlib.decompressobj(GZIP_WBITS)
+            chunk = self._inflater.decompress(data)
+            if chunk:
+                chunks.append(chunk)
+            if self._inflater.eof:
+                data = self._inflater.unused_data
+                self._inflater = None
+            else:
+                data = b''
+        return chunks
+
+    @property
+    def in_member(self):
+        """
+        True if the data so far ends inside a gzip member
+        """
+        return self._inflater is not None
+
+
+class GzipReader(io.RawIOBase):
+    """
+    Raw reader of decompressed gzip data
+
+    Usually this is used wrapped in a buffered reader as returned by
+    open_reads().
+
+    :param file: Binary file object with gzip data, must support peek()
+    :param int threads: Number of threads to decompress BGZF data, by default
+                        the number of available CPUs.  Ignored if an executor
+                        is given.
+    :param executor: Optional concurrent.futures.ThreadPoolExecutor object to
+                     decompress BGZF blocks, e.g. shared between readers.
+    """
+    def __init__(self, file, threads=None, executor=None):
+        super().__init__()
+        self._file = file
+        self._buf = memoryview(b'')
+        self._jobs = deque()
+        self._own_executor = None
+        self._thread = None
+        self._stop = threading.Event()
+
+        header = file.peek(BGZF_HEADER_SIZE)[:BGZF_HEADER_SIZE]
+        if threads is None:
+            threads = get_num_cpus()
+        if get_bgzf_block_size(header) and (threads > 1 or executor):
+            if executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                executor = ThreadPoolExecutor(max_workers=threads)
+                self._own_executor = executor
+            self._chunks = self._bgzf_chunks(executor, 4 * threads)
+        else:
+            self._chunks = self._stream_chunks()
+
+    @property
+    def name(self):
+        return getattr(self._file, 'name', '')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buf = memoryview(chunk)
+        size = min(len(b), len(self._buf))
+        b[:size] = self._buf[:size]
+        self._buf = self._buf[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            for i in self._jobs:
+                i.cancel()
+            if self._own_executor is not None:
+                self._own_executor.shutdown()
+            if self._thread is not None:
+                # unblock the inflate thread so it can see the stop signal
+                while self._thread.is_alive():
+                    try:
+                        self._queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            self._file.close()
+        super().close()
+
+    def _bgzf_jobs(self):
+        """
+        Read BGZF blocks from input, grouped into jobs
+        """
+        read = self._file.read
+        blocks = []
+        while True:
+            header = read(BGZF_HEADER_SIZE)
+            if not header:
+                break
+            size = get_bgzf_block_size(header)
+            if size is None:
+                raise OSError('Not a BGZF block in {}: {}'
+                              ''.format(self.name, header))
+            data = read(size - BGZF_HEADER_SIZE)
+            if len(data) < size - BGZF_HEADER_SIZE:
+                raise EOFError('Compressed file ended before the '
+                               'end-of-stream marker was reached: {}'
+                               ''.format(self.name))
+            blocks.append(header + data)
+            if len(blocks) == BGZF_JOB_BLOCKS:
+                yield blocks
+                blocks = []
+        if blocks:
+            yield blocks
+
+    def _bgzf_chunks(self, executor, max_jobs):
+        """
+        Get decompressed data in order while keeping the pool busy
+        """
+        jobs = self._jobs
+        for blocks in self._bgzf_jobs():
+            jobs.append(executor.submit(inflate_blocks, blocks))
+            if len(jobs) >= max_jobs:
+                yield jobs.popleft().result()
+        while jobs:
+            yield jobs.popleft().result()
+
+    def _stream_chunks(self):
+        """
+        Get decompressed data from the inflate thread
+        """
+        self._queue = queue.Queue(maxsize=READ_AHEAD)
+        self._thread = threading.Thread(target=self._inflate, daemon=True)
+        self._thread.start()
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def _inflate(self):
+        """
+        Decompress gzip data, run by the inflate thread
+
+        Output goes to the queue, None marks the end of the data.  Any
+        exception is passed on via the queue, too.
+        """
+        put = self._queue.put
+        try:
+            inflater = Inflater()
+            while not self._stop.is_set():
+                data = self._file.read(READ_SIZE)
+                if not data:
+                    break
+                for chunk in inflater.decompress(data):
+                    put(chunk)
+            if inflater.in_member and not self._stop.is_set():
+                raise EOFError('Compressed file ended before the '
+                               'end-of-stream marker was reached: {}'
+                               ''.format(self.name))
+        except Exception as e:
+            put(e)
+        else:
+            put(None)
+
+
+class BgzfWriter(io.BufferedIOBase):
+    """
+    Writer compressing data into BGZF blocks
+
+    Data is collected into jobs of several blocks which are compressed by a
+    thread pool and written in order.  Closing the writer appends the BGZF
+    end-of-file marker.
+
+    :param file: Path or file name, or a file object opened in binary mode,
+                 e.g. sys.stdout.buffer.  A file object passed in is flushed
+                 but not closed when the writer is closed.
+    :param int level: zlib compression level, 1 to 9
+    :param int threads: Number of compression threads, by default the number
+                        of available CPUs.  Ignored if an executor is given.
+    :param executor: Optional concurrent.futures.ThreadPoolExecutor object to
+                     compress blocks, e.g. shared between writers.
+    """
+    def __init__(self, file, level=DEFAULT_COMPRESS_LEVEL, threads=None,
+                 executor=None):
+        super().__init__()
+        if isinstance(file, (str, Path)):
+            self._file = open(str(file), 'wb')
+            self._close_file = True
+        else:
+            self._file = file
+            self._close_file = False
+        self.level = level
+        self._buf = bytearray()
+        self._jobs = deque()
+        self._own_executor = None
+        self._finished = False
+        self._job_size = BGZF_JOB_BLOCKS * BGZF_DATA_SIZE
+
+        if threads is None:
+            threads = get_num_cpus()
+        if executor is None and threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=threads)
+            self._own_executor = executor
+        self._executor = executor
+        self._max_jobs = 4 * threads
+
+    @property
+    def name(self):
+        return getattr(self._file, 'name', '')
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buf += b
+        if len(self._buf) >= self._job_size:
+            size = len(self._buf) - len(self._buf) % self._job_size
+            for start in range(0, size, self._job_size):
+                self._submit(bytes(self._buf[start:start + self._job_size]))
+            del self._buf[:size]
+        return len(b)
+
+    def _submit(self, data):
+        """
+        Compress data, in the pool if there is one, and write finished jobs
+        """
+        if self._executor is None:
+            self._file.write(deflate_blocks(data, self.level))
+            return
+        self._jobs.append(self._executor.submit(deflate_blocks, data,
+                                                self.level))
+        while len(self._jobs) > self._max_jobs:
+            self._file.write(self._jobs.popleft().result())
+
+    def flush(self):
+        """
+        Compress and write all data so far
+
+        Each flush ends the current block, so flushing often makes the
+        compression worse.
+        """
+        if self.closed or self._finished:
+            return
+        if self._buf:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        while self._jobs:
+            self._file.write(self._jobs.popleft().result())
+        self._file.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+                self._file.write(BGZF_EOF)
+                self._file.flush()
+            finally:
+                self._finished = True
+                for i in self._jobs:
+                    i.cancel()
+                if self._own_executor is not None:
+                    self._own_executor.shutdown()
+                if self._close_file:
+                    self._file.close()
+        super().close()
+
+
+def open_output(file, compress=False, level=DEFAULT_COMPRESS_LEVEL,
+                threads=None):
+    """
+    Open FASTA/FASTQ output, optionally BGZF-compressed
+
+    :param file: Path or file name, or a file object opened in binary mode
+    :param bool compress: Compress the output if True
+    :param int level: Compression level
+    :param int threads: Number of compression threads
+
+    :return: A binary file object, a file object passed in is returned as-is
+             if output is not to be compressed.
+    """
+    if compress:
+        return BgzfWriter(file, level=level, threads=threads)
+    if isinstance(file, (str, Path)):
+        return open(str(file), 'wb')
+    return file
+
+
+def add_compress_arguments(argp):
+    """
+    Add the --compress and --compress-level options to an argument parser
+    """
+    argp.add_argument(
+        '--compress',
+        action='store_true',
+        help='Write gzip-compressed output, in BGZF format.  A .gz suffix is '
+             'added to derived output file names.',
+    )
+    argp.add_argument(
+        '--compress-level',
+        metavar='LEVEL',
+        type=int,
+        choices=range(1, 10),
+        default=DEFAULT_COMPRESS_LEVEL,
+        help='Compression level for --compress, from 1 (fastest) to 9 '
+             '(best), the default is {}.'.format(DEFAULT_COMPRESS_LEVEL),
+    )
+
+
+def compressed_path(path, compress=True):
+    """
+    Get path with .gz suffix added if output is compressed
+    """
+    path = Path(path)
+    if compress:
+        return path.with_name(path.name + '.gz')
+    return path
+
+
+def is_gzip(file):
+    """
+    Check if binary file object with peek() support starts with gzip magic
+    """
+    return file.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC
+
+
+def get_uncompressed_size(path, inflate=True):
+    """
+    Get the size of the data in a possibly gzip-compressed file
+
+    For uncompressed files this is the file size.  For BGZF the sizes stored
+    in the trailer of each block are added up, which needs only a few bytes
+    read per block.  Other gzip data must be decompressed, as the size in the
+    gzip trailer is only that of the last member and modulo 4 GiB.
+
+    :param Path path: The file
+    :param bool inflate: If False, return None instead of decompressing.
+    :return: The size in bytes
+    """
+    with open(str(path), 'rb') as file:
+        if not is_gzip(file):
+            return os.fstat(file.fileno()).st_size
+
+        total = 0
+        while True:
+            header = file.read(BGZF_HEADER_SIZE)
+            if not header:
+                return total
+            size = get_bgzf_block_size(header)
+            if size is None:
+                break
+            file.seek(size - BGZF_HEADER_SIZE - 4, io.SEEK_CUR)
+            isize = file.read(4)
+            if len(isize) < 4:
+                raise EOFError('Compressed file ended before the '
+                               'end-of-stream marker was reached: {}'
+                               ''.format(path))
+            total += struct.unpack('<I', isize)[0]
+
+        if not inflate:
+            return None
+        file.seek(0)
+        reader = GzipReader(file, threads=1)
+        buf = bytearray(BUFFER_SIZE)
+        total = 0
+        while True:
+            size = reader.readinto(buf)
+            if not size:
+                return total
+            total += size
+
+
+def open_reads(file, threads=None, executor=None):
+    """
+    Open FASTA/FASTQ input, transparently decompressing gzip data
+
+    Compression is detected by the data, not by the file name.
+
+    :param file: Path or file name, or a file object opened in binary mode,
+                 e.g. sys.stdin.buffer
+    :param int threads: Number of threads for decompression, by default the
+                        number of available CPUs.
+    :param executor: Optional ThreadPoolExecutor for decompression
+
+    :return: A binary file object that supports peek(), readline() etc.
+    """
+    if isinstance(file, (str, Path)):
+        file = open(str(file), 'rb')
+    elif not hasattr(file, 'peek'):
+        file = io.BufferedReader(file)
+
+    if not is_gzip(file):
+        return file
+
+    raw = GzipReader(file, threads=threads, executor=executor)
+    return io.BufferedReader(raw, buffer_size=BUFFER_SIZE)
+
+
+def uncompressed_path(path):
+    """
+    Get path without any .gz suffix
+    """
+    path = Path(path)
+    if path.suffix == '.gz':
+        return path.with_suffix('')
+    return path
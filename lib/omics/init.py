@@ -25,7 +25,6 @@ convenience feature and not necessary to run any of the omics tools.
 from pathlib import Path
 from string import Template
 
-from omics import db
 from omics import OMICS_DIR, CONFIG_FILE, CONF_SECTION_PROJECT, get_argparser
 
 empty_conf_template = """\
@@ -103,13 +102,24 @@ def get_argp():
         help='Optional project name, by default, a project name will be '
              'derived from the project directory',
     )
+    argp.add_argument(
+        '--wal',
+        action='store_true',
+        help='Put the project database into sqlite\'s WAL journal mode, '
+             'which lets readers and writers access it concurrently.  This '
+             'does not work with network file systems such as NFS, for '
+             'which the default journal mode is kept.',
+    )
     return argp
 
 
 def main(argv=None):
+    # django is heavy, omics.db imports it only when migrations are due
+    from omics import db
+
     args = get_argp().parse_args(argv)
     path, exists = init(path=args.directory, name=args.name)
-    db.setup(db_path=path)
+    db.init_db(db_path=path, wal=args.wal)
     if exists:
         print('Reinitialized existing omics project in {}'.format(path))
     else:
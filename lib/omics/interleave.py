@@ -16,74 +16,34 @@
 # with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
-from enum import Enum
+from itertools import chain
 from pathlib import Path
 import sys
 
 from . import get_argparser
-
-
-FileFormat = Enum('FileFormat', 'fasta fastq')
-
-format_info = {
-    FileFormat.fasta: {'lines': 2, 'headchar': '>'},
-    FileFormat.fastq: {'lines': 4, 'headchar': '@'},
-}
+from .gzio import add_compress_arguments, open_output, open_reads
+from .seqio import FileFormat, RecordReader, read_paired
 
 
 def record(file, fmt=FileFormat.fastq):
     """
     Given a fasta or fastq file return iterator over sequences
 
-    Implements the grouper recipe from collections doc
+    The sequence records are memoryviews of the whole record, i.e. all lines
+    including the newlines.
     """
-    args = [iter(file)] * format_info[fmt]['lines']
-    return zip(*args)
+    for batch in RecordReader(file, fmt=fmt):
+        yield from batch
 
 
 def interleave(fwd_in, rev_in, check=False):
     """
     Interleave reads from two files
+
+    Returns an iterator over chunks of the interleaved data.
     """
-    fmt = None
-    for file in [fwd_in, rev_in]:
-        try:
-            fmt_indicator = file.peek(1)[0]
-        except IndexError:
-            raise RuntimeError('File empty?: {}'.format(file.name))
-
-        for _fmt, info in format_info.items():
-            if fmt_indicator == ord(info['headchar']):
-                if fmt is None:
-                    fmt = _fmt
-                else:
-                    if fmt != _fmt:
-                        raise RuntimeError(
-                            'Fileformat mismatch: {} is {} but {} is {}.'
-                            ''.format(fwd_in.name, fmt.name, rev_in.name,
-                                      _fmt.name))
-                break
-        if fmt is None:
-            raise RuntimeError('Bad file format: {}: expected'
-                               ' > or @ as first character but got {}'
-                               ''.format(file.name, chr(fmt_indicator)))
-
-    for fwd_rec, rev_rec in zip(record(fwd_in, fmt=fmt),
-                                record(rev_in, fmt=fmt)):
-        if check:
-            fwd_rec = list(fwd_rec)
-            rev_rec = list(rev_rec)
-            for rec in [fwd_rec, rev_rec]:
-                if rec[0][0] != ord(format_info[fmt]['headchar']):
-                    raise RuntimeError('Expected header: {}'.format(rec[0]))
-            if fmt is FileFormat.fastq:
-                for rec in [fwd_rec, rev_rec]:
-                    if rec[2] != b'+\n':
-                        raise RuntimeError('Expected + separator line: {}'
-                                           ''.format(rec[2]))
-        for rec in [fwd_rec, rev_rec]:
-            for line in rec:
-                yield line
+    for fwd_batch, rev_batch in read_paired(fwd_in, rev_in, check=check):
+        yield b''.join(chain.from_iterable(zip(fwd_batch, rev_batch)))
 
 
 def main(argv=None, namespace=None):
@@ -91,7 +51,6 @@ def main(argv=None, namespace=None):
         prog=__loader__.name.replace('.', ' '),
         description=__doc__,
         project_home=False,
-        threads=False,
     )
     argp.add_argument('forward_reads', type=argparse.FileType())
     argp.add_argument('reverse_reads', type=argparse.FileType())
@@ -107,6 +66,7 @@ def main(argv=None, namespace=None):
         help='Path to output file.  If not provided output is written to '
              'stdout.',
     )
+    add_compress_arguments(argp)
     args = argp.parse_args(args=argv, namespace=namespace)
 
     args.forward_reads.close()
@@ -115,20 +75,26 @@ def main(argv=None, namespace=None):
     fwd_path = Path(args.forward_reads.name)
     rev_path = Path(args.reverse_reads.name)
 
-    fwd_in = fwd_path.open('rb')
-    rev_in = rev_path.open('rb')
+    fwd_in = open_reads(fwd_path, threads=args.threads)
+    rev_in = open_reads(rev_path, threads=args.threads)
 
     if args.output is None:
         out = sys.stdout.buffer
     else:
-        try:
-            out = Path(args.output).open('wb')
-        except Exception as e:
-            argp.error('Failed to open file for writing: {}: {}: {}'
-                       ''.format(args.output, e.__class__.__name__, e))
+        out = Path(args.output)
+    try:
+        out = open_output(out, args.compress, args.compress_level,
+                          threads=args.threads)
+    except Exception as e:
+        argp.error('Failed to open file for writing: {}: {}: {}'
+                   ''.format(args.output, e.__class__.__name__, e))
 
     for i in interleave(fwd_in, rev_in, check=args.check):
         out.write(i)
+    if out is sys.stdout.buffer:
+        out.flush()
+    else:
+        out.close()
 
 
 if __name__ == '__main__':
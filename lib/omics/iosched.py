@@ -0,0 +1,202 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Scheduling of I/O jobs per storage device
+
+Jobs are grouped by the devices, as given by st_dev, of the files they read
+and write.  A job is handed to the executor only when each of its devices
+has a free slot, so worker threads never sit waiting on a busy device while
+jobs for idle devices queue up behind them.  Optionally, the data rate per
+device is capped.
+"""
+
+from collections import Counter
+from concurrent.futures import Future
+from functools import partial
+import os
+from pathlib import Path
+import threading
+from time import perf_counter, sleep
+
+
+class DeviceStats():
+    """
+    Bytes moved on a device and its rate limit state
+    """
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.first_start = None
+        self.last_end = None
+        self.next_time = 0  # earliest time to move more data if rate capped
+        self.lock = threading.Lock()
+
+    @property
+    def seconds(self):
+        if self.first_start is None or self.last_end is None:
+            return 0
+        return self.last_end - self.first_start
+
+    @property
+    def rate(self):
+        """
+        Achieved rate in bytes per second while jobs were running
+        """
+        if not self.seconds:
+            return 0
+        return self.bytes / self.seconds
+
+
+class IOScheduler():
+    """
+    Run I/O jobs in an executor with per-device limits
+
+    :param executor: A concurrent.futures.Executor object
+    :param int max_jobs: Maximum number of concurrently running jobs per
+                         device, None for no limit
+    :param float bandwidth: Maximum rate per device in bytes per second, None
+                            for no limit.  Jobs must report the data they
+                            move to the throttle passed to them.
+    """
+    def __init__(self, executor, max_jobs=None, bandwidth=None):
+        self.executor = executor
+        self.max_jobs = max_jobs
+        self.bandwidth = bandwidth
+        self.devices = {}
+        self._active = Counter()
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def get_device(self, path):
+        """
+        Get device of a file, or of its directory if it does not exist yet
+        """
+        path = Path(path)
+        while not path.exists() and path != path.parent:
+            path = path.parent
+        dev = path.stat().st_dev
+        with self._lock:
+            if dev not in self.devices:
+                self.devices[dev] = DeviceStats(
+                    '{}:{} ({})'.format(os.major(dev), os.minor(dev), path)
+                )
+        return dev
+
+    def submit(self, paths, fn, *args, throttle=False, **kwargs):
+        """
+        Schedule a job
+
+        :param list paths: The files the job reads or writes
+        :param fn: The job function
+        :param bool throttle: If True, a function is passed to the job as
+                              keyword argument throttle that the job must
+                              call with the number of bytes after each piece
+                              of data it moves.
+        :return: A Future for the job's result
+        """
+        devices = frozenset(self.get_device(i) for i in paths)
+        if throttle:
+            kwargs['throttle'] = partial(self.charge, devices)
+        future = Future()
+        with self._lock:
+            self._pending.append((devices, future, fn, args, kwargs))
+            self._dispatch()
+        return future
+
+    def _dispatch(self):
+        """
+        Start pending jobs with free slots on all their devices
+
+        Must be called with the lock held.
+        """
+        pending = []
+        for job in self._pending:
+            devices = job[0]
+            if self.max_jobs is None \
+                    or all(self._active[i] < self.max_jobs for i in devices):
+                for i in devices:
+                    self._active[i] += 1
+                self._start(*job)
+            else:
+                pending.append(job)
+        self._pending = pending
+
+    def _start(self, devices, future, fn, args, kwargs):
+        try:
+            fut = self.executor.submit(self._run, devices, fn, args, kwargs)
+        except RuntimeError as e:
+            # executor was shut down
+            future.set_exception(e)
+            return
+        fut.add_done_callback(partial(self._finish, devices, future))
+
+    def _run(self, devices, fn, args, kwargs):
+        start = perf_counter()
+        for i in devices:
+            stats = self.devices[i]
+            with stats.lock:
+                if stats.first_start is None:
+                    stats.first_start = start
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            end = perf_counter()
+            for i in devices:
+                stats = self.devices[i]
+                with stats.lock:
+                    stats.last_end = max(stats.last_end or end, end)
+
+    def _finish(self, devices, future, fut):
+        with self._lock:
+            for i in devices:
+                self._active[i] -= 1
+            self._dispatch()
+        if fut.exception() is not None:
+            future.set_exception(fut.exception())
+        else:
+            future.set_result(fut.result())
+
+    def charge(self, devices, size):
+        """
+        Account for data moved by a job, waiting if a rate cap is reached
+
+        :param devices: The job's devices
+        :param int size: Number of bytes
+        """
+        delay = 0
+        for i in devices:
+            stats = self.devices[i]
+            with stats.lock:
+                stats.bytes += size
+                if self.bandwidth:
+                    now = perf_counter()
+                    start = max(now, stats.next_time)
+                    stats.next_time = start + size / self.bandwidth
+                    delay = max(delay, start - now)
+        if delay:
+            sleep(delay)
+
+    def report(self):
+        """
+        Get lines describing the achieved rate per device
+        """
+        return [
+            '{}: {:.1f} MB in {:.1f} s, {:.1f} MB/s'
+            ''.format(i.name, i.bytes / 1e6, i.seconds, i.rate / 1e6)
+            for i in self.devices.values()
+        ]
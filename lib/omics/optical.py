@@ -0,0 +1,185 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Detection of optical duplicates
+
+Optical duplicates are replicated reads whose clusters lie close to each
+other on the same tile of the flowcell.  The reads of each group of
+replicates are located by a grid per tile with cells as wide as the
+distance, so only reads in the neighboring cells need to be looked at, and
+those are found by binary searches, no pairs of reads are compared.
+As with Picard's MarkDuplicates, the distance is the larger of the distances
+along x and along y, in pixels.
+"""
+
+from . import lazy_import
+
+numpy = lazy_import('numpy')
+
+# bits of a grid cell key for each of the cell coordinates
+CELL_BITS = 16
+
+
+def find_optical(keys, tiles, xs, ys, distance):
+    """
+    Find reads close to a read with the same key on the same tile
+
+    :param keys: numpy array of the read's hashes
+    :param tiles: numpy array of the tile numbers
+    :param xs: numpy array of the x coordinates
+    :param ys: numpy array of the y coordinates
+    :param int distance: Maximum distance in pixels
+    :return: numpy bool array, True for reads with a close neighbor
+    """
+    near = numpy.zeros(len(keys), dtype=bool)
+    if not len(keys):
+        return near
+
+    # only replicated reads can have neighbors
+    _, group, counts = numpy.unique(keys, return_inverse=True,
+                                    return_counts=True)
+    candidates = numpy.flatnonzero(counts[group] > 1)
+    if not len(candidates):
+        return near
+
+    # number the reads of each group on each tile, each then gets a grid of
+    # its own
+    group = group[candidates]
+    tile = tiles[candidates]
+    order = numpy.lexsort((tile, group))
+    new = numpy.ones(len(order), dtype=bool)
+    new[1:] = (group[order][1:] != group[order][:-1]) \
+        | (tile[order][1:] != tile[order][:-1])
+    grid = numpy.empty(len(order), dtype=numpy.int64)
+    grid[order] = numpy.cumsum(new) - 1
+    del group, tile, order, new
+
+    near[candidates] = find_near(grid, xs[candidates], ys[candidates],
+                                 distance)
+    return near
+
+
+def find_near(grids, xs, ys, distance):
+    """
+    Find close reads on the same grid
+
+    No pairs of reads are compared.  The reads of each cell are sorted by x,
+    then the reads of a neighboring cell within the distance along x are a
+    range of the cell, and whether any of them is within the distance along
+    y is told by the minimum or maximum y over the range.  The minima and
+    maxima over the ranges starting or ending at a cell's boundary are
+    precomputed for all reads at once, so the time taken grows only as
+    n log n, even for dense clusters.
+
+    :param grids: numpy array of the number of each read's grid, numbers
+                  must be below 2 ** 32
+    :param xs: numpy array of the non-negative x coordinates
+    :param ys: numpy array of the non-negative y coordinates
+    :return: numpy bool array, True for reads with a close neighbor
+    """
+    width = max(distance, 1)
+    cell_x = xs // width
+    cell_y = ys // width
+    if cell_x.max(initial=0) >= 1 << CELL_BITS \
+            or cell_y.max(initial=0) >= 1 << CELL_BITS:
+        raise ValueError('Coordinates too large for distance {}'
+                         ''.format(distance))
+    cells = (grids.astype(numpy.uint64) << numpy.uint64(2 * CELL_BITS)
+             | cell_x.astype(numpy.uint64) << numpy.uint64(CELL_BITS)
+             | cell_y.astype(numpy.uint64))
+    order = numpy.lexsort((xs, cells))
+    cells = cells[order]
+    cell_x = cell_x[order]
+    cell_y = cell_y[order]
+    xs = xs[order].astype(numpy.int64)
+    ys = ys[order].astype(numpy.int64)
+
+    # reads sharing a cell are less than the cell width apart along both
+    # axes, so each read with another one in its cell is near
+    near = numpy.zeros(len(cells), dtype=bool)
+    same = cells[1:] == cells[:-1]
+    near[1:] |= same
+    near[:-1] |= same
+
+    # number the cells, then offsetting the values of each cell by a
+    # multiple of its number beyond the values' range gives keys sorted
+    # across cells and makes the running minima and maxima restart at each
+    # cell
+    cell_num = numpy.zeros(len(cells), dtype=numpy.int64)
+    numpy.cumsum(~same, out=cell_num[1:])
+    del same
+    span_x = xs.max() + distance + 1
+    x_keys = cell_num * span_x + xs
+    shift = cell_num * (ys.max() + 1)
+    head_min = numpy.minimum.accumulate(ys - shift) + shift
+    head_max = numpy.maximum.accumulate(ys + shift) - shift
+    tail_min = numpy.minimum.accumulate((ys + shift)[::-1])[::-1] - shift
+    tail_max = numpy.maximum.accumulate((ys - shift)[::-1])[::-1] + shift
+    del shift
+
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            if not dx and not dy:
+                continue
+            valid = ((cell_x + dx >= 0) & (cell_x + dx < 1 << CELL_BITS)
+                     & (cell_y + dy >= 0) & (cell_y + dy < 1 << CELL_BITS))
+            reads = numpy.flatnonzero(valid & ~near)
+            target = (
+                cells[reads].astype(numpy.int64)
+                + (dx << CELL_BITS) + dy
+            ).astype(numpy.uint64)
+            lo = numpy.searchsorted(cells, target, side='left')
+            hi = numpy.searchsorted(cells, target, side='right')
+            found = lo < hi
+            reads, lo, hi = reads[found], lo[found], hi[found]
+            if not len(reads):
+                continue
+            x = xs[reads]
+            y = ys[reads]
+
+            # the range of the neighboring cell within the distance along x,
+            # for dx == 0 that is the whole cell
+            if dx > 0:
+                key = cell_num[lo] * span_x + x + distance
+                hi = numpy.minimum(
+                    numpy.searchsorted(x_keys, key, side='right'), hi)
+            elif dx < 0:
+                key = cell_num[lo] * span_x + numpy.maximum(x - distance, 0)
+                lo = numpy.maximum(
+                    numpy.searchsorted(x_keys, key, side='left'), lo)
+            found = lo < hi
+            reads, lo, hi, y = reads[found], lo[found], hi[found], y[found]
+
+            # for dy == 0 the whole cell is within the distance along y
+            if dx < 0:
+                # range ends at the cell's end
+                if dy > 0:
+                    found = tail_min[lo] <= y + distance
+                elif dy < 0:
+                    found = tail_max[lo] >= y - distance
+            else:
+                # range starts at the cell's start
+                if dy > 0:
+                    found = head_min[hi - 1] <= y + distance
+                elif dy < 0:
+                    found = head_max[hi - 1] >= y - distance
+            near[reads[found] if dy else reads] = True
+
+    result = numpy.empty(len(near), dtype=bool)
+    result[order] = near
+    return result
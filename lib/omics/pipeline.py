@@ -0,0 +1,367 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Run a series of omics commands in a single python process
+
+Commands are read from the given file or from stdin, one per line, and
+written as they would be passed to the omics command, e.g.:
+
+    derep --check fwd.fastq rev.fastq --out-dir tmp
+    separate-interleaved -f fwd.good.fastq -r rev.good.fastq int.fastq
+
+omics.* modules and python scripts like separate-interleaved run inside this
+process, other commands run as sub-process.  Modules stay imported between
+steps so each step saves the interpreter start-up.  Empty lines and lines
+starting with # are ignored.  A line "cd DIR" changes the working directory
+for the following steps.  Standard input and output of a step can be
+redirected with "< FILE" and "> FILE" at the end of the line, where a FILE of
+the form @NAME refers to an in-memory stream that can be read by a later
+step, e.g.:
+
+    interleave fwd.fastq rev.fastq > @int
+    fastq2fasta < @int > int.fasta
+
+When reading commands from stdin the process can be used as a persistent
+worker, e.g. as bash coproc, in which case the --status option can be used to
+report each finished step.
+"""
+
+import argparse
+from importlib import import_module
+import io
+import os
+from pathlib import Path
+import runpy
+import shlex
+import shutil
+import subprocess
+import sys
+from tempfile import SpooledTemporaryFile
+from time import perf_counter
+
+from . import (OmicsArgParser, DEFAULT_VERBOSITY, SCRIPT_PREFIX,
+               get_command_info)
+
+# in-memory streams are spilled to disk beyond this size
+STREAM_MAX_MEM = 64 * 1024 * 1024
+
+
+class StepFailed(Exception):
+    """
+    Raised when a pipeline step fails
+    """
+    def __init__(self, status, msg=''):
+        super().__init__(msg or 'exit status {}'.format(status))
+        self.status = status
+
+
+def get_runner(command, script_dir=None):
+    """
+    Find out how to run a command
+
+    :param str command: The omics command name or name of a script
+    :param Path script_dir: Directory with the omics scripts
+
+    :return: A tuple of kind and target, where kind is one of 'module',
+             'python' or 'exec' and target is the main function, or the path
+             to a python script or other executable.
+    """
+    info = get_command_info(command)
+    if info is None or info['module'] is not None:
+        if info is None:
+            module_name = __package__ + '.' + command.replace('-', '_')
+        else:
+            module_name = info['module']
+        try:
+            module = import_module(module_name)
+        except ImportError as e:
+            if e.name != module_name:
+                # module exists but failed to import
+                raise
+        else:
+            if callable(getattr(module, 'main', None)):
+                return 'module', module.main
+
+    path = None
+    for name in [SCRIPT_PREFIX + command, command]:
+        if script_dir is not None and (script_dir / name).is_file():
+            path = script_dir / name
+        else:
+            path = shutil.which(name)
+        if path is not None:
+            break
+    else:
+        raise FileNotFoundError('Not a valid omics command: {}'
+                                ''.format(command))
+
+    path = Path(path)
+    with path.open('rb') as f:
+        shebang = f.readline()
+    if shebang.startswith(b'#!') and b'python3' in shebang:
+        return 'python', path
+    return 'exec', path
+
+
+def parse_step(line):
+    """
+    Split a pipeline line into command line and redirections
+
+    :return: Tuple of the argument list, stdin and stdout targets, each
+             target is None if not redirected.
+    """
+    argv = shlex.split(line)
+    stdin = stdout = None
+    while len(argv) >= 2 and argv[-2] in ['<', '>']:
+        if argv[-2] == '<':
+            stdin = argv[-1]
+        else:
+            stdout = argv[-1]
+        del argv[-2:]
+    return argv, stdin, stdout
+
+
+class StreamView(io.RawIOBase):
+    """
+    Raw file object through which a step reads or writes a pipeline's stream
+
+    Closing the view, e.g. when a step or some wrapper made by the step
+    closes its stdin or stdout, leaves the underlying stream open, which the
+    pipeline owns.  Reading is buffered by the step's stdin, so it supports
+    peek() even if the stream itself does not.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def fileno(self):
+        return self._stream.fileno()
+
+    def readinto(self, b):
+        data = self._stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def write(self, b):
+        self._stream.write(bytes(b))
+        return len(b)
+
+
+class Pipeline():
+    """
+    Runs commands in-process, keeping track of in-memory streams
+    """
+    def __init__(self, script_dir=None, verbosity=DEFAULT_VERBOSITY):
+        self.script_dir = script_dir
+        self.verbosity = verbosity
+        self.streams = {}
+
+    def open_input(self, target):
+        if target.startswith('@'):
+            try:
+                stream = self.streams.pop(target)
+            except KeyError:
+                raise RuntimeError('No such stream: {}'.format(target))
+            stream.seek(0)
+            return stream
+        return open(target, 'rb')
+
+    def open_output(self, target):
+        if target.startswith('@'):
+            stream = SpooledTemporaryFile(max_size=STREAM_MAX_MEM)
+            self.streams[target] = stream
+            return stream
+        return open(target, 'wb')
+
+    def run(self, line):
+        """
+        Run a single pipeline step
+
+        :param str line: The step's line from the pipeline
+        :raise StepFailed: If the command exits with non-zero status
+        """
+        argv, stdin, stdout = parse_step(line)
+        if not argv:
+            return
+
+        if argv[0] == 'cd':
+            if len(argv) != 2:
+                raise RuntimeError('cd takes exactly one argument')
+            os.chdir(argv[1])
+            return
+
+        kind, target = get_runner(argv[0], self.script_dir)
+        if self.verbosity > DEFAULT_VERBOSITY:
+            print('[pipeline] {} ({}): {}'.format(argv[0], kind, line),
+                  file=sys.stderr)
+
+        infile = outfile = None
+        try:
+            if stdin is None:
+                infile = open(os.devnull, 'rb')
+            else:
+                infile = self.open_input(stdin)
+            if stdout is not None:
+                outfile = self.open_output(stdout)
+
+            if kind == 'exec':
+                sys.stdout.flush()
+                p = subprocess.run(
+                    [str(target)] + argv[1:],
+                    stdin=infile,
+                    stdout=sys.stdout if outfile is None else outfile,
+                )
+                status = p.returncode
+            else:
+                status = self._run_in_process(kind, target, argv, infile,
+                                              outfile)
+        finally:
+            # input streams are used up and get closed too
+            if infile is not None:
+                infile.close()
+            if outfile is not None and not stdout.startswith('@'):
+                outfile.close()
+
+        if status:
+            raise StepFailed(status)
+
+    def _run_in_process(self, kind, target, argv, infile, outfile):
+        """
+        Run main function or python script with redirected stdio
+
+        :return: Exit status
+        """
+        saved = sys.argv, sys.stdin, sys.stdout
+        stdin = io.TextIOWrapper(io.BufferedReader(StreamView(infile)))
+        stdout = None
+        if outfile is not None:
+            sys.stdout.flush()
+            stdout = io.TextIOWrapper(io.BufferedWriter(StreamView(outfile)),
+                                      write_through=True)
+        try:
+            sys.stdin = stdin
+            if stdout is not None:
+                sys.stdout = stdout
+            if kind == 'module':
+                sys.argv = ['omics ' + argv[0]] + argv[1:]
+                target(argv[1:])
+            else:
+                sys.argv = [str(target)] + argv[1:]
+                runpy.run_path(str(target), run_name='__main__')
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+        else:
+            status = 0
+        finally:
+            sys.argv, sys.stdin, sys.stdout = saved
+            try:
+                # flushes the output, a step may have closed its stdio
+                # already, but not the pipeline's streams
+                if stdout is not None:
+                    stdout.close()
+            finally:
+                stdin.close()
+        return status
+
+
+def main(argv=None, namespace=None):
+    argp = OmicsArgParser(
+        prog=__loader__.name.replace('.', ' '),
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        threads=False,
+    )
+    argp.add_argument(
+        'pipeline',
+        nargs='?',
+        type=argparse.FileType(),
+        default=sys.stdin,
+        help='File with one command per line, by default commands are read '
+             'from stdin.',
+    )
+    argp.add_argument(
+        '--script-dir',
+        metavar='PATH',
+        default=None,
+        help='Path to directory containing the omics scripts, by default '
+             'scripts are searched for in the PATH',
+    )
+    argp.add_argument(
+        '-k', '--keep-going',
+        action='store_true',
+        help='Continue with the next step if a step fails.  By default the '
+             'pipeline stops at the first failure.',
+    )
+    argp.add_argument(
+        '--status',
+        metavar='FILE',
+        type=argparse.FileType('w'),
+        default=None,
+        help='Write a line with step number, exit status, run time, and the '
+             'command to given file after each step.  This can be a FIFO '
+             'when running as persistent worker.',
+    )
+    args = argp.parse_args(args=argv, namespace=namespace)
+
+    script_dir = None if args.script_dir is None else Path(args.script_dir)
+    pipeline = Pipeline(script_dir=script_dir, verbosity=args.verbosity)
+
+    failed = 0
+    for num, line in enumerate(args.pipeline, start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        start = perf_counter()
+        try:
+            pipeline.run(line)
+        except Exception as e:
+            if args.traceback and not isinstance(e, StepFailed):
+                raise
+            status = getattr(e, 'status', 1)
+            print('[pipeline] (error) step {}: {}: {}: {}'
+                  ''.format(num, line, e.__class__.__name__, e),
+                  file=sys.stderr)
+        else:
+            status = 0
+
+        if args.status is not None:
+            print(num, status, '{:.3f}'.format(perf_counter() - start), line,
+                  sep='\t', file=args.status, flush=True)
+
+        if status:
+            failed += 1
+            if not args.keep_going:
+                sys.exit(status)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
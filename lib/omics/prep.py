@@ -22,19 +22,35 @@ prep copies, renames, and (optionally) decompresses your (gzipped) fastq
 files to ensure a standardized setup for further processing.
 """
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import gzip
-from itertools import groupby, zip_longest
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import groupby
+import json
+import os
 from pathlib import Path
 import re
-import shutil
 import sys
+import threading
+from time import perf_counter
 
 from . import get_argparser, DEFAULT_VERBOSITY
+from .checksum import ALGORITHMS, HashingWriter, Verifier, read_checksum_file
+from .filecopy import (COPY_METHODS, OffsetWriter, copy_fileobj,
+                       copy_to_offset, link_file)
+from .gzio import (GZIP_MAGIC, Inflater, get_uncompressed_size, is_gzip,
+                   open_reads)
+from .iosched import IOScheduler
 from omics.read_counts import make_output as write_read_counts
+from .seqio import FileFormat, RecordCounter, count_records
 
 READ_COUNT_FILE_NAME = 'read_count.tsv'
 
+# record of prep's work in the destination directory, for --resume
+MANIFEST_FILE_NAME = '.prep_manifest.json'
+
+# buffer size for copying
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
 FORWARD_READS_FILE = 'fwd.fastq'
 REVERSE_READS_FILE = 'rev.fastq'
 
@@ -56,6 +72,112 @@ class FileNameDoesNotMatch(Exception):
     pass
 
 
+class PrepManifest():
+    """
+    Record of the input files and the completed parts of prep's output files
+
+    The manifest is kept as JSON file and saved each time an input file is
+    done, so that an interrupted run can be resumed.  Methods may be called
+    from several threads.
+
+    :param Path path: The manifest file, loaded if it exists
+    """
+    def __init__(self, path):
+        self.path = path
+        self.outputs = {}
+        self._lock = threading.Lock()
+        if path.is_file():
+            with path.open() as f:
+                self.outputs = json.load(f)['outputs']
+
+    def _key(self, outfile):
+        """
+        Get key for output file, relative to the manifest's directory
+        """
+        outfile = outfile.resolve()
+        try:
+            return str(outfile.relative_to(self.path.parent.resolve()))
+        except ValueError:
+            return str(outfile)
+
+    @staticmethod
+    def get_input_info(path):
+        """
+        Get what identifies an input file as unchanged
+        """
+        stat = path.stat()
+        return {
+            'path': str(path.resolve()),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+
+    def start(self, outfile, series):
+        """
+        Record a new output file made from a series of input files
+        """
+        with self._lock:
+            self.outputs[self._key(outfile)] = {
+                'inputs': [self.get_input_info(i) for i in series],
+                'done': {},
+            }
+            self._save()
+
+    def get_done(self, outfile, series):
+        """
+        Get the parts of an output file recorded as done
+
+        :return: Dict mapping the index of the input file in the series to a
+                 dict with the part's offset and size in the output file and
+                 the read and base counts and checksums, if known.  Empty if
+                 the output file is unknown or if any input file changed.
+        """
+        entry = self.outputs.get(self._key(outfile))
+        if entry is None:
+            return {}
+        current = [self.get_input_info(i) for i in series]
+        recorded = [
+            {k: i[k] for k in ['path', 'size', 'mtime_ns']}
+            for i in entry['inputs']
+        ]
+        if current != recorded:
+            return {}
+        return {
+            int(k): dict(v, checksums=v.get('checksums'))
+            for k, v in entry['done'].items()
+        }
+
+    def set_done(self, outfile, index, offset, size, counts=None,
+                 checksums=None):
+        """
+        Record that an input file was completely written to the output
+
+        :param Path outfile: The output file
+        :param int index: Index of the input file in the series
+        :param int offset: Offset of the data in the output
+        :param int size: Size of the data in the output
+        :param tuple counts: Optional numbers of reads and bases
+        :param dict checksums: Optional checksums, a dict with the algorithm
+                               and the hex digests of the input file and of
+                               its data in the output
+        """
+        with self._lock:
+            self.outputs[self._key(outfile)]['done'][str(index)] = {
+                'offset': offset,
+                'size': size,
+                'counts': counts,
+                'checksums': checksums,
+            }
+            self._save()
+
+    def _save(self):
+        # replace atomically, an interrupted write must not lose the record
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w') as f:
+            json.dump({'version': 1, 'outputs': self.outputs}, f, indent=1)
+        os.replace(str(tmp), str(self.path))
+
+
 def group(files, keep_lanes=False, multi_run=False, verbosity=1):
     """
     Generate groups of raw reads files per sample
@@ -113,6 +235,8 @@ def group(files, keep_lanes=False, multi_run=False, verbosity=1):
                 key += (runid, int(m['lane']), m['dir'])
             else:
                 key += (m['dir'], runid, int(m['lane']))
+            # keep the series in order
+            key += (int(m['fnum']),)
 
         if verbosity >= DEFAULT_VERBOSITY + 2:
             print('parsed: {} -> {}'.format(x, key))
@@ -188,7 +312,9 @@ def sample_direction(filename):
 
 
 def prep(sample, files, dest=Path.cwd(), force=False, verbosity=1,
-         keep_compression=False, skip_existing=False, executor=None):
+         keep_compression=False, skip_existing=False, executor=None,
+         inflate_executor=None, count=False, copy_method='reflink',
+         manifest=None, resume=False, scheduler=None, verifier=None):
     """
     Decompress and copy files into sample directory
 
@@ -202,7 +328,28 @@ def prep(sample, files, dest=Path.cwd(), force=False, verbosity=1,
     :param bool keep_compression: Do not decompress compressed data.
     :param bool skip_existing: Do nothing if a destination file exists.
     :param executor: A concurrent.futures.Executor object.  If executor is None
-                     then all will be done single-threaded.
+                     then all will be done single-threaded.  Otherwise the
+                     files of a series are processed in parallel if their
+                     uncompressed sizes can be found without decompressing
+                     them, each written to its offset in the output file.
+    :param inflate_executor: Optional ThreadPoolExecutor object used to
+                             decompress BGZF input block-parallel.  This must
+                             not be the same as executor.
+    :param bool count: Count reads and bases while copying.
+    :param str copy_method: How to copy files that are not decompressed, one
+                            of omics.filecopy.COPY_METHODS
+    :param PrepManifest manifest: Optional manifest to record progress in
+    :param bool resume: Keep the parts of existing output files that the
+                        manifest records as done, if they pass a quick check,
+                        and only add what is missing.  force and
+                        skip_existing take precedence.
+    :param IOScheduler scheduler: Optional scheduler wrapping executor that
+                                  limits I/O per storage device
+    :param Verifier verifier: Optional omics.checksum.Verifier to checksum
+                              the input files while they are read, checking
+                              them against known checksums, and the data
+                              written to the output.  Digests are recorded in
+                              the manifest.
 
     :return: Dictionary of futures
 
@@ -237,12 +384,18 @@ def prep(sample, files, dest=Path.cwd(), force=False, verbosity=1,
                 return {}
 
             if force:
-                with i.open('wb'):
-                    # truncating
-                    pass
-            else:
+                # unlink rather than truncate, the file may be a hard link
+                # to the raw data
+                i.unlink()
+            elif not resume or manifest is None:
                 raise FileExistsError(i)
 
+    def submit(paths, fn, *args, throttle=False):
+        if scheduler is None:
+            return executor.submit(fn, *args)
+        return scheduler.submit(paths + [destdir], fn, *args,
+                                throttle=throttle)
+
     for direction, series in groupby(files, key=sample_direction):
         # a 'series' is a bunch of files that got split up, and that we need
         # to put back together in a consistent order
@@ -255,18 +408,155 @@ def prep(sample, files, dest=Path.cwd(), force=False, verbosity=1,
                              ''.format(direction))
         series = list(series)
 
-        args = (sample, outfile, series, verbosity)
+        done = {}
+        if resume and manifest is not None and outfile.is_file():
+            done = manifest.get_done(outfile, series)
+            if count:
+                # can't keep parts whose reads would need counting again
+                done = {k: v for k, v in done.items() if v['counts']}
+            if verifier is not None:
+                # nor parts without checksums, the recorded checksums of
+                # the input must pass the check now
+                done = {
+                    k: v for k, v in done.items()
+                    if v['checksums'] is not None
+                    and v['checksums']['algorithm'] == verifier.algorithm
+                }
+                for k, v in done.items():
+                    verifier.check(series[k], v['checksums']['input'])
+            done = _check_done(outfile, done)
+
+        sizes = None
+        if executor is not None and len(series) > 1:
+            sizes = _get_series_sizes(outfile, series)
+
+        if sizes is None:
+            # sequential processing can only continue after the done parts
+            # at the start of the series
+            skip = 0
+            while skip in done:
+                skip += 1
+            done = {k: v for k, v in done.items() if k < skip}
+        else:
+            offsets = [sum(sizes[:i]) for i in range(len(sizes))]
+            if any((v['offset'], v['size']) != (offsets[k], sizes[k])
+                   for k, v in done.items()):
+                done = {}
+
+        if done:
+            if verbosity > DEFAULT_VERBOSITY:
+                print('{}: resume {}: {} of {} files done'
+                      ''.format(sample, outfile, len(done), len(series)))
+            for part in done.values():
+                # pass on counts of done parts as if done now
+                fut = Future()
+                fut.set_result((str(outfile), part['counts']))
+                futures[fut] = (sample, direction)
+            if len(done) == len(series):
+                continue
+        else:
+            if outfile.is_file():
+                # left over, but can't be resumed
+                outfile.unlink()
+            if manifest is not None:
+                manifest.start(outfile, series)
+
+        progress = None
+        if manifest is not None:
+            progress = partial(manifest.set_done, outfile)
+
+        if sizes is not None:
+            with outfile.open('r+b' if done else 'wb') as f:
+                f.truncate(sum(sizes))
+            for i, (infile, offset, size) \
+                    in enumerate(zip(series, offsets, sizes)):
+                if i in done:
+                    continue
+                args = (sample, outfile, infile, offset, size, verbosity,
+                        inflate_executor, count, copy_method, progress, i,
+                        verifier)
+                futures[
+                    submit([infile], _extract_to_offset, *args, throttle=True)
+                ] = (sample, direction)
+            continue
+
+        offset = sum(i['size'] for i in done.values())
+        args = (sample, outfile, series, verbosity, inflate_executor, count,
+                copy_method, progress, skip, offset, verifier)
         if executor is None:
             _do_extract_and_copy(*args)
         else:
             futures[
-                executor.submit(_do_extract_and_copy, *args)
+                submit(series, _do_extract_and_copy, *args, throttle=True)
             ] = (sample, direction)
 
     return futures
 
 
-def _do_extract_and_copy(sample, outfile, series, verbosity):
+def _check_done(outfile, done):
+    """
+    Quickly check that done parts of an output file are really there
+
+    The output file must be large enough and each part must start like a
+    FASTQ record or gzip member and, if uncompressed, end with a newline.
+    Parts not written since the output file was created, e.g. when the
+    output was pre-sized for writing in parallel, are zeros.
+
+    :param Path outfile: Output file
+    :param dict done: Done parts as returned by PrepManifest.get_done()
+    :return: Dict of the done parts that passed the check
+    """
+    if outfile.suffix == '.gz':
+        head, tail = GZIP_MAGIC, None
+    else:
+        head, tail = b'@', b'\n'
+    good = {}
+    with outfile.open('rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        for i, part in done.items():
+            offset, size = part['offset'], part['size']
+            if offset + size > file_size:
+                continue
+            if size:
+                f.seek(offset)
+                if f.read(len(head)) != head:
+                    continue
+                if tail is not None:
+                    f.seek(offset + size - len(tail))
+                    if f.read(len(tail)) != tail:
+                        continue
+            good[i] = part
+    return good
+
+
+def _get_series_sizes(outfile, series):
+    """
+    Get the size of each file of a series as it will be in the output
+
+    Sizes of uncompressed files and BGZF files are found cheaply.  Other gzip
+    files would have to be decompressed once just to get their size and then
+    again to extract them, so a series with such files is appended
+    sequentially instead.
+
+    :return: List of sizes, or None if the series should be processed
+             sequentially.
+    """
+    sizes = []
+    for path in series:
+        if path.suffix == '.gz' and outfile.suffix != '.gz':
+            size = get_uncompressed_size(path, inflate=False)
+            if size is None:
+                return None
+        else:
+            size = path.stat().st_size
+        sizes.append(size)
+    return sizes
+
+
+def _do_extract_and_copy(sample, outfile, series, verbosity,
+                         inflate_executor=None, count=False,
+                         copy_method='reflink', progress=None, skip=0,
+                         offset=0, verifier=None, throttle=None):
     """
     Helper function doing all the parallelizable IO work
 
@@ -277,52 +567,252 @@ def _do_extract_and_copy(sample, outfile, series, verbosity):
 
     :param Path outfile: Output file
     :param series: List of input files
-
-    Returns name of output file
+    :param inflate_executor: Optional executor for decompression
+    :param bool count: Count reads and bases of the data as it is copied,
+                       compressed data copied as-is is decompressed for
+                       counting only.
+    :param str copy_method: One of omics.filecopy.COPY_METHODS.  A single
+                            file is linked if the method says so and it
+                            needs no decompression.  Otherwise the kernel
+                            copies, but data that is counted or decompressed
+                            passes through python.
+    :param progress: Optional function called with index in series, offset,
+                     size, counts and checksums of each input file that is
+                     done
+    :param int skip: Number of input files at the start of the series that
+                     are done already
+    :param int offset: Size of the output of the done input files, where
+                       the rest of the output starts.
+    :param Verifier verifier: Optional checksum verifier.  The input is
+                              hashed as it is read, so data that is hashed
+                              is copied through python, and linked files
+                              are read once for hashing.
+    :param throttle: Optional function to call with the number of bytes
+                     after each piece of data written, see omics.iosched
+
+    Returns name of output file and, if counting, a tuple of the numbers of
+    reads and bases, None otherwise.
     """
-    with outfile.open('ab') as outf:
-        for i in series:
-            if i.suffix == '.gz' and outfile.suffix != '.gz':
-                infile = gzip.open(str(i), 'r')
-                action = 'extr'
-            else:
-                infile = i.open('rb')
-                action = 'copy'
-
-            if verbosity > DEFAULT_VERBOSITY:
-                try:
-                    dest = outfile.resolve().relative_to(Path.cwd())
-                except:
-                    dest = outfile
-                print('{}: {} {} >> {}'.format(sample, action, i,
-                      dest))
+    def report(action, method, infile, size, start):
+        if verbosity > DEFAULT_VERBOSITY:
+            _report(sample, action, method, infile, outfile, size, start)
+
+    if not count and len(series) == 1 and skip == 0:
+        src = series[0]
+        if src.suffix != '.gz' or outfile.suffix == '.gz':
+            start = perf_counter()
+            method = link_file(src, outfile, copy_method)
+            if method is not None:
+                size = src.stat().st_size
+                checksums = None
+                if verifier is not None:
+                    checksums = _checksums(verifier, src,
+                                           verifier.hash_file(src))
+                report('link', method, src, size, start)
+                if progress is not None:
+                    progress(0, 0, size, None, checksums)
+                return str(outfile), None
+
+    total_counts = (0, 0) if count else None
+    with outfile.open('r+b' if offset else 'wb') as outf:
+        outf.truncate(offset)
+        outf.seek(offset)
+        for index, i in enumerate(series[skip:], start=skip):
+            start = perf_counter()
+            counter = None
+            if count:
+                counter = RecordCounter(FileFormat.fastq, str(i))
+            infile, action, in_hash = _open_input(i, outfile,
+                                                  inflate_executor, verifier)
+            out, out_hash = outf, None
+            if in_hash is not None and action == 'extr':
+                out_hash = verifier.new()
+                out = HashingWriter(outf, out_hash)
 
             try:
-                shutil.copyfileobj(infile, outf, 4 * 1024 * 1024)
+                if counter is not None:
+                    method = 'python'
+                    size = _copy_and_count(infile, out, counter, throttle)
+                elif action == 'extr' or in_hash is not None:
+                    method, size = copy_fileobj(infile, out, 'python',
+                                                throttle)
+                else:
+                    method, size = copy_fileobj(infile, outf, copy_method,
+                                                throttle)
 
             finally:
                 infile.close()
 
-    return outf.name
+            checksums = None
+            if in_hash is not None:
+                checksums = _checksums(verifier, i, in_hash, out_hash)
+            report(action, method, i, size, start)
+            counts = None
+            if counter is not None:
+                counts = counter.finish()
+                total_counts = tuple(map(sum, zip(total_counts, counts)))
+            if progress is not None:
+                progress(index, offset, size, counts, checksums)
+            offset += size
+
+    return outf.name, total_counts
+
+
+def _extract_to_offset(sample, outfile, infile, offset, size, verbosity,
+                       inflate_executor=None, count=False,
+                       copy_method='reflink', progress=None, index=None,
+                       verifier=None, throttle=None):
+    """
+    Decompress or copy one file of a series into its place in the output
+
+    Parameters are as for _do_extract_and_copy(), except for:
+
+    :param Path infile: The input file
+    :param int offset: Offset of the file's data in the output
+    :param int size: Expected size of the data in the output
+    :param int index: Index of the input file in the series, passed to
+                      progress
+
+    Returns name of output file and the read and base counts or None.
+    """
+    start = perf_counter()
+    counter = RecordCounter(FileFormat.fastq, str(infile)) if count else None
+    inf, action, in_hash = _open_input(infile, outfile, inflate_executor,
+                                       verifier)
+
+    fd = os.open(str(outfile), os.O_WRONLY)
+    try:
+        out, out_hash = OffsetWriter(fd, offset), None
+        if in_hash is not None and action == 'extr':
+            out_hash = verifier.new()
+            out = HashingWriter(out, out_hash)
+        if counter is not None:
+            method = 'pwrite'
+            written = _copy_and_count(inf, out, counter, throttle)
+        elif in_hash is not None:
+            method = 'pwrite'
+            _, written = copy_fileobj(inf, out, 'python', throttle)
+        elif action == 'extr':
+            method, written = copy_to_offset(inf, fd, offset, 'python',
+                                             throttle)
+        else:
+            method, written = copy_to_offset(inf, fd, offset, copy_method,
+                                             throttle)
+    finally:
+        os.close(fd)
+        inf.close()
+
+    if written != size:
+        raise RuntimeError('Size of {} changed while writing {}: expected {} '
+                           'bytes, got {}'.format(infile, outfile, size,
+                                                  written))
+    checksums = None
+    if in_hash is not None:
+        checksums = _checksums(verifier, infile, in_hash, out_hash)
+    if verbosity > DEFAULT_VERBOSITY:
+        _report(sample, action, method, infile, outfile, size, start)
+
+    counts = None if counter is None else counter.finish()
+    if progress is not None:
+        progress(index, offset, size, counts, checksums)
+    return str(outfile), counts
+
+
+def _open_input(path, outfile, inflate_executor=None, verifier=None):
+    """
+    Open an input file, to be decompressed unless the output is compressed
+
+    :return: Tuple of the file object, the action, 'extr' or 'copy', and the
+             hash object of the verifier that the input's raw data passes
+             through, or None if there is no verifier.
+    """
+    if verifier is None:
+        raw, in_hash = path.open('rb'), None
+    else:
+        raw = verifier.open(path)
+        in_hash = raw.raw.hash
+    if path.suffix == '.gz' and outfile.suffix != '.gz':
+        return open_reads(raw, executor=inflate_executor), 'extr', in_hash
+    return raw, 'copy', in_hash
+
+
+def _checksums(verifier, path, in_hash, out_hash=None):
+    """
+    Check an input file's checksum and get the checksums for the manifest
+
+    :param Path path: The input file
+    :param in_hash: Hash object of the input file's data
+    :param out_hash: Hash object of the data written, None if the input was
+                     copied as-is.
+    :raise ChecksumMismatch: If the input's checksum is known and differs
+    """
+    in_digest = in_hash.hexdigest()
+    verifier.check(path, in_digest)
+    return {
+        'algorithm': verifier.algorithm,
+        'input': in_digest,
+        'output': in_digest if out_hash is None else out_hash.hexdigest(),
+    }
+
+
+def _report(sample, action, method, infile, outfile, size, start):
+    """
+    Print what was done to a file and the throughput
+    """
+    try:
+        dest = outfile.resolve().relative_to(Path.cwd())
+    except:
+        dest = outfile
+    secs = perf_counter() - start
+    # single write, so lines from parallel jobs don't get mixed up
+    sys.stdout.write(
+        '{}: {} {} >> {} [{}: {:.1f} MB, {:.1f} MB/s]\n'
+        ''.format(sample, action, infile, dest, method, size / 1e6,
+                  size / 1e6 / secs if secs else float('inf'))
+    )
+
+
+def _copy_and_count(infile, outf, counter, throttle=None):
+    """
+    Copy data while passing it through a RecordCounter
+
+    :param infile: Input file object opened in binary mode, supporting peek()
+    :param outf: Output file object
+    :param RecordCounter counter: The counter, compressed input is
+                                  decompressed for it
+    :param throttle: Optional function to call with the number of bytes
+                     after each chunk
+    :return: Number of bytes copied
+    """
+    inflater = Inflater() if is_gzip(infile) else None
+    size = 0
+    while True:
+        data = infile.read(COPY_BUFFER_SIZE)
+        if not data:
+            break
+        outf.write(data)
+        size += len(data)
+        if throttle is not None:
+            throttle(len(data))
+        if inflater is None:
+            counter.update(data)
+        else:
+            for i in inflater.decompress(data):
+                counter.update(i)
+    if inflater is not None and inflater.in_member:
+        raise EOFError('Compressed file ended before the end-of-stream '
+                       'marker was reached: {}'.format(infile.name))
+    return size
 
 
 def count_fastq_reads(path, verbose=False):
     """
     Count number of reads in fastq file
     """
-    count = 0
-    args = [iter(path.open('rb'))] * 4
     if verbose:
         print('Start counting reads for {}...'.format(path))
-    for read in zip_longest(*args):
-        if read[-1] is None:
-            raise RuntimeError(
-                'Line count is not a multiple of 4: {}, read count at {}\n'
-                'Last lines are:\n{}'
-                ''.format(path, count, '\n'.join([str(i) for i in read]))
-            )
-        count += 1
-    return count
+    with open_reads(path) as file:
+        return count_records(file, fmt=FileFormat.fastq)
 
 
 def main(argv=None):
@@ -351,7 +841,9 @@ def main(argv=None):
     argp.add_argument(
         '--count-reads',
         action='store_true',
-        help='Make simple read-count statistics',
+        help='Make simple read-count statistics.  Reads and bases are '
+             'counted while the data is copied, and forward and reverse '
+             'read counts are checked to be equal.',
     )
     argp.add_argument(
         '--force', '-f',
@@ -364,11 +856,77 @@ def main(argv=None):
         action='store_true',
         help='Skip sample when a destination file exists',
     )
+    argp.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue an interrupted run.  prep records its progress in '
+             'the file ' + MANIFEST_FILE_NAME + ' in the destination '
+             'directory.  With this option, parts of existing output files '
+             'recorded as done are kept, after a quick check, if their input '
+             'files are unchanged, and only missing parts are added.  '
+             'Other existing output files are redone.  --force and '
+             '--skip-existing take precedence.',
+    )
+    argp.add_argument(
+        '--checksum',
+        choices=ALGORITHMS,
+        default=None,
+        help='Compute checksums of the input files while they are read, and '
+             'of the data written to the output files, and record them in '
+             'the manifest file ' + MANIFEST_FILE_NAME + '.  Data that is '
+             'hashed gets copied through python.  The default is not to '
+             'compute checksums unless --checksum-file is given.',
+    )
+    argp.add_argument(
+        '--checksum-file',
+        metavar='FILE',
+        action='append',
+        help='A file with checksums of input files, in the format of md5sum '
+             'or sha256sum, with file names relative to the checksum file.  '
+             'Listed input files are verified while they are read and prep '
+             'fails if a checksum does not match.  If --checksum is not '
+             'given, the algorithm is taken from the first checksum in the '
+             'file, and input files that are not listed are reported and '
+             'left unverified.  With --checksum, unlisted input files are '
+             'an error.  This option may be given several times.',
+    )
     argp.add_argument(
         '--keep-compression',
         action='store_true',
         help='Keep files in compressed format.  The default is to decompress.',
     )
+    argp.add_argument(
+        '--copy-method',
+        choices=COPY_METHODS,
+        default=COPY_METHODS[0],
+        help='How to copy files that do not need decompressing.  With reflink,'
+             ' the default, or hardlink a sample file that is not split up '
+             'is cloned or linked where the file system supports it.  '
+             'Otherwise, and with kernel, the data is copied inside the '
+             'kernel via copy_file_range or sendfile.  python copies '
+             'through user space, which is also what --count-reads does.  '
+             'Any method falls back to the next simpler one if not '
+             'supported.',
+    )
+    argp.add_argument(
+        '--io-jobs',
+        metavar='N',
+        type=int,
+        default=None,
+        help='Maximum number of concurrent copy jobs per storage device, as '
+             'given by the device number of input and output files.  Jobs '
+             'touching a busy device wait while others run.  By default '
+             'only the number of threads limits the jobs.',
+    )
+    argp.add_argument(
+        '--io-bandwidth',
+        metavar='MB/S',
+        type=float,
+        default=None,
+        help='Maximum data rate per storage device in MB per second.  By '
+             'default the rate is not limited.  With -v the achieved rates '
+             'are reported.',
+    )
     argp.add_argument(
         '--keep-lanes-separate',
         action='store_true',
@@ -431,11 +989,56 @@ def main(argv=None):
         print('Using {} threads.'.format(args.threads))
 
     files = list(set(files))
+    manifest = PrepManifest(dest / MANIFEST_FILE_NAME)
+
+    expected = {}
+    algorithm = args.checksum
+    for i in args.checksum_file or []:
+        try:
+            checksums = read_checksum_file(Path(i))
+        except (OSError, RuntimeError) as e:
+            argp.error(e)
+        if algorithm is None and checksums:
+            algorithm = next(iter(checksums.values()))[0]
+        expected.update(checksums)
+    verifier = None
+    if algorithm is not None:
+        verifier = Verifier(algorithm, expected)
+        ignored = len(expected) - len(verifier.expected)
+        if ignored:
+            print('Warning: ignoring {} checksums not of type {}'
+                  ''.format(ignored, algorithm), file=sys.stderr)
+        if args.checksum_file:
+            missing = sorted(
+                i for i in files if i.resolve() not in verifier.expected
+            )
+            if missing:
+                msg = ('{} of {} input files have no {} checksum in the '
+                       'checksum file:\n  {}'.format(
+                           len(missing), len(files), algorithm,
+                           '\n  '.join(map(str, missing))))
+                if args.checksum is not None:
+                    argp.error(msg)
+                print('Warning: {}\nThese files are not verified.'
+                      ''.format(msg), file=sys.stderr)
+        if verbose:
+            listed = [i for i in files if i.resolve() in verifier.expected]
+            print('Verifying {} checksums of {} of {} input files'
+                  ''.format(algorithm, len(listed), len(files)))
     samp_count = 0
     read_counts = {}
+    # sample -> {direction: (reads, bases)}
+    seq_counts = {}
 
     try:
-        with ThreadPoolExecutor(max_workers=args.threads) as e:
+        with ThreadPoolExecutor(max_workers=args.threads) as e, \
+                ThreadPoolExecutor(max_workers=args.threads) as inflate:
+            scheduler = IOScheduler(
+                e,
+                max_jobs=args.io_jobs,
+                bandwidth=None if args.io_bandwidth is None
+                else args.io_bandwidth * 1e6,
+            )
             futures = {}
             file_groupings = group(files, keep_lanes=args.keep_lanes,
                                    multi_run=args.multi_run,
@@ -461,54 +1064,49 @@ def main(argv=None):
                         keep_compression=args.keep_compression,
                         skip_existing=args.skip_existing,
                         executor=e,
+                        inflate_executor=inflate,
+                        count=args.count_reads,
+                        copy_method=args.copy_method,
+                        manifest=manifest,
+                        resume=args.resume,
+                        scheduler=scheduler,
+                        verifier=verifier,
                     )
                 )
 
-            while futures:
-                for fut in as_completed(futures.keys()):
-                    job_meta = futures[fut]
-                    if len(job_meta) == 1:
-                        # read counting job, job_meta is 1-tuple
-                        sample = futures[fut][0]
-                        count = fut.result()
-                        if sample in read_counts:
-                            raise RuntimeError(
-                                'Already counted reads for {} (internal error)'
-                                ''.format(sample)
-                            )
-                        else:
-                            read_counts[sample] = count
-                            if verbose:
-                                print('{}: {} reads'.format(sample, count))
-                    elif len(job_meta) == 2:
-                        # was an extract/copy job, job_meta is 2-tuple
-                        sample, direction = futures[fut]
-                        outfile = Path(fut.result())
-                        if very_verbose:
-                            print(
-                                'Done: {} {}'.format(
-                                    sample,
-                                    'fwd' if direction == 1 else 'rev'
-                                ),
-                                end=''
-                            )
-                        if args.count_reads and direction == 1:
-                            futures[e.submit(
-                                count_fastq_reads,
-                                outfile,
-                                verbose=verbose,
-                            )] = (sample, )
-                        if fut.exception() is not None:
-                            print('Failed to write: {}: {}: {}'
-                                  ''.format(sample, direction, outfile),
-                                  file=sys.stderr)
-                    else:
-                        raise RuntimeError(
-                            '(internal error) invalid futures structure: '
-                            '{}: {}: {}'
-                            ''.format(e.__class__.__name__, e, job_meta)
-                        )
-                    del futures[fut]
+            for fut in as_completed(futures.keys()):
+                sample, direction = futures[fut]
+                if fut.exception() is not None:
+                    print('Failed to write: {}: {}'.format(sample, direction),
+                          file=sys.stderr)
+                _, counts = fut.result()
+                if very_verbose:
+                    print('Done: {} {}'.format(
+                        sample,
+                        'fwd' if direction == 1 else 'rev'
+                    ))
+                if counts is not None:
+                    # reads were counted while copying, maybe per file of a
+                    # series
+                    sample_counts = seq_counts.setdefault(sample, {})
+                    reads, bases = sample_counts.get(direction, (0, 0))
+                    sample_counts[direction] = \
+                        (reads + counts[0], bases + counts[1])
+
+        for sample, counts in sorted(seq_counts.items()):
+            reads = {i: count for i, (count, _) in counts.items()}
+            if len(set(reads.values())) > 1:
+                raise RuntimeError(
+                    'Different number of forward and reverse reads for '
+                    'sample {}: {} vs. {}'.format(sample, reads[1], reads[2])
+                )
+            read_counts[sample] = reads.get(1, reads.get(2))
+            if verbose:
+                print('{}: {} reads, {} bases'.format(
+                    sample,
+                    read_counts[sample],
+                    ' + '.join(str(counts[i][1]) for i in sorted(counts)),
+                ))
 
     except FileNameDoesNotMatch as e:
         print('The name of file {} does not follow the supported pattern:\n'
@@ -533,6 +1131,11 @@ def main(argv=None):
         if verbose:
             print('read counts written to', READ_COUNT_FILE_NAME)
 
+    if verbose:
+        print('Throughput per storage device:')
+        for i in scheduler.report():
+            print('  ' + i)
+
     if not quiet:
         print('Processed {} samples'.format(samp_count))
 
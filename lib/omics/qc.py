@@ -19,22 +19,28 @@
 Run QC on metagenomic reads from multiple samples
 """
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                as_completed, wait)
+from os import environ
 from pathlib import Path
 import subprocess
 import sys
 
-from omics import get_argparser, DEFAULT_VERBOSITY
+from omics import get_argparser, DEFAULT_VERBOSITY, PROJECT_HOME_ENV_VAR
 
 QC_BINARY_NAME = 'omics-qc-sample'
 DEFAULT_RQCFILTERDATA = '/reference-data/bbtools/RQCFilterData'
+DEFAULT_FWD = 'fwd.fastq'
+DEFAULT_REV = 'rev.fastq'
 
 
 def qc_sample(path, **kwargs):
     """
     Do QC for a single sample
 
-    This is a wrapper for the omics-qc-sample script
+    This is a wrapper for the omics-qc-sample script.  The project home is
+    passed on to omics commands run by the script, so they get the project's
+    configuration even when run outside of the project, e.g. in scratch.
     """
     for k, v in vars(get_args(argv=[])).items():
         kwargs.setdefault(k, v)
@@ -61,15 +67,59 @@ def qc_sample(path, **kwargs):
         args.append('--verbosity={}'.format(kwargs['verbosity']))
         print('[qc] Calling qc-sample with arguments: {}'.format(args))
 
+    env = None
+    if kwargs.get('project') is not None:
+        env = dict(environ)
+        env[PROJECT_HOME_ENV_VAR] = str(kwargs['project']['project_home'])
+
     p = subprocess.run(
         [QC_BINARY_NAME] + args,
         cwd=str(path),
+        env=env,
     )
     if p.check_returncode():
         raise RuntimeError('Failed to run qc-sample: sample: {}: exit status: '
                            '{}'.format(path, p.returncode))
 
 
+def qc_staged(path, key, staged, stager, write_backs, **kwargs):
+    """
+    Do QC for a single sample in scratch space
+
+    :param Path path: The sample directory
+    :param str key: The sample's staging key
+    :param staged: Future for the sample's scratch directory holding the
+                   staged reads
+    :param Stager stager: The omics.staging.Stager
+    :param list write_backs: List to which the Future for writing the
+                             results back to the sample directory is added.
+                             Results are written back even if QC fails.
+    """
+    try:
+        local = staged.result()
+    except Exception:
+        stager.evict(key)
+        raise
+    inputs = [
+        i.relative_to(local) for i in local.rglob('*') if i.is_file()
+    ]
+
+    def clean():
+        qc_sample(path, **dict(kwargs, clean_only=True))
+
+    try:
+        qc_sample(local, **kwargs)
+    finally:
+        if kwargs['verbosity'] > DEFAULT_VERBOSITY:
+            print('[qc] Writing back results from {} to {}'
+                  ''.format(local, path))
+        # clean up the sample directory before writing back, as qc-sample
+        # would have done when run there
+        write_backs.append(
+            stager.stage_out(key, path, exclude=inputs, before=clean)
+        )
+
+
 def qc(**kwargs):
     """
     Do quality control on multiple samples
@@ -94,11 +144,45 @@ def qc(**kwargs):
 
     kwargs['threads'] = threads_per_worker
 
+    stager = None
+    write_backs = []
+    if kwargs['stage'] and not kwargs['clean_only']:
+        from omics.staging import Stager
+        # samples in scratch: those being processed, one read ahead, and
+        # any whose results are still being written back
+        stager = Stager(
+            scratch=kwargs['scratch'],
+            max_bytes=None if kwargs['scratch_size'] is None
+            else int(kwargs['scratch_size'] * 1e9),
+            max_keys=num_workers + 1,
+        )
+        if kwargs['verbosity'] > DEFAULT_VERBOSITY:
+            print('[qc] Staging samples in {}'.format(stager.root))
+
     errors = []
     with ThreadPoolExecutor(max_workers=num_workers) as e:
         futures = {}
-        for path in kwargs['samples']:
-            futures[e.submit(qc_sample, path, **kwargs)] = path
+        running = set()
+        for num, path in enumerate(kwargs['samples']):
+            if stager is None:
+                futures[e.submit(qc_sample, path, **kwargs)] = path
+                continue
+            # stage lazily, only one sample ahead of those being processed
+            while len(running) > num_workers:
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+            # read ahead in the order the samples are processed, relative
+            # paths are kept, absolute ones are read in place
+            reads = [
+                path / i for i in [kwargs['fwd'] or DEFAULT_FWD,
+                                   kwargs['rev'] or DEFAULT_REV]
+                if not Path(i).is_absolute()
+            ]
+            key = '{}-{}'.format(num, path.resolve().name)
+            staged = stager.stage_in(key, reads, base=path)
+            fut = e.submit(qc_staged, path, key, staged, stager, write_backs,
+                           **kwargs)
+            futures[fut] = path
+            running.add(fut)
 
         for fut in as_completed(futures.keys()):
             sample_path = futures[fut]
@@ -112,6 +196,20 @@ def qc(**kwargs):
                     ''.format(sample_path, e.__class__.__name__, e)
                 )
 
+    if stager is not None:
+        wait(write_backs)
+        for fut in write_backs:
+            if fut.exception() is not None:
+                errors.append(
+                    '[qc] (error): writing back results: {}: {}'
+                    ''.format(fut.exception().__class__.__name__,
+                              fut.exception())
+                )
+        stager.close()
+        if stager.root.exists():
+            errors.append('[qc] (error): results left in scratch directory: '
+                          '{}'.format(stager.root))
+
     if errors:
         raise(RuntimeError('\n'.join(errors)))
 
@@ -186,6 +284,32 @@ def get_args(argv=None, namespace=None):
              'rqcfilter2. The default is ' + DEFAULT_RQCFILTERDATA + ' and '
              'is good for running omics qc inside the omics container.'
     )
+    argp.add_argument(
+        '--stage',
+        action='store_true',
+        help='Run QC on node-local scratch storage.  Each sample\'s reads '
+             'are copied to scratch ahead of time while the previous sample '
+             'is processed, and results are written back to the sample '
+             'directory in the background.  This hides the latency of slow '
+             'network storage.',
+    )
+    argp.add_argument(
+        '--scratch',
+        metavar='PATH',
+        help='Scratch directory for --stage, the default is given by the '
+             'TMPDIR environment variable, or else the system\'s default '
+             'temporary directory.',
+    )
+    argp.add_argument(
+        '--scratch-size',
+        metavar='GB',
+        type=float,
+        help='Maximum size of data staged in scratch, in GB.  Reading ahead '
+             'waits for results of earlier samples to be written back.  The '
+             'qc-sample script\'s own temporary files are not counted.  By '
+             'default only the number of samples in scratch is limited, to '
+             'one more than the number of samples processed in parallel.',
+    )
     args = argp.parse_args(args=argv, namespace=namespace)
     args.samples = [Path(i) for i in args.samples]
     for i in args.samples:
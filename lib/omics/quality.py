@@ -0,0 +1,101 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Per-read quality statistics for whole batches of records
+
+The quality lines of a batch are located by the line offsets the record
+reader already found and are summed up by numpy right in the input block,
+without python-level work per read.
+"""
+
+from . import lazy_import
+
+numpy = lazy_import('numpy')
+
+# index of the quality line within a FASTQ record
+QUAL_LINE = 3
+
+# size of the pieces of data summed up at once
+SPAN_CHUNK = 256 * 1024
+
+
+def line_bounds(batch, line=QUAL_LINE):
+    """
+    Get the offsets into the batch's data of a line of each record
+
+    :param batch: A seqio.Batch object
+    :param int line: Index of the line within the records
+    :return: Tuple of numpy arrays of the start and end offsets, the end
+             being just past the newline
+    """
+    ends = numpy.frombuffer(batch.ends, dtype=numpy.uint64).astype(numpy.intp)
+    stops = ends[line::batch.lines]
+    if line == 0:
+        starts = numpy.concatenate(
+            [[batch.start], ends[batch.lines - 1:-1:batch.lines]]
+        ).astype(numpy.intp)
+    else:
+        starts = ends[line - 1::batch.lines]
+    return starts, stops
+
+
+def sum_spans(data, starts, stops, dtype=None):
+    """
+    Sum up values over spans of data
+
+    The values are summed up in chunks of the data, bounding the memory
+    taken by the values cast to the result type.
+
+    :param data: numpy array
+    :param starts: Start of each span, in increasing order
+    :param stops: End of each span, spans must be non-empty and must not
+                  overlap
+    :param dtype: Type of the sums, by default that of the values
+    :return: numpy array of the sums
+    """
+    if dtype is None:
+        dtype = data.dtype
+    sums = numpy.empty(len(starts), dtype=dtype)
+    first = 0
+    while first < len(starts):
+        last = max(first + 1,
+                   numpy.searchsorted(starts, starts[first] + SPAN_CHUNK))
+        base = starts[first]
+        values = data[base:stops[last - 1]]
+        # reduceat sums from each index to the next, the sums over the gaps
+        # between the spans are dropped
+        index = numpy.empty(2 * (last - first) - 1, dtype=numpy.intp)
+        index[0::2] = starts[first:last] - base
+        index[1::2] = stops[first:last - 1] - base
+        sums[first:last] = numpy.add.reduceat(values, index, dtype=dtype)[0::2]
+        first = last
+    return sums
+
+
+def quality_sums(batch, line=QUAL_LINE):
+    """
+    Get the sums of the raw bytes of each record's quality line
+
+    :return: Tuple of numpy int64 arrays of the sums and the lengths, both
+             including the newline
+    """
+    data = numpy.frombuffer(batch.data, dtype=numpy.uint8)
+    starts, stops = line_bounds(batch, line)
+    return (sum_spans(data, starts, stops, dtype=numpy.int64),
+            (stops - starts).astype(numpy.int64))
+
@@ -16,14 +16,15 @@
 # with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
-from itertools import zip_longest
 from operator import itemgetter
 from pathlib import Path
 import sys
 
-import matplotlib
+from . import get_argparser, lazy_import
+from .gzio import open_reads
+from .seqio import count_records, detect_format
 
-from . import get_argparser
+matplotlib = lazy_import('matplotlib')
 
 
 def main(argv=None):
@@ -95,31 +96,16 @@ def count_fastaq_reads(path):
     """
     Count number of reads in fasta/q file
     """
-    file = path.open('rb')
-    marker = file.peek()[:1]
-    if marker == b'@':
-        # FASTQ
-        read_lines = 4
-    elif marker == b'>':
-        # FASTA
-        read_lines = 2
-    else:
-        raise RuntimeError(
-            'Failed to detect fileformat: {} is neither valid FASTA nor FASTQ:'
-            ' file starts: "{}"'.format(path, file.peek()[:10].decode())
-        )
-
-    count = 0
-    args = [iter(file)] * read_lines
-    for read in zip_longest(*args):
-        if read[-1] is None:
+    with open_reads(path) as file:
+        try:
+            fmt = detect_format(file)
+        except RuntimeError:
             raise RuntimeError(
-                'Line count is not a multiple of {}: {}, read count at {}\n'
-                'Last lines are:\n{}'
-                ''.format(path, count, '\n'.join([str(i) for i in read]))
+                'Failed to detect fileformat: {} is neither valid FASTA nor '
+                'FASTQ: file starts: "{}"'
+                ''.format(path, file.peek()[:10].decode(errors='replace'))
             )
-        count += 1
-    return count
+        return count_records(file, fmt=fmt)
 
 
 def make_output(read_counts, outfile, pdfout=None):
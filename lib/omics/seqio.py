@@ -0,0 +1,558 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Block-based reading of FASTA and FASTQ files
+
+Input is read in large blocks and the line boundaries are located by numpy,
+there is no python-level work per line.  Records are handed out in batches,
+each holding a block of input together with an array of the offsets of the
+line ends of its records.  Single lines or whole records are accessed as
+memoryview slices into the block, which can be written out without copying.
+
+As everywhere in geo-omics-scripts, sequence and quality scores must be on a
+single line per record, i.e. a FASTA record has two lines and a FASTQ record
+has four.
+"""
+
+from array import array
+from enum import Enum
+from itertools import chain
+
+from . import lazy_import
+
+numpy = lazy_import('numpy')
+
+# size of the blocks read from the input
+BLOCK_SIZE = 4 * 1024 * 1024
+
+NEWLINE = ord('\n')
+
+FileFormat = Enum('FileFormat', 'fasta fastq')
+
+format_info = {
+    FileFormat.fasta: {'lines': 2, 'headchar': '>'},
+    FileFormat.fastq: {'lines': 4, 'headchar': '@'},
+}
+
+
+def detect_format(file):
+    """
+    Detect file format from the first character of a file
+
+    :param file: File object opened in binary mode supporting peek()
+    :return: The FileFormat
+    :raise RuntimeError: If the file is empty or not FASTA/FASTQ
+    """
+    name = getattr(file, 'name', '')
+    first = file.peek(1)[:1]
+    if not first:
+        raise RuntimeError('File empty?: {}'.format(name))
+    for fmt, info in format_info.items():
+        if first == info['headchar'].encode():
+            return fmt
+    raise RuntimeError('Bad file format: {}: expected > or @ as first '
+                       'character but got {}'
+                       ''.format(name, first.decode(errors='replace')))
+
+
+def find_newlines(data):
+    """
+    Get offsets just past each newline
+
+    The newlines are located by numpy in vectorized passes over the data, no
+    python objects are made per line.
+
+    :param data: A block of input, bytes or any other buffer
+    :return: numpy array of int64 offsets
+    """
+    ends = numpy.flatnonzero(numpy.frombuffer(data, dtype=numpy.uint8)
+                             == NEWLINE)
+    ends += 1
+    return ends
+
+
+def split_lines(data):
+    """
+    Get offsets just past each newline as array
+
+    Any incomplete last line is left out.
+
+    :param data: A block of input
+    :return: array of offsets
+    """
+    return array('Q', find_newlines(data).astype(numpy.uint64).tobytes())
+
+
+class Batch():
+    """
+    Consecutive records from a block of input
+
+    Methods returning iterators over all records of the batch do so without
+    python-level work per record, using only built-ins like map() and
+    slice().
+
+    :param bytes data: The input block
+    :param array ends: Offsets into data just past the newline of each line
+                       of the batch's records
+    :param int start: Offset into data of the batch's first record
+    :param int lines: Number of lines per record
+    :param int offset: Offset of the input block in the file
+    """
+    def __init__(self, data, ends, start, lines, offset=0):
+        self.data = data
+        self.view = memoryview(data)
+        self.ends = ends
+        self.start = start
+        self.lines = lines
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.ends) // self.lines
+
+    def __iter__(self):
+        """
+        Iterate over the records as memoryview
+        """
+        return self.spans(0, self.lines)
+
+    def starts(self, line=0):
+        """
+        Get iterator over the offsets into the data where given line starts
+
+        :param int line: Index of line within the records
+        """
+        if line == 0:
+            return chain([self.start], self.ends[self.lines - 1:-1:self.lines])
+        return iter(self.ends[line - 1::self.lines])
+
+    def spans(self, first, last, skip=0, copy=False):
+        """
+        Get iterator over a span of lines of each record
+
+        :param int first: Index of first line of span
+        :param int last: Index of line after the span
+        :param int skip: Number of bytes to skip at start of span
+        :param bool copy: If True, return bytes, otherwise memoryviews
+        """
+        starts = self.starts(first)
+        if skip:
+            starts = map(skip.__add__, starts)
+        ends = self.ends[last - 1::self.lines]
+        data = self.data if copy else self.view
+        return map(data.__getitem__, map(slice, starts, ends))
+
+    def iter_lines(self, copy=False):
+        """
+        Iterate over the records as tuples of their lines
+
+        The lines include the newline.
+
+        :param bool copy: If True, lines are bytes, otherwise memoryviews
+        """
+        ends = self.ends
+        starts = chain([self.start], ends[:-1])
+        data = self.data if copy else self.view
+        lines = map(data.__getitem__, map(slice, starts, ends))
+        return zip(*[lines] * self.lines)
+
+    def file_offsets(self):
+        """
+        Get iterator over the offsets in the file of the records
+        """
+        return map(self.offset.__add__, self.starts(0))
+
+    def record_start(self, i):
+        """
+        Get the offset into the data of the i-th record
+
+        For i equal to the number of records this is the end of the batch.
+        """
+        if i == 0:
+            return self.start
+        return self.ends[i * self.lines - 1]
+
+    def record(self, i):
+        """
+        Get the i-th record as memoryview
+        """
+        end = self.ends[(i + 1) * self.lines - 1]
+        return self.view[self.record_start(i):end]
+
+    def records(self, i, j):
+        """
+        Get the i-th up to, excluding, the j-th record as single memoryview
+        """
+        return self.view[self.record_start(i):self.record_start(j)]
+
+    def line(self, i, j):
+        """
+        Get the j-th line of the i-th record as memoryview
+        """
+        k = i * self.lines + j
+        start = self.start if k == 0 else self.ends[k - 1]
+        return self.view[start:self.ends[k]]
+
+    def tobytes(self):
+        """
+        Get all the records as a single bytes object
+        """
+        if not self.ends:
+            return b''
+        return self.data[self.start:self.ends[-1]]
+
+
+class RecordReader():
+    """
+    Read records from a FASTA or FASTQ file in batches
+
+    Iterating over a reader gives the batches until the end of the file.
+
+    :param file: File object opened in binary mode.  If the format is not
+                 given it must support peek() for the format detection.
+    :param FileFormat fmt: The file format, detected if None.
+    :param bool interleaved: If True, then two consecutive records, the
+                             forward and reverse read, are taken as a single
+                             record.
+    :param bool check: If True, check that the headers and the + separator
+                       lines are where they are expected.
+    :param int block_size: Size of blocks read from the file.
+    """
+    def __init__(self, file, fmt=None, interleaved=False, check=False,
+                 block_size=BLOCK_SIZE):
+        self.file = file
+        self.fmt = detect_format(file) if fmt is None else fmt
+        self.lines = format_info[self.fmt]['lines']
+        if interleaved:
+            self.lines *= 2
+        self.headchar = ord(format_info[self.fmt]['headchar'])
+        self.check = check
+        self.block_size = block_size
+        self.count = 0  # records handed out so far
+
+        self._data = b''
+        self._ends = array('Q')
+        self._next = 0  # index into _ends of the next record's first line
+        self._start = 0  # offset into _data of next record
+        self._offset = 0  # file offset of _data
+        self._tail = b''  # incomplete record at end of last block
+        self._tail_offset = 0
+        self._eof = False
+        try:
+            self._pos = file.tell()
+        except (OSError, AttributeError):
+            # not seekable, e.g. stdin
+            self._pos = 0
+
+    @property
+    def name(self):
+        return getattr(self.file, 'name', '')
+
+    def __iter__(self):
+        while True:
+            batch = self.read()
+            if not batch:
+                break
+            yield batch
+
+    def _fill(self):
+        """
+        Read blocks until at least one complete record is available
+
+        Blocks are used as they are read, without copying.  A record cut off
+        at the end of a block is completed by reading the missing lines and
+        makes up a small data block of its own.
+
+        :return bool: False if there are no more records.
+        """
+        while not self._eof:
+            if self._tail:
+                data = self._tail
+                offset = self._tail_offset
+                parts = [data]
+                for _ in range(self.lines - data.count(b'\n')):
+                    line = self.file.readline()
+                    if not line:
+                        self._eof = True
+                        break
+                    parts.append(line)
+                    self._pos += len(line)
+                data = b''.join(parts)
+                self._tail = b''
+            else:
+                offset = self._pos
+                data = self.file.read(self.block_size)
+                if not data:
+                    self._eof = True
+                    break
+                self._pos += len(data)
+
+            if self._eof and not data.endswith(b'\n'):
+                data += b'\n'
+
+            ends = split_lines(data)
+            num_lines = len(ends) - len(ends) % self.lines
+            cut = ends[num_lines - 1] if num_lines else 0
+            if cut < len(data):
+                if self._eof:
+                    raise RuntimeError(
+                        'Line count is not a multiple of {}: {}: incomplete '
+                        'record after {} records, last lines are:\n{}'
+                        ''.format(self.lines, self.name,
+                                  self.count + num_lines // self.lines,
+                                  data[cut:].decode(errors='replace'))
+                    )
+                self._tail = data[cut:]
+                self._tail_offset = offset + cut
+                del ends[num_lines:]
+
+            self._data = data
+            self._ends = ends
+            self._offset = offset
+            self._next = 0
+            self._start = 0
+            if ends:
+                return True
+
+        self._data = b''
+        self._ends = array('Q')
+        self._next = 0
+        self._start = 0
+        return False
+
+    def available(self):
+        """
+        Get number of records that can be read without further I/O
+
+        Reads the next block if needed.  Returns zero at the end of the file.
+        """
+        if self._next >= len(self._ends):
+            if not self._fill():
+                return 0
+        return (len(self._ends) - self._next) // self.lines
+
+    def read(self, max_records=None):
+        """
+        Read the next batch of records
+
+        :param int max_records: Maximum number of records in the batch
+        :return: A Batch, which is empty at the end of the file.
+        """
+        avail = self.available()
+        if max_records is not None:
+            avail = min(avail, max_records)
+        end = self._next + avail * self.lines
+        batch = Batch(self._data, self._ends[self._next:end], self._start,
+                      self.lines, self._offset)
+        if self.check and avail:
+            self.check_batch(batch)
+        self._next = end
+        if avail:
+            self._start = self._ends[end - 1]
+        self.count += avail
+        return batch
+
+    def check_batch(self, batch):
+        """
+        Check the headers and separator lines of the reads in a batch
+
+        :raise RuntimeError: If the format is violated
+        """
+        data = batch.data
+        ends = batch.ends
+        read_lines = format_info[self.fmt]['lines']
+        reads_per_record = self.lines // read_lines
+
+        # the first characters of all headers and separators
+        starts = chain([batch.start], ends[read_lines - 1:-1:read_lines])
+        checks = [(bytes([self.headchar]), 'header', starts)]
+        if self.fmt is FileFormat.fastq:
+            checks.append((b'+', '+ separator line',
+                           iter(ends[1::read_lines])))
+
+        for char, what, offsets in checks:
+            offsets = list(offsets)
+            found = bytes(map(data.__getitem__, offsets))
+            bad = len(found) - len(found.lstrip(char))
+            if bad < len(found):
+                pos = offsets[bad]
+                raise RuntimeError(
+                    'Expected {} in {} at record {}: {}'
+                    ''.format(what, self.name,
+                              self.count + bad // reads_per_record,
+                              data[pos:pos + 80].decode(errors='replace'))
+                )
+
+
+def read_paired(fwd_in, rev_in, fmt=None, check=False):
+    """
+    Read forward and reverse reads in batches of equal size
+
+    :param fwd_in: Forward reads file object opened in binary mode
+    :param rev_in: Reverse reads file object opened in binary mode
+    :param FileFormat fmt: The file format, detected if None
+    :param bool check: Check the format of the records
+
+    :return: Iterator over pairs of forward and reverse batches
+    :raise RuntimeError: If the files have different numbers of reads or
+                         different formats.
+    """
+    fwd = RecordReader(fwd_in, fmt=fmt, check=check)
+    rev = RecordReader(rev_in, fmt=fmt, check=check)
+    if fwd.fmt != rev.fmt:
+        raise RuntimeError('Fileformat mismatch: {} is {} but {} is {}.'
+                           ''.format(fwd.name, fwd.fmt.name, rev.name,
+                                     rev.fmt.name))
+    while True:
+        num = min(fwd.available(), rev.available())
+        if num == 0:
+            if fwd.available() or rev.available():
+                raise RuntimeError('Files have different number of reads: '
+                                   '{} and {}'.format(fwd.name, rev.name))
+            break
+        yield fwd.read(num), rev.read(num)
+
+
+def find_record_start(file, offset, fmt=FileFormat.fastq):
+    """
+    Find the first record starting at or after given offset of a file
+
+    A FASTQ header is told from a quality line that starts with @ by the +
+    separator two lines down, sequence lines never start with +.
+
+    :param file: Seekable file object opened in binary mode
+    :param int offset: Where to start looking
+    :param FileFormat fmt: The file format
+    :return: The offset of the record, or None if no record starts at or
+             after offset
+    """
+    file.seek(offset)
+    if offset:
+        # skip rest of line, unless offset is at the start of a line
+        file.seek(offset - 1)
+        offset += len(file.readline()) - 1
+
+    headchar = format_info[fmt]['headchar'].encode()
+    window = 3 if fmt is FileFormat.fastq else 1
+    lines = [file.readline() for _ in range(window)]
+    while lines[0]:
+        if lines[0].startswith(headchar):
+            if fmt is FileFormat.fasta or lines[2].startswith(b'+'):
+                return offset
+        offset += len(lines[0])
+        lines = lines[1:] + [file.readline()]
+    return None
+
+
+def count_records(file, fmt=None, block_size=BLOCK_SIZE):
+    """
+    Count the records in a FASTA or FASTQ file
+
+    Only the newlines are counted, the records are not checked.
+
+    :param file: File object opened in binary mode.  If the format is not
+                 given it must support peek() for the format detection.
+    :param FileFormat fmt: The file format, detected if None
+    :return int: The number of records
+    :raise RuntimeError: If the number of lines does not fit the format
+    """
+    if fmt is None:
+        fmt = detect_format(file)
+    read_lines = format_info[fmt]['lines']
+
+    buf = bytearray(block_size)
+    lines = 0
+    last = ord('\n')
+    while True:
+        size = file.readinto(buf)
+        if not size:
+            break
+        lines += buf.count(b'\n', 0, size)
+        last = buf[size - 1]
+    if last != ord('\n'):
+        # no newline at end of file
+        lines += 1
+
+    if lines % read_lines:
+        raise RuntimeError(
+            'Line count is not a multiple of {}: {}: {} lines'
+            ''.format(read_lines, getattr(file, 'name', ''), lines)
+        )
+    return lines // read_lines
+
+
+class RecordCounter():
+    """
+    Count records and bases of FASTA or FASTQ data passing through
+
+    The data is given piece by piece as it is copied from somewhere, pieces
+    may end anywhere, e.g. inside a line.  Only the line lengths are looked
+    at, the records are not checked.
+
+    :param FileFormat fmt: The file format
+    :param str name: Name of the data's source, for error messages
+    """
+    def __init__(self, fmt=FileFormat.fastq, name=''):
+        self.fmt = fmt
+        self.name = name
+        self.lines_per_record = format_info[fmt]['lines']
+        self.lines = 0  # complete lines so far
+        self.bases = 0
+        self._carry = b''  # incomplete line at end of last piece
+
+    def update(self, data):
+        """
+        Count the lines and bases in the next piece of data
+        """
+        if self._carry:
+            data = self._carry + data
+        ends = find_newlines(data)
+        if not len(ends):
+            self._carry = bytes(data)
+            return
+        self._carry = bytes(data[ends[-1]:])
+
+        # sequence is the second line of each record, find its first
+        # occurrence in ends, which may be in the middle of a record
+        n = self.lines_per_record
+        k = (1 - self.lines) % n
+        seq_ends = ends[k::n]
+        if k:
+            seq_starts = ends[k - 1::n]
+        else:
+            seq_starts = numpy.concatenate([[0], ends[n - 1::n]])
+        seq_starts = seq_starts[:len(seq_ends)]
+        # line lengths include the newline
+        self.bases += int(seq_ends.sum() - seq_starts.sum()) - len(seq_ends)
+        self.lines += len(ends)
+
+    def finish(self):
+        """
+        Get the final counts
+
+        :return: Tuple of number of records and number of bases
+        :raise RuntimeError: If the number of lines does not fit the format
+        """
+        if self._carry:
+            # no newline at end of data
+            self.update(b'\n')
+        if self.lines % self.lines_per_record:
+            raise RuntimeError(
+                'Line count is not a multiple of {}: {}: {} lines'
+                ''.format(self.lines_per_record, self.name, self.lines)
+            )
+        return self.lines // self.lines_per_record, self.bases
@@ -29,8 +29,10 @@ import os.path
 from pathlib import Path
 import sys
 
-import numpy
-import pandas
+from . import lazy_import
+
+numpy = lazy_import('numpy')
+pandas = lazy_import('pandas')
 
 DEFAULT_THREADS = 1
 
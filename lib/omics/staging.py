@@ -0,0 +1,208 @@
+# Copyright 2019 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Staging of data to node-local scratch space
+
+Input files are copied to scratch ahead of time, in the background, so that
+work can be done on local storage while the next input is still being
+transferred.  Results are written back to their destination in the
+background too, after which their scratch space is freed.  The total size of
+staged data and the number of keys staged at once can be bounded,
+read-ahead then waits for earlier data to be written back.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+
+from .filecopy import copy_fileobj
+
+
+def get_size(path):
+    """
+    Get total size of files in a directory tree
+    """
+    return sum(
+        os.lstat(os.path.join(root, i)).st_size
+        for root, _, files in os.walk(str(path))
+        for i in files
+    )
+
+
+def copy_file(src, dest):
+    """
+    Copy a file by the kernel if possible, keeping its permissions
+
+    The data is written to a temporary file first that then replaces dest, so
+    dest is never left half written.
+    """
+    tmp = dest.with_name('.' + dest.name + '.staging')
+    with src.open('rb') as i, tmp.open('wb') as o:
+        copy_fileobj(i, o)
+    shutil.copymode(str(src), str(tmp))
+    os.replace(str(tmp), str(dest))
+
+
+class Stager():
+    """
+    Stage input files into scratch and write results back asynchronously
+
+    Data is staged per key, e.g. a sample, in a directory of its own.  One
+    thread reads ahead and one thread writes back, both in the order of the
+    calls.  Use as context manager, on exit pending transfers are completed
+    and the scratch directory is removed unless it still holds data that
+    failed to be written back.
+
+    :param str scratch: Directory in which to make the staging directory, by
+                        default the directory given by the TMPDIR environment
+                        variable or the system's default temporary directory.
+    :param int max_bytes: Bound on the total size of staged data, None for no
+                          bound.  Data of a key that alone exceeds the bound
+                          is staged once nothing else is.
+    :param int max_keys: Bound on the number of keys whose data is in
+                         scratch, from staging in until written back, None
+                         for no bound.
+    """
+    def __init__(self, scratch=None, max_bytes=None, max_keys=None):
+        self.root = Path(tempfile.mkdtemp(prefix='omics-stage-', dir=scratch))
+        self.max_bytes = max_bytes
+        self.max_keys = max_keys
+        self.used = 0
+        self._usage = {}
+        self._cond = threading.Condition()
+        self._read_ahead = ThreadPoolExecutor(max_workers=1)
+        self._write_back = ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._read_ahead.shutdown()
+        self._write_back.shutdown()
+        if not self._usage:
+            shutil.rmtree(str(self.root), ignore_errors=True)
+
+    def local_dir(self, key):
+        """
+        Get the scratch directory for a key
+        """
+        return self.root / key
+
+    def _reserve(self, key, size):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: not self._usage or (
+                    (self.max_bytes is None
+                     or self.used + size <= self.max_bytes)
+                    and (self.max_keys is None
+                         or len(self._usage) < self.max_keys)
+                )
+            )
+            self.used += size
+            self._usage[key] = self._usage.get(key, 0) + size
+
+    def _update(self, key):
+        """
+        Account for data made in scratch since staging in
+        """
+        size = get_size(self.local_dir(key))
+        with self._cond:
+            self.used += size - self._usage.get(key, 0)
+            self._usage[key] = size
+
+    def stage_in(self, key, files, base=None):
+        """
+        Copy files into scratch in the background
+
+        :param str key: Name of the scratch directory for the files
+        :param list files: List of Path objects
+        :param Path base: Directory the files are relative to, their path
+                          below it is kept in scratch.  By default all files
+                          go directly into the key's directory.
+        :return: A Future for the key's scratch directory
+        """
+        return self._read_ahead.submit(self._stage_in, key, files, base)
+
+    def _stage_in(self, key, files, base):
+        self._reserve(key, sum(i.stat().st_size for i in files))
+        local = self.local_dir(key)
+        local.mkdir()
+        for i in files:
+            if base is None:
+                dest = local / i.name
+            else:
+                dest = local / i.relative_to(base)
+                dest.parent.mkdir(parents=True, exist_ok=True)
+            copy_file(i, dest)
+        return local
+
+    def stage_out(self, key, dest, exclude=(), before=None):
+        """
+        Write a key's scratch directory back in the background, then free it
+
+        Files are written to the same relative path in the destination,
+        replacing existing files.  If writing fails, the scratch data is kept.
+
+        :param str key: The key
+        :param Path dest: Destination directory
+        :param exclude: Paths, relative to the scratch directory, of files not
+                        to be written back, e.g. the staged input files
+        :param before: Optional function to call before writing back, e.g. to
+                       clean up the destination
+        :return: A Future for the destination
+        """
+        self._update(key)
+        return self._write_back.submit(self._stage_out, key, dest,
+                                       set(map(Path, exclude)), before)
+
+    def _stage_out(self, key, dest, exclude, before):
+        if before is not None:
+            before()
+        local = self.local_dir(key)
+        for root, dirs, files in os.walk(str(local)):
+            root = Path(root)
+            reldir = root.relative_to(local)
+            (dest / reldir).mkdir(exist_ok=True)
+            for i in sorted(files):
+                if reldir / i in exclude:
+                    continue
+                src = root / i
+                if src.is_symlink():
+                    target = dest / reldir / i
+                    if target.is_symlink() or target.exists():
+                        target.unlink()
+                    target.symlink_to(os.readlink(str(src)))
+                else:
+                    copy_file(src, dest / reldir / i)
+        self.evict(key)
+        return dest
+
+    def evict(self, key):
+        """
+        Remove a key's data from scratch
+        """
+        shutil.rmtree(str(self.local_dir(key)), ignore_errors=True)
+        with self._cond:
+            self.used -= self._usage.pop(key, 0)
+            self._cond.notify_all()